@@ -1,9 +1,14 @@
+import contextlib
+import json
 from pathlib import Path
 
 import pytest
 
 from allauth.account.models import EmailAddress
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
@@ -18,6 +23,64 @@ def tests_output_path():
     return output_path
 
 
+@pytest.fixture(autouse=True)
+def entitlement_cache(settings):
+    """Keep cached auth_resource answers in a local cache, which is cleared for every test."""
+    settings.CACHES = dict(settings.CACHES, entitlements={
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'entitlements',
+    })
+    settings.ENTITLEMENT_CACHE = 'entitlements'
+    cache = caches['entitlements']
+    cache.clear()
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def immediate_on_commit(request, monkeypatch):
+    """Run on_commit callbacks right away, the transactions of tests using db are never committed."""
+    if 'transactional_db' not in request.fixturenames:
+        monkeypatch.setattr('django.db.transaction.on_commit', lambda func, using=None: func())
+
+
+@pytest.fixture(autouse=True)
+def query_budget(settings):
+    """Fail requests running more SQL queries than their budget, see qabel_provider.middleware."""
+    settings.QUERY_BUDGET_STRICT = True
+
+
+@pytest.fixture
+def queries_for():
+    """Return a function calling *run* (with *args* and *kwargs*) and returning the SQL statements it executed."""
+    def capture(run, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            run(*args, **kwargs)
+        return [query['sql'] for query in context.captured_queries]
+    return capture
+
+
+@pytest.fixture
+def assert_num_queries():
+    """Return a context manager asserting that exactly *num* SQL statements (including savepoints) are executed."""
+    @contextlib.contextmanager
+    def do_assert(num):
+        with CaptureQueriesContext(connection) as context:
+            yield
+        queries = [query['sql'] for query in context.captured_queries]
+        assert len(queries) == num, 'Executed %d queries instead of %d:\n%s' % (len(queries), num, '\n'.join(queries))
+    return do_assert
+
+
+@pytest.fixture
+def age():
+    """Return a function moving the timestamp *field* of the dict cached under *key* in *cache* back *by* a timedelta."""
+    def move_back(cache, key, field, by):
+        entry = cache.get(key)
+        entry[field] -= by
+        cache.set(key, entry)
+    return move_back
+
+
 @pytest.fixture
 def user(db):
     try:
@@ -78,3 +141,116 @@ def user_client(api_client, user):
 def external_api_client(user, api_secret):
     client = APIClient(HTTP_APISECRET=api_secret)
     return client
+
+
+@pytest.fixture
+def auth_resource_path():
+    return '/api/v0/internal/user/'
+
+
+@pytest.fixture
+def auth_resource_batch_path():
+    return '/api/v0/internal/user/batch/'
+
+
+@pytest.fixture
+def register_on_behalf_path():
+    return '/api/v0/internal/user/register/'
+
+
+@pytest.fixture
+def register_bulk_path():
+    return '/api/v0/internal/user/register/bulk/'
+
+
+@pytest.fixture
+def plan_subscription_path():
+    return '/api/v0/plan/subscription/'
+
+
+@pytest.fixture
+def plan_interval_path():
+    return '/api/v0/plan/add-interval/'
+
+
+@pytest.fixture
+def plan_batch_path():
+    return '/api/v0/plan/batch/'
+
+
+@pytest.fixture
+def audit_log_path():
+    return '/api/v0/internal/audit-log/'
+
+
+@pytest.fixture
+def usage_path():
+    return '/api/v0/internal/usage/'
+
+
+@pytest.fixture
+def entitlement_changes_path():
+    return '/api/v0/internal/user/changes/'
+
+
+@pytest.fixture
+def auth_call(external_api_client, token, auth_resource_path):
+    """Return a function posting *payload* (the token of the user by default) to auth_resource, returning the answer."""
+    def make_request(**payload):
+        payload = payload or {'auth': 'Token {}'.format(token)}
+        response = external_api_client.post(auth_resource_path, payload)
+        assert response.status_code == 200, response.json()
+        return response.json()
+    return make_request
+
+
+@pytest.fixture
+def register_bulk(external_api_client, register_bulk_path):
+    """Return a function posting *lines* (records or strings) to register_on_behalf_bulk, returning the results."""
+    def post(*lines):
+        body = '\n'.join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+        response = external_api_client.post(register_bulk_path, body, content_type='application/x-ndjson')
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'application/x-ndjson'
+        return [json.loads(line) for line in response.content.decode().splitlines()]
+    return post
+
+
+@pytest.fixture
+def plan_batch(external_api_client, plan_batch_path):
+    """Return a function posting *changes* to plan_batch, returning their results."""
+    def post(*changes):
+        response = external_api_client.post(plan_batch_path, {'changes': list(changes)}, format='json')
+        assert response.status_code == 200, response.json()
+        return response.json()['changes']
+    return post
+
+
+@pytest.fixture
+def export(external_api_client, audit_log_path):
+    """Return a function exporting the audit log from *since* until *until*, returning the content type and content."""
+    def get(since, until, **params):
+        params.update(since=since.isoformat(), until=until.isoformat())
+        response = external_api_client.get(audit_log_path, params)
+        assert response.status_code == 200
+        return response['Content-Type'], b''.join(response.streaming_content).decode()
+    return get
+
+
+@pytest.fixture
+def report(external_api_client, usage_path):
+    """Return a function reporting the usage *entries* like a block server."""
+    def make_request(*entries):
+        response = external_api_client.post(usage_path, {'users': list(entries)}, format='json')
+        assert response.status_code == 200, response.json()
+    return make_request
+
+
+@pytest.fixture
+def feed(external_api_client, entitlement_changes_path):
+    """Return a function fetching the entitlement changes feed with *params*."""
+    def fetch(**params):
+        response = external_api_client.get(entitlement_changes_path, params)
+        assert response.status_code == 200, response.json()
+        return response.json()
+    return fetch
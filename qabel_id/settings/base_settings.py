@@ -36,6 +36,7 @@ INSTALLED_APPS = (
 
 MIDDLEWARE_CLASSES = (
     'django_prometheus.middleware.PrometheusBeforeMiddleware',
+    'qabel_provider.middleware.QueryBudgetMiddleware',
     'log_request_id.middleware.RequestIDMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -164,6 +165,10 @@ USE_TZ = True
 # The old password is required to change it to a new password
 OLD_PASSWORD_FIELD_ENABLED = True
 
+REST_AUTH_SERIALIZERS = {
+    'PASSWORD_RESET_SERIALIZER': 'qabel_provider.serializers.QueuedPasswordResetSerializer',
+}
+
 REST_AUTH_REGISTER_SERIALIZERS = {
     'REGISTER_SERIALIZER': 'qabel_provider.serializers.UserSerializer'
 }
@@ -183,8 +188,58 @@ MENU = (
     'qabel_id.urls.staff_menu',
 )
 
+# Cache alias and maximum lifetime (in seconds) of cached auth_resource answers, see qabel_provider.entitlements.
+# A timeout of zero disables the cache.
+ENTITLEMENT_CACHE = 'default'
+ENTITLEMENT_CACHE_TIMEOUT = 5 * 60
+# Maximum lifetime (in seconds) of entitlement tickets handed out by auth_resource, see qabel_provider.tickets.
+ENTITLEMENT_TICKET_LIFETIME = 5 * 60
+# Maximum time (in seconds) clients of the entitlement change feed may wait for new changes. Every waiting client
+# holds a uWSGI worker meanwhile, so keep it short, and have a worker per block server on top of the usual ones.
+ENTITLEMENT_FEED_MAX_WAIT = 5
+
+# Cache alias usage deltas reported by block servers are added up in until the flush_usage command writes them to
+# the database, see qabel_provider.usage. This needs to be shared by all processes (and support atomic increments).
+USAGE_CACHE = 'default'
+
+# Cache alias the counts exported as prometheus metrics are kept in, and the age (in seconds) after which they are not
+# exported anymore. The snapshot_stats command should refresh them more often, see qabel_provider.monitoring.
+MONITORING_CACHE = 'default'
+MONITORING_STATS_MAX_AGE = 5 * 60
+
+# SQL query budgets of requests: maximum number of queries and total time (in seconds) spent in the database, by URL
+# name, see qabel_provider.middleware. Views not listed get QUERY_BUDGET, None disables the budget of a view. Requests
+# over budget are logged and counted, the plan of the slowest query of a share (QUERY_BUDGET_EXPLAIN_RATE) of them is
+# logged too. QUERY_BUDGET_STRICT fails requests running too many queries instead, the tests do that.
+QUERY_BUDGET = (30, 0.5)
+QUERY_BUDGETS = {
+    'api-auth': (16, 0.1),
+    'api-plan-subscription': (20, 0.2),
+    'api-plan-add-interval': (20, 0.2),
+    'api-register': (45, 0.5),
+    'rest_register': (60, 0.5),
+    'rest_login': (35, 0.5),
+    'user-history': (10, 0.2),
+    # Long-polls run one query per second waited, up to ENTITLEMENT_FEED_MAX_WAIT
+    'api-entitlement-changes': (15, 0.5),
+    # Includes the export_user_data action
+    'admin:auth_user_changelist': (15, 0.5),
+    # About 20 queries (plus one per plan) per chunk of 500 changes, with up to 10000 changes per request
+    'api-plan-batch': (500, 10),
+    # About 10 queries per chunk of 500 records, with up to 10000 records per request
+    'api-register-bulk': (250, 10),
+}
+QUERY_BUDGET_STRICT = False
+QUERY_BUDGET_EXPLAIN_RATE = 0.1
+
 # No trailing slash please
 BLOCK_URL = 'https://block.qabel.org'
+# Timeouts (in seconds) of requests to the block server, and the circuit breaker: after BLOCK_FAILURE_THRESHOLD
+# consecutive failures requests fail fast for BLOCK_RESET_TIMEOUT seconds. See qabel_provider.block.
+BLOCK_CONNECT_TIMEOUT = 3
+BLOCK_READ_TIMEOUT = 10
+BLOCK_FAILURE_THRESHOLD = 5
+BLOCK_RESET_TIMEOUT = 30
 OUTGOING_REQUEST_ID_HEADER = 'X-Request-ID'
 
 FACET_USER_PROFILE = False
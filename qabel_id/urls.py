@@ -17,11 +17,13 @@ from django.conf import settings
 from django.conf.urls import include, url
 from django.contrib import admin
 from django.contrib.auth import urls as auth_urls
+from django.contrib.auth import views as auth_views
 from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import pgettext_lazy as _context
 from qabel_provider import views
+from qabel_provider.forms import QueuedPasswordResetForm
 from rest_auth.views import (
     LogoutView, UserDetailsView, PasswordChangeView,
     PasswordResetView, PasswordResetConfirmView
@@ -30,13 +32,11 @@ from rest_auth.registration.views import VerifyEmailView
 from rest_auth.registration import urls as registration_urls
 from allauth.account.views import ConfirmEmailView, EmailVerificationSentView
 import nested_admin.urls
-import django_prometheus.urls
 
 from qabel_web_theme import urls as theme_urls
 from dispatch_service.views import dispatch
 
-# Import the module somewhere, so it can register itself.
-import qabel_provider.monitoring
+from qabel_provider import monitoring
 
 rest_auth_register_urls = [
     url(r'^$', views.PasswordPolicyRegisterView.as_view(), name='rest_register'),
@@ -60,15 +60,23 @@ rest_urls = [
     url(r'^auth/', include(rest_auth_urls)),
     url(r'^auth/registration/', include(registration_urls)),
     url(r'^internal/user/$', views.auth_resource, name='api-auth'),
-    url(r'^internal/user/register/$', views.register_on_behalf),
-
-    url(r'^plan/subscription/$', views.plan_subscription),
-    url(r'^plan/add-interval/$', views.plan_add_interval),
+    url(r'^internal/user/batch/$', views.auth_resource_batch, name='api-auth-batch'),
+    url(r'^internal/user/changes/$', views.entitlement_changes, name='api-entitlement-changes'),
+    url(r'^internal/user/register/$', views.register_on_behalf, name='api-register'),
+    url(r'^internal/user/register/bulk/$', views.register_on_behalf_bulk, name='api-register-bulk'),
+    url(r'^internal/usage/$', views.usage_report, name='api-usage'),
+    url(r'^internal/audit-log/$', views.audit_log_export, name='api-audit-log'),
+
+    url(r'^plan/subscription/$', views.plan_subscription, name='api-plan-subscription'),
+    url(r'^plan/add-interval/$', views.plan_add_interval, name='api-plan-add-interval'),
+    url(r'^plan/batch/$', views.plan_batch, name='api-plan-batch'),
+
+    url(r'^account/history/$', views.account_history, name='api-account-history'),
 ]
 
 profile_urls = [
     url(r'^$', views.user_profile, name='user-profile'),
-    url(r'^account/history$', views.user_history),
+    url(r'^account/history$', views.user_history, name='user-history'),
     url(r'^change/profile$', views.change_user_profile, name='change-user-profile'),
 ]
 
@@ -94,10 +102,12 @@ urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^nested_admin/', include(nested_admin.urls)),
     url(r'^accounts/login/', views.user_login, name='login'),  # overrides auth_urls.login
+    url(r'^accounts/password_reset/$', auth_views.password_reset,  # overrides auth_urls.password_reset
+        {'password_reset_form': QueuedPasswordResetForm}, name='password_reset'),
     url(r'^accounts/', include(auth_urls)),
     url(r'^api/v0/', include(rest_urls)),
     url('', include(profile_urls)),
-    url('', include(django_prometheus.urls)),
+    url(r'^metrics$', monitoring.metrics, name='prometheus-django-metrics'),
     url(r'^account-confirm-email/(?P<key>\w+)/$', ConfirmEmailView.as_view(),
         name='account_confirm_email'),
     url(r'^account-email-verification-sent/$', EmailVerificationSentView.as_view(),
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "qabel_id.settings")
 
 application = get_wsgi_application()
+
+try:
+    import uwsgi
+except ImportError:
+    pass
+else:
+    from qabel_provider.monitoring import mark_worker_dead
+    uwsgi.atexit = mark_worker_dead
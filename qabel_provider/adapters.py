@@ -1,8 +1,18 @@
 from allauth.account.adapter import DefaultAccountAdapter
 
+from . import outbox
+
 
 class IgnoreInvalidMailsAdapter(DefaultAccountAdapter):
+    # Mails queued in the outbox (see qabel_provider.outbox) instead of being sent right away.
+    # These are the confirmation mails sent from Profile.check_confirmation_and_send_mail, e.g. in auth_resource.
+    queued_templates = (
+        'account/email/email_confirmation',
+    )
 
     def send_mail(self, template_prefix, email, context):
         msg = self.render_mail(template_prefix, email, context)
-        msg.send(fail_silently=True)
+        if template_prefix in self.queued_templates:
+            outbox.enqueue(msg)
+        else:
+            msg.send(fail_silently=True)
@@ -1,9 +1,12 @@
 import csv
+import logging
 
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.admin import UserAdmin as OriginalUserAdmin
 from django.contrib.auth.models import User
 from django.http import HttpResponse
+from django.template.defaultfilters import filesizeformat
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -11,8 +14,11 @@ from allauth.account.models import EmailAddress
 
 import nested_admin
 
+from .block import BlockUnavailable, get_block_quotas
 from .models import Profile, Plan, PlanInterval, ProfilePlanLog
 
+logger = logging.getLogger(__name__)
+
 admin.site.site_title = _('Accounting')
 admin.site.site_header = _('Qabel Account Management')
 admin.site.index_title = _('Qabel Account Management')
@@ -55,8 +61,40 @@ class UserProfileInline(nested_admin.NestedStackedInline):
     )
 
 
+class PageStorageUsed:
+    """Storage used by the users of one changelist page, looked up on first use with one block server request."""
+
+    def __init__(self, user_ids):
+        self.user_ids = user_ids
+        self.quotas = None
+
+    def of(self, user_id):
+        if self.quotas is None:
+            try:
+                self.quotas = get_block_quotas(self.user_ids)
+            except BlockUnavailable as exc:
+                logger.warning('Unable to retrieve block quotas: %s', exc)
+                self.quotas = {}
+            except Exception:
+                logger.exception('Unable to retrieve block quotas.')
+                self.quotas = {}
+        quota = self.quotas.get(user_id)
+        if quota:
+            return quota[1]
+
+
+class UserChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        users = list(self.result_list)
+        page_storage_used = PageStorageUsed([user.id for user in users])
+        for user in users:
+            user.page_storage_used = page_storage_used
+
+
 class UserAdmin(OriginalUserAdmin, nested_admin.NestedModelAdmin):
     inlines = [UserProfileInline]
+    list_display = OriginalUserAdmin.list_display + ('storage_used',)
     list_filter = OriginalUserAdmin.list_filter + \
         ('profile__plus_notification_mail', 'profile__pro_notification_mail',
          'profile__subscribed_plan',
@@ -82,6 +120,16 @@ class UserAdmin(OriginalUserAdmin, nested_admin.NestedModelAdmin):
         return response
     export_user_data.short_description = _('admin user action export data label')
 
+    def get_changelist(self, request, **kwargs):
+        return UserChangeList
+
+    def storage_used(self, user):
+        storage_used = user.page_storage_used.of(user.id)
+        if storage_used is None:
+            return _('unavailable')
+        return filesizeformat(storage_used)
+    storage_used.short_description = _('Storage used')
+
 
 class PlanAdmin(admin.ModelAdmin):
     model = Plan
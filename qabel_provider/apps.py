@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class QabelProviderConfig(AppConfig):
+    name = 'qabel_provider'
+    verbose_name = 'Qabel accounting'
+
+    def ready(self):
+        from . import entitlements
+        entitlements.connect_signals()
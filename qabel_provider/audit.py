@@ -0,0 +1,108 @@
+"""
+Export and archival of the audit log (ProfilePlanLog) for finance reconciliation.
+
+Entries are read in chunks of CHUNK_SIZE by keyset on (timestamp, id), which is covered by an index, and the output
+is generated entry by entry. Exports of any size therefore take constant memory, and the response starts streaming
+right away.
+
+The archive_audit_log command moves the entries of months older than HOT_MONTHS into ArchivedProfilePlanLog (see
+archive), so that the ProfilePlanLog table stays small. Exports read both tables.
+"""
+import csv
+import datetime
+import json
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ArchivedProfilePlanLog, ProfilePlanLog
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2000
+
+# Number of months (including the current one) kept in ProfilePlanLog by archive_audit_log
+HOT_MONTHS = 6
+ARCHIVE_BATCH_SIZE = 500
+
+# Names of the exported fields, and the columns they are read from
+FIELDS = ('id', 'timestamp', 'user_id', 'username', 'action', 'plan', 'interval', 'origin')
+COLUMNS = ('id', 'timestamp', 'profile_id', 'profile__user__username', 'action', 'plan_id', 'interval_id', 'origin')
+
+
+def entries(since, until):
+    """Yield the audit log entries from *since* (inclusive) to *until* (exclusive) as dicts of FIELDS, oldest first."""
+    # Archived entries are older than the others
+    for model in (ArchivedProfilePlanLog, ProfilePlanLog):
+        last = None
+        while True:
+            chunk = model.objects.filter(timestamp__gte=since, timestamp__lt=until)
+            if last:
+                last_id, last_timestamp = last[:2]
+                chunk = chunk.filter(Q(timestamp__gt=last_timestamp) | Q(timestamp=last_timestamp, id__gt=last_id))
+            count = 0
+            for last in chunk.order_by('timestamp', 'id').values_list(*COLUMNS)[:CHUNK_SIZE].iterator():
+                count += 1
+                yield dict(zip(FIELDS, last))
+            if count < CHUNK_SIZE:
+                break
+
+
+class Echo:
+    """File-like object returning what is written, for generating CSV row by row."""
+
+    def write(self, value):
+        return value
+
+
+def as_csv(entries):
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for entry in entries:
+        entry['timestamp'] = entry['timestamp'].isoformat()
+        yield writer.writerow([entry[field] for field in FIELDS])
+
+
+def as_ndjson(entries):
+    for entry in entries:
+        entry['timestamp'] = entry['timestamp'].isoformat()
+        yield json.dumps(entry) + '\n'
+
+
+# Export formats, mapping to (content type, generator)
+FORMATS = {
+    'csv': ('text/csv', as_csv),
+    'ndjson': ('application/x-ndjson', as_ndjson),
+}
+
+
+def archive_before(now=None, hot_months=HOT_MONTHS):
+    """Return the start of the oldest month kept in ProfilePlanLog at *now*: *hot_months* include the current one."""
+    now = timezone.localtime(now or timezone.now())
+    year, month = divmod(now.year * 12 + now.month - 1 - (hot_months - 1), 12)
+    return timezone.make_aware(datetime.datetime(year, month + 1, 1))
+
+
+def archive(before, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move the ProfilePlanLog entries before *before* into ArchivedProfilePlanLog, *batch_size* entries per transaction.
+
+    Return the number of entries moved.
+    """
+    moved = 0
+    while True:
+        with transaction.atomic():
+            batch = list(ProfilePlanLog.objects
+                         .filter(timestamp__lt=before)
+                         .order_by('timestamp', 'id')
+                         .values('id', 'profile_id', 'timestamp', 'action', 'plan_id', 'interval_id', 'origin')
+                         [:batch_size])
+            if not batch:
+                return moved
+            ArchivedProfilePlanLog.objects.bulk_create([ArchivedProfilePlanLog(**entry) for entry in batch])
+            # A bulk delete, ProfilePlanLog.delete refuses to delete single entries
+            ProfilePlanLog.objects.filter(id__in=[entry['id'] for entry in batch]).delete()
+        moved += len(batch)
+        logger.info('Archived %d audit log entries before %s', moved, before)
@@ -1,16 +1,177 @@
+"""
+Client of the block server API.
+
+Requests go through one keep-alive session per process and thread, so that connections (and TLS sessions) to
+BLOCK_URL are reused. Every request is bounded by BLOCK_CONNECT_TIMEOUT and BLOCK_READ_TIMEOUT. After
+BLOCK_FAILURE_THRESHOLD consecutive failures the circuit breaker opens: requests fail fast with BlockUnavailable for
+BLOCK_RESET_TIMEOUT seconds, then a single trial request decides whether the block server is back.
+
+Lookups on behalf of the accounting server (like get_block_quotas) authenticate with the API_SECRET shared with the
+block server, in the APISECRET header, just like the block server does when calling auth_resource.
+"""
 import logging
+import os
+import threading
+import time
 
+import requests
 from django.conf import settings
+from prometheus_client import Counter, Gauge, Histogram
+from requests.adapters import HTTPAdapter
 
 from log_request_id.session import Session
 
-from rest_auth.app_settings import create_token
-from rest_auth.models import TokenModel
-
 
 module_logger = logging.getLogger(__name__)
 
-BASE_URL = settings.BLOCK_URL + '/api/v0/'
+request_duration = Histogram('block_request_duration_seconds', 'Duration of requests to the block server',
+                             ['endpoint'])
+request_errors = Counter('block_request_errors_total', 'Failed requests to the block server', ['endpoint', 'error'])
+# Per worker; live gauges drop the values (and files) of exited workers, see qabel_provider.monitoring.mark_worker_dead
+circuit_open = Gauge('block_circuit_open', 'Whether requests to the block server fail fast (circuit breaker open)',
+                     multiprocess_mode='liveall')
+
+
+class BlockUnavailable(Exception):
+    """Raised instead of sending requests while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fail fast after *failure_threshold* consecutive failures, for *reset_timeout* seconds.
+
+    Afterwards one trial call is let through (half-open); its outcome closes or reopens the breaker.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raise BlockUnavailable if calls should fail fast. Return whether the call is the trial call."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if self.trial_running or self.clock() - self.opened_at < self.reset_timeout:
+                raise BlockUnavailable('Block server unavailable, not trying again before %.1f seconds passed'
+                                       % self.reset_timeout)
+            self.trial_running = True
+            return True
+
+    def trial_ended(self):
+        """Let the next trial call through, in case the trial call ended without succeeded() or failed()."""
+        with self.lock:
+            self.trial_running = False
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+        circuit_open.set(0)
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is None and self.failures < self.failure_threshold:
+                return
+            self.opened_at = self.clock()
+        module_logger.warning('Block server failed %d times in a row, failing fast for %.1f seconds',
+                              self.failures, self.reset_timeout)
+        circuit_open.set(1)
+
+
+class BlockClient:
+    def __init__(self, base_url, connect_timeout, read_timeout, failure_threshold, reset_timeout, pool_size=10):
+        self.base_url = base_url.rstrip('/') + '/api/v0/'
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        # Sessions must not be shared with forked worker processes, which would share the sockets.
+        if getattr(self.local, 'pid', None) != os.getpid():
+            session = Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+            self.local.pid = os.getpid()
+        return self.local.session
+
+    def request(self, method, endpoint, **kwargs):
+        """
+        Send request to *endpoint* (relative to the API root) and return the response.
+
+        Raise BlockUnavailable while the circuit breaker is open, and requests exceptions on errors.
+        Responses with status 5xx count as failures of the block server, but are returned.
+        """
+        try:
+            trial = self.breaker.before_call()
+        except BlockUnavailable:
+            request_errors.labels(endpoint, 'circuit_open').inc()
+            raise
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return self.send(method, endpoint, **kwargs)
+        finally:
+            # Other exceptions (like InvalidURL, a ValueError) don't count as failures, but must not keep
+            # the breaker open for good.
+            if trial:
+                self.breaker.trial_ended()
+
+    def send(self, method, endpoint, **kwargs):
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, self.base_url + endpoint, **kwargs)
+        except requests.Timeout:
+            self.breaker.failed()
+            request_errors.labels(endpoint, 'timeout').inc()
+            raise
+        except requests.RequestException:
+            self.breaker.failed()
+            request_errors.labels(endpoint, 'connection').inc()
+            raise
+        finally:
+            request_duration.labels(endpoint).observe(time.monotonic() - started)
+        if response.status_code >= 500:
+            self.breaker.failed()
+            request_errors.labels(endpoint, 'status').inc()
+        else:
+            self.breaker.succeeded()
+        return response
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def internal_post(self, endpoint, data):
+        """POST *data* as JSON to the internal API *endpoint*, authenticated by API_SECRET."""
+        return self.request('POST', endpoint, json=data, headers={'APISECRET': settings.API_SECRET})
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the BlockClient of this process, configured by the BLOCK_* settings."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = BlockClient(settings.BLOCK_URL,
+                                  connect_timeout=settings.BLOCK_CONNECT_TIMEOUT,
+                                  read_timeout=settings.BLOCK_READ_TIMEOUT,
+                                  failure_threshold=settings.BLOCK_FAILURE_THRESHOLD,
+                                  reset_timeout=settings.BLOCK_RESET_TIMEOUT)
+        return _client
 
 
 def check_response(response, logger=None, ok_codes=(200,)):
@@ -27,13 +188,38 @@ def check_response(response, logger=None, ok_codes=(200,)):
     raise ValueError('Request failed with status code %d', response.status_code)
 
 
-def get_block_quota_of_user(user):
-    logger = module_logger.getChild('get_block_quota_of_user')
-    logger.info('Retrieving quota of user %r on %r', user.username, settings.BLOCK_URL)
-    response = Session().get(BASE_URL + 'quota/', headers={
-        'Authorization': 'Token %s' % create_token(TokenModel, user, None),
-    })
-    check_response(response, logger)
-    quota = response.json()
-    logger.info('Received quota: %r', quota)
-    return quota['quota'], quota['size']
+# Maximum number of users looked up with one request by get_block_quotas
+QUOTA_BATCH_SIZE = 100
+
+
+def get_block_quotas(user_ids, client=None):
+    """
+    Return dict mapping *user_ids* to (quota, size) tuples, as known to the block server.
+
+    Users are looked up in batches of QUOTA_BATCH_SIZE, with one request each. The block server answers
+    POST internal/quota/ ``{"user_ids": [INT, ...]}`` with ``{"users": {"ID": {"quota": INT, "size": INT}, ...}}``,
+    including every requested user.
+    """
+    logger = module_logger.getChild('get_block_quotas')
+    client = client or get_client()
+    user_ids = list(user_ids)
+    quotas = {}
+    for start in range(0, len(user_ids), QUOTA_BATCH_SIZE):
+        batch = user_ids[start:start + QUOTA_BATCH_SIZE]
+        logger.info('Retrieving quota of %d users on %r', len(batch), client.base_url)
+        response = client.internal_post('internal/quota/', {'user_ids': batch})
+        check_response(response, logger)
+        users = response.json()['users']
+        for user_id in batch:
+            try:
+                quota = users[str(user_id)]
+            except KeyError:
+                raise ValueError('Block server did not return the quota of user %d' % user_id)
+            quotas[user_id] = quota['quota'], quota['size']
+    return quotas
+
+
+def get_block_quota_of_user(user, client=None):
+    quota, size = get_block_quotas([user.id], client)[user.id]
+    module_logger.info('Received quota of user %r: %r', user.username, (quota, size))
+    return quota, size
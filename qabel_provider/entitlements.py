@@ -0,0 +1,594 @@
+"""
+Effective entitlements of users, i.e. auth_resource answers.
+
+Entitlements are materialized per profile in the Entitlement table, which is rewritten whenever one of the models
+the entitlements are computed from changes (see refresh_user and the signal receivers below). Changes made in a
+transaction rewrite the row of each user once, after the commit (see schedule_refresh). The rebuild_entitlements
+and check_entitlements management commands backfill and verify the table.
+
+The over_quota flag of the rows is not computed here, it is maintained from the usage rollups by qabel_provider.usage.
+
+Whenever the answer of a user changes, an EntitlementChange is recorded, block servers follow these to keep local
+copies of entitlements up to date (see changes_after). Plan changes are recorded once per plan, not per user.
+
+In front of the table sits a read-through cache of auth_resource answers. Answers are cached per user ID; tokens are
+cached as pointers to the user ID. Entries are dropped whenever one of the models the answer is computed from changes.
+Plan changes affect many users at once, these bump a generation counter instead, which invalidates all entries cached
+before. Invalidation also changes a version of the user or token; answers are only stored if the generation and the
+versions are still those read before computing them, so that answers computed concurrently with a change don't outlive
+it in the cache.
+"""
+import uuid
+import weakref
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction, IntegrityError
+from django.db.models import Case, F, Max, Min, Q, Value, When
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .models import Entitlement, EntitlementChange, EntitlementFeed, Plan, PlanInterval, Profile, ProfilePlanLog, select_entitlement_data
+
+GENERATION_KEY = 'entitlement-generation'
+# Versions only need to outlive the requests computing answers, see store()
+VERSION_TIMEOUT = 60 * 60
+
+
+def get_cache():
+    return caches[settings.ENTITLEMENT_CACHE]
+
+
+def token_key(token):
+    return 'entitlement-token-%s' % token
+
+
+def user_key(user_id):
+    return 'entitlement-user-%d' % user_id
+
+
+def version_key(user_id):
+    return 'entitlement-version-user-%d' % user_id
+
+
+def token_version_key(token):
+    return 'entitlement-version-token-%s' % token
+
+
+def lookup(identifications):
+    """
+    Return cached answers for *identifications* and the versions to pass to store() for the others.
+
+    *identifications* are (kind, value) tuples as returned by views.parse_user_identification. The answers are a dict
+    mapping (kind, value) to (answer, valid_until) tuples, identifications without a (valid) cache entry are omitted.
+    The versions are the generation and the versions of the users and tokens, as read before the answers.
+    This doesn't touch the database.
+    """
+    if not settings.ENTITLEMENT_CACHE_TIMEOUT or not identifications:
+        return {}, {}
+    cache = get_cache()
+    tokens = [value for kind, value in identifications if kind == 'token']
+    version_keys = [GENERATION_KEY] + [token_version_key(token) for token in tokens]
+    entries = cache.get_many(version_keys + [token_key(token) for token in tokens])
+    versions = {key: entries.get(key) for key in version_keys}
+    user_ids = {}
+    for token in tokens:
+        user_id = entries.get(token_key(token))
+        if user_id is not None:
+            user_ids[('token', token)] = user_id
+    for kind, value in identifications:
+        if kind == 'user_id':
+            user_ids[(kind, value)] = value
+    if not user_ids:
+        return {}, versions
+
+    version_keys = [version_key(user_id) for user_id in set(user_ids.values())]
+    entries = cache.get_many(version_keys + [user_key(user_id) for user_id in set(user_ids.values())])
+    versions.update((key, entries.get(key)) for key in version_keys)
+    generation = versions[GENERATION_KEY] or 0
+    answers = {}
+    for identification, user_id in user_ids.items():
+        entry = entries.get(user_key(user_id))
+        if entry is not None and entry['generation'] == generation:
+            answers[identification] = entry['data'], entry['valid_until']
+    return answers, versions
+
+
+def valid_until(profile, active):
+    """
+    Return the point in time after which the answer for *profile* may change on its own, or None.
+
+    That is the end of the interval currently in use, the confirmation deadline for unconfirmed users and,
+    for inactive users, the time the next confirmation mail is due. If a pristine interval is waiting to be
+    started by the next auth_resource call, that is now.
+    """
+    candidates = []
+    interval = PlanInterval.peek_interval(profile)
+    if interval and interval.state == 'in_use':
+        candidates.append(interval.started_at + interval.duration)
+    elif interval:
+        candidates.append(timezone.now())
+    if not active:
+        # Inactive users get a confirmation mail now and then, see Profile.check_confirmation_and_send_mail
+        candidates.append(profile.next_confirmation_mail or timezone.now())
+    elif not profile.created_on_behalf and not profile.is_confirmed:
+        candidates.append(profile.needs_confirmation_after)
+    if candidates:
+        return min(candidates)
+
+
+# Fields of Entitlement which make up the auth_resource answer
+ANSWER_FIELDS = ('plan', 'block_quota', 'monthly_traffic_quota', 'active')
+
+
+def record_changes(user_ids):
+    """Add the users *user_ids* to the change feed."""
+    EntitlementChange.objects.bulk_create([EntitlementChange(user_id=user_id) for user_id in user_ids], batch_size=500)
+
+
+def sequence_changes():
+    """
+    Assign sequence numbers, the cursors of the feed, to the committed changes which have none yet.
+
+    Transactions may commit after others which got later IDs, so IDs can't be the cursors: a change committed late
+    would get an ID below cursors clients already passed. Sequence numbers are assigned after the commit instead,
+    under a lock, and each is higher than all assigned before. They follow the order of the IDs among the changes
+    numbered together, with one update for all of them.
+    """
+    unnumbered = EntitlementChange.objects.filter(sequence__isnull=True)
+    if not unnumbered.exists():
+        return
+    with transaction.atomic():
+        feed, _ = EntitlementFeed.objects.select_for_update().get_or_create(pk=1)
+        bounds = unnumbered.aggregate(Min('id'), Max('id'))
+        first, last = bounds['id__min'], bounds['id__max']
+        if first is None:
+            # Numbered concurrently
+            return
+        offset = feed.last_sequence + 1 - first
+        # Changes below *first* committing meanwhile are numbered next time, with a higher offset
+        unnumbered.filter(id__gte=first, id__lte=last).update(sequence=F('id') + offset)
+        feed.last_sequence = last + offset
+        feed.save(update_fields=('last_sequence',))
+
+
+def pending_after(cursor):
+    """Return whether changes_after would return changes for *cursor*, with one query."""
+    return EntitlementChange.objects.filter(Q(sequence__gt=cursor) | Q(sequence__isnull=True)).exists()
+
+
+def changes_after(cursor, limit):
+    """Return up to *limit* changes after *cursor* (a sequence number), in feed order."""
+    sequence_changes()
+    return list(EntitlementChange.objects.filter(sequence__gt=cursor).order_by('sequence')[:limit])
+
+
+def feed_cursor():
+    """Return the cursor pointing behind the latest change handed out by changes_after."""
+    sequence_changes()
+    return EntitlementChange.objects.aggregate(Max('sequence'))['sequence__max'] or 0
+
+
+def store(user_id, data, until, versions, token=None):
+    """
+    Cache the auth_resource answer *data* for *user_id* (and *token*, if given), which is valid *until*.
+
+    *versions* are the versions lookup() returned before *data* was computed. If the user (or token) was invalidated
+    since, *data* may be outdated and nothing is stored. Users found by a token without a cached pointer have no version
+    in *versions*; their answer is stored only if they have none now either, i.e. weren't invalidated recently.
+    """
+    if not settings.ENTITLEMENT_CACHE_TIMEOUT:
+        return
+    timeout = settings.ENTITLEMENT_CACHE_TIMEOUT
+    if until:
+        timeout = min(timeout, int((until - timezone.now()).total_seconds()))
+    if timeout <= 0:
+        return
+    cache = get_cache()
+    answer_keys = [GENERATION_KEY, version_key(user_id)]
+    pointer_keys = [token_version_key(token)] if token else []
+    current = cache.get_many(answer_keys + pointer_keys)
+
+    def unchanged(keys):
+        return all(current.get(key) == versions.get(key) for key in keys)
+
+    entries = {}
+    if unchanged(answer_keys):
+        entries[user_key(user_id)] = {
+            'generation': versions[GENERATION_KEY] or 0,
+            'data': data,
+            'valid_until': until,
+        }
+    if token and unchanged(pointer_keys):
+        entries[token_key(token)] = user_id
+    if entries:
+        cache.set_many(entries, timeout)
+
+
+def entitlement_values(user):
+    """
+    Return the field values of the Entitlement row of *user*.
+
+    Unlike auth_resource this doesn't start intervals or send confirmation mails,
+    it only looks at the current state (see valid_until).
+    """
+    profile = user.profile
+    interval = PlanInterval.peek_interval(profile)
+    plan = interval.plan if interval else profile.subscribed_plan
+    confirmed = profile.is_confirmed
+    active = user.is_active and (confirmed or not profile.confirmation_date_exceeded())
+    return {
+        'plan': plan,
+        'block_quota': plan.block_quota,
+        'monthly_traffic_quota': plan.monthly_traffic_quota,
+        'active': active,
+        'confirmed': confirmed,
+        'valid_until': valid_until(profile, active),
+    }
+
+
+def refresh(user):
+    """
+    Rewrite the Entitlement row of *user* and return it.
+
+    *user* should come from select_entitlement_data, otherwise computing the row costs a few queries more.
+    """
+    values = entitlement_values(user)
+    values['updated_at'] = timezone.now()
+    rows = Entitlement.objects.filter(profile_id=user.id)
+    answer = {field: values[field] for field in ANSWER_FIELDS}
+    if rows.exclude(**answer).update(**values):
+        record_changes([user.id])
+    elif not rows.update(**values):
+        try:
+            with transaction.atomic():
+                Entitlement.objects.create(profile_id=user.id, **values)
+        except IntegrityError:
+            # Created concurrently
+            rows.update(**values)
+        record_changes([user.id])
+    _refreshed([user.id])
+    return Entitlement(profile_id=user.id, **values)
+
+
+def refresh_user(user_id):
+    """Rewrite the Entitlement row of the user *user_id*, if the user and its profile exist."""
+    user = select_entitlement_data(User.objects.filter(pk=user_id)).first()
+    if user is None:
+        return
+    try:
+        user.profile
+    except ObjectDoesNotExist:
+        return
+    refresh(user)
+
+
+# Fields rewritten by refresh_many, besides updated_at, those making up the answer, and the number of rows updated
+# per statement
+REFRESHED_FIELDS = ('plan_id', 'block_quota', 'monthly_traffic_quota', 'active', 'confirmed', 'valid_until')
+ANSWER_COLUMNS = ('plan_id', 'block_quota', 'monthly_traffic_quota', 'active')
+REFRESH_BATCH_SIZE = 100
+
+
+def refresh_many(users):
+    """
+    Rewrite the Entitlement rows of *users* (from select_entitlement_data) set-wise.
+
+    Existing rows are updated with one statement per REFRESH_BATCH_SIZE users, missing rows are inserted and the
+    changes recorded with one insert each.
+    """
+    now = timezone.now()
+    existing = {}
+    missing = []
+    changed = []
+    for user in users:
+        values = entitlement_values(user)
+        values['plan_id'] = values.pop('plan').pk
+        try:
+            stored = user.profile.entitlement
+        except ObjectDoesNotExist:
+            missing.append(Entitlement(profile_id=user.id, updated_at=now, **values))
+            changed.append(user.id)
+            continue
+        existing[user.id] = values
+        if any(getattr(stored, field) != values[field] for field in ANSWER_COLUMNS):
+            changed.append(user.id)
+    user_ids = list(existing)
+    for start in range(0, len(user_ids), REFRESH_BATCH_SIZE):
+        batch = user_ids[start:start + REFRESH_BATCH_SIZE]
+        Entitlement.objects.filter(profile_id__in=batch).update(updated_at=now, **{
+            field: Case(*[When(profile_id=user_id, then=Value(existing[user_id][field])) for user_id in batch],
+                        output_field=Entitlement._meta.get_field(field))
+            for field in REFRESHED_FIELDS
+        })
+    if missing:
+        try:
+            with transaction.atomic():
+                Entitlement.objects.bulk_create(missing)
+        except IntegrityError:
+            # Some were created concurrently, refresh records the changes of these itself
+            missing_ids = {entitlement.profile_id for entitlement in missing}
+            for user in users:
+                if user.id in missing_ids:
+                    refresh(user)
+            changed = [user_id for user_id in changed if user_id not in missing_ids]
+    if changed:
+        record_changes(changed)
+    _refreshed([user.id for user in users])
+
+
+def refresh_users(user_ids):
+    """Drop cached answers and rewrite the Entitlement rows of *user_ids*, after changes made without signals."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    _drop(user_ids)
+    refresh_many(list(select_entitlement_data(User.objects.filter(pk__in=user_ids, profile__isnull=False))))
+
+
+def refresh_outdated(batch_size, now=None):
+    """
+    Rewrite the Entitlement rows whose valid_until has passed, one transaction per *batch_size* rows.
+
+    Answers also change without any write, when a confirmation deadline passes or an interval ends; rewriting the rows
+    records these changes in the feed. Return the number of rows rewritten.
+    """
+    now = now or timezone.now()
+    outdated = Entitlement.objects.filter(valid_until__lte=now).order_by('profile_id')
+    refreshed = 0
+    last_id = 0
+    while True:
+        # Rows like those of inactive users may stay outdated after rewriting, so go by ID
+        user_ids = list(outdated.filter(profile_id__gt=last_id).values_list('profile_id', flat=True)[:batch_size])
+        if not user_ids:
+            return refreshed
+        with transaction.atomic():
+            refresh_users(user_ids)
+        refreshed += len(user_ids)
+        last_id = user_ids[-1]
+
+
+def users_in_batches(batch_size):
+    """Yield all users with a profile in lists of at most *batch_size*, loaded with select_entitlement_data."""
+    last_id = 0
+    while True:
+        users = list(select_entitlement_data(
+            User.objects.filter(pk__gt=last_id, profile__isnull=False).order_by('pk')[:batch_size]))
+        if not users:
+            return
+        yield users
+        last_id = users[-1].pk
+
+
+CHECKED_FIELDS = ('plan_id', 'block_quota', 'monthly_traffic_quota', 'active', 'confirmed', 'valid_until')
+
+
+def check(users):
+    """
+    Return a dict mapping IDs of *users* with a wrong Entitlement row to dicts of field -> (stored, expected) values.
+
+    A missing row is reported as 'row': (None, 'missing'). Outdated rows (see Entitlement.valid_until) are skipped,
+    readers don't use these anyway.
+    """
+    stored = Entitlement.objects.in_bulk([user.id for user in users])
+    problems = {}
+    for user in users:
+        entitlement = stored.get(user.id)
+        if entitlement is None:
+            problems[user.id] = {'row': (None, 'missing')}
+            continue
+        if not entitlement.is_valid():
+            continue
+        expected = computed(user)
+        differences = {}
+        for field in CHECKED_FIELDS:
+            if getattr(entitlement, field) != getattr(expected, field):
+                differences[field] = getattr(entitlement, field), getattr(expected, field)
+        if differences:
+            problems[user.id] = differences
+    return problems
+
+
+def current(user):
+    """
+    Return the Entitlement row of *user* if it is up to date, None otherwise.
+
+    Load the row along with the user using select_related('profile__entitlement').
+    """
+    try:
+        entitlement = user.profile.entitlement
+    except ObjectDoesNotExist:
+        return
+    if entitlement.is_valid():
+        return entitlement
+
+
+def computed(user):
+    """Return an unsaved Entitlement row of *user*, for readers which shouldn't write (see entitlement_values)."""
+    return Entitlement(profile_id=user.id, **entitlement_values(user))
+
+
+def over_quota_of(user):
+    """Return the over_quota flag of *user*, which outdated Entitlement rows still carry."""
+    try:
+        return user.profile.entitlement.over_quota
+    except ObjectDoesNotExist:
+        return False
+
+
+def set_over_quota(user_ids, over_quota):
+    """Set the over_quota flag of the Entitlement rows of *user_ids*. Return the IDs of the users whose flag changed."""
+    changed = list(Entitlement.objects
+                   .filter(profile_id__in=user_ids)
+                   .exclude(over_quota=over_quota)
+                   .values_list('profile_id', flat=True))
+    if changed:
+        Entitlement.objects.filter(profile_id__in=changed).update(over_quota=over_quota)
+        _drop(changed)
+        record_changes(changed)
+    return changed
+
+
+def data_of(entitlement):
+    """Return the auth_resource answer for the Entitlement row *entitlement*."""
+    return {
+        'user_id': entitlement.profile_id,
+        'active': entitlement.active,
+        'block_quota': entitlement.block_quota,
+        'monthly_traffic_quota': entitlement.monthly_traffic_quota,
+        'over_quota': entitlement.over_quota,
+    }
+
+
+def _drop(user_ids=(), tokens=()):
+    """
+    Drop the cached answers of *user_ids* and the pointers of *tokens*, and change their versions.
+
+    Answers computed from the state before are then not stored anymore, see store().
+    """
+    cache = get_cache()
+    keys = [user_key(user_id) for user_id in user_ids] + [token_key(token) for token in tokens]
+    version_keys = [version_key(user_id) for user_id in user_ids] + [token_version_key(token) for token in tokens]
+
+    def drop():
+        cache.delete_many(keys)
+        cache.set_many(dict.fromkeys(version_keys, uuid.uuid4().hex), VERSION_TIMEOUT)
+
+    drop()
+    # Readers may have cached the old state between the drop above and the commit, so drop them again afterwards.
+    transaction.on_commit(drop)
+
+
+def invalidate_user(user_id):
+    _drop(user_ids=[user_id])
+
+
+def invalidate_token(token):
+    _drop(tokens=[token])
+
+
+def invalidate_all():
+    cache = get_cache()
+    cache.add(GENERATION_KEY, 0, None)
+    cache.incr(GENERATION_KEY)
+    transaction.on_commit(lambda: cache.incr(GENERATION_KEY))
+
+
+class PendingRefresh:
+    """on_commit callback rewriting the Entitlement rows of the users changed in a transaction."""
+
+    def __init__(self):
+        self.user_ids = set()
+
+    def __call__(self):
+        refresh_users(self.user_ids)
+
+
+def pending_refresh():
+    """Return the PendingRefresh of the current transaction, or None."""
+    reference = getattr(transaction.get_connection(), 'pending_entitlement_refresh', None)
+    return reference and reference()
+
+
+def schedule_refresh(user_id):
+    """
+    Rewrite the Entitlement row of *user_id* after the current transaction commits, or right away outside of one.
+
+    Every user is refreshed once per transaction, however often it changes in it, and not at all if refresh rewrote
+    its row after the last change.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        refresh_user(user_id)
+        return
+    pending = pending_refresh()
+    if pending is None:
+        pending = PendingRefresh()
+        pending.user_ids.add(user_id)
+        # Only Django holds on to the callback, until it ran or a rollback dropped it; then a new one is needed.
+        connection.pending_entitlement_refresh = weakref.ref(pending)
+        transaction.on_commit(pending)
+    else:
+        pending.user_ids.add(user_id)
+
+
+def _refreshed(user_ids):
+    """Note that the rows of *user_ids* were just rewritten, so that the pending refresh can skip them."""
+    pending = pending_refresh()
+    if pending is not None:
+        pending.user_ids.difference_update(user_ids)
+
+
+def user_changed(user_id, signal, raw=False):
+    invalidate_user(user_id)
+    if raw:
+        # Loading fixtures, related objects may not be there yet
+        return
+    if signal is post_delete:
+        # Recomputing the row while deleting a user (and thereby its intervals and email addresses) could write it
+        # after the cascade deleted it. Readers recreate missing rows.
+        Entitlement.objects.filter(profile_id=user_id).delete()
+        record_changes([user_id])
+    else:
+        schedule_refresh(user_id)
+
+
+# Fields of User which don't affect entitlements, but are saved all the time
+IGNORED_USER_FIELDS = {'last_login'}
+
+
+def user_saved_or_deleted(sender, instance, signal, raw=False, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= IGNORED_USER_FIELDS:
+        return
+    user_changed(instance.pk, signal, raw)
+
+
+def profile_changed(sender, instance, signal, raw=False, **kwargs):
+    user_changed(instance.user_id, signal, raw)
+
+
+def plan_interval_changed(sender, instance, signal, raw=False, **kwargs):
+    user_changed(instance.profile_id, signal, raw)
+
+
+def plan_log_written(sender, instance, created, signal, raw=False, **kwargs):
+    # Interval transitions are conditional updates, which don't send signals, but they always write an audit log entry.
+    user_changed(instance.profile_id, signal, raw)
+
+
+def email_address_changed(sender, instance, signal, raw=False, **kwargs):
+    user_changed(instance.user_id, signal, raw)
+
+
+def token_changed(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+def plan_changed(sender, instance, signal, **kwargs):
+    # Plans may have many users: one statement for all of their rows, and one change for the feed
+    invalidate_all()
+    if signal is post_save:
+        Entitlement.objects.filter(plan=instance).update(
+            block_quota=instance.block_quota, monthly_traffic_quota=instance.monthly_traffic_quota)
+    EntitlementChange.objects.create(plan_id=instance.pk)
+
+
+receivers = (
+    (User, user_saved_or_deleted),
+    (Profile, profile_changed),
+    (PlanInterval, plan_interval_changed),
+    (EmailAddress, email_address_changed),
+    (Token, token_changed),
+    (Plan, plan_changed),
+)
+
+
+def connect_signals():
+    for sender, receiver in receivers:
+        post_save.connect(receiver, sender=sender, dispatch_uid='entitlements-save-%s' % sender.__name__)
+        post_delete.connect(receiver, sender=sender, dispatch_uid='entitlements-delete-%s' % sender.__name__)
+    post_save.connect(plan_log_written, sender=ProfilePlanLog, dispatch_uid='entitlements-save-ProfilePlanLog')
@@ -0,0 +1,27 @@
+from django.contrib.auth.forms import PasswordResetForm
+from django.core.mail import EmailMultiAlternatives
+from django.template import loader
+
+from . import outbox
+
+
+class QueuedPasswordResetForm(PasswordResetForm):
+    """PasswordResetForm which queues its mails in the outbox (see qabel_provider.outbox) instead of sending them."""
+
+    def render_mail(self, subject_template_name, email_template_name, context, from_email, to_email,
+                    html_email_template_name=None, cc_emails=()):
+        subject = loader.render_to_string(subject_template_name, context)
+        # Email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        body = loader.render_to_string(email_template_name, context)
+
+        email_message = EmailMultiAlternatives(subject, body, from_email, [to_email], cc=cc_emails)
+        if html_email_template_name is not None:
+            html_email = loader.render_to_string(html_email_template_name, context)
+            email_message.attach_alternative(html_email, 'text/html')
+        return email_message
+
+    def send_mail(self, subject_template_name, email_template_name,
+                  context, from_email, to_email, html_email_template_name=None):
+        outbox.enqueue(self.render_mail(subject_template_name, email_template_name, context, from_email, to_email,
+                                        html_email_template_name))
@@ -0,0 +1,99 @@
+"""
+Bulk plan interval transitions.
+
+Requests expire the interval in use and start the next pristine interval lazily, when they find them due
+(see PlanInterval.get_or_start_interval). The sweep_intervals management command does these transitions ahead of time,
+with a few statements per chunk of intervals, so that requests find the intervals (and Entitlement rows) up to date.
+"""
+import logging
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import ExpressionWrapper, F, Max
+from django.utils import timezone
+
+from . import entitlements
+from .models import PlanInterval, ProfilePlanLog
+
+logger = logging.getLogger(__name__)
+
+ORIGIN = 'command sweep_intervals'
+
+
+def overdue(now):
+    """Return queryset of intervals in use which ended before *now*."""
+    ends_at = ExpressionWrapper(F('started_at') + F('duration'), output_field=models.DateTimeField())
+    return PlanInterval.objects.annotate(ends_at=ends_at).filter(state='in_use', ends_at__lt=now)
+
+
+def start_next(profile_ids, now):
+    """
+    Start the next pristine interval of the profiles *profile_ids* which have no interval in use, at *now*.
+
+    The next interval is the one PlanInterval._get_pristine_interval picks. Return (id, profile_id, plan_id) tuples
+    of the started intervals which still need an audit log entry.
+    """
+    in_use = PlanInterval.objects.filter(profile_id__in=profile_ids, state='in_use').values('profile_id')
+    next_intervals = (PlanInterval.objects
+                      .filter(profile_id__in=profile_ids, state='pristine')
+                      .exclude(profile_id__in=in_use)
+                      .values('profile_id').annotate(next_id=Max('id')).order_by())
+    next_ids = [row['next_id'] for row in next_intervals]
+    if not next_ids:
+        return []
+    started = list(PlanInterval.objects.select_for_update()
+                   .filter(id__in=next_ids, state='pristine')
+                   .values_list('id', 'profile_id', 'plan_id'))
+    try:
+        with transaction.atomic():
+            PlanInterval.objects.filter(id__in=[interval_id for interval_id, _, _ in started]).update(state='in_use', started_at=now)
+    except IntegrityError:
+        # A request started an interval of one of the profiles in the meantime (see migration 0016),
+        # fall back to starting them one by one; PlanInterval.start writes the audit log itself.
+        logger.info('Raced starting intervals, starting %d intervals one by one', len(started))
+        for interval in PlanInterval.objects.filter(id__in=[interval_id for interval_id, _, _ in started], state='pristine'):
+            interval.start()
+        return []
+    return started
+
+
+def sweep_chunk(batch_size):
+    """
+    Expire up to *batch_size* overdue intervals and start the next pristine interval of their profiles.
+
+    Return the number of overdue intervals found, zero means there are none left.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        overdue_ids = list(overdue(now).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not overdue_ids:
+            return 0
+        # Requests expiring the same intervals concurrently are serialized by the row locks. They update conditionally,
+        # so each transition is logged exactly once.
+        expired = list(PlanInterval.objects.select_for_update()
+                       .filter(id__in=overdue_ids, state='in_use')
+                       .values_list('id', 'profile_id', 'plan_id'))
+        PlanInterval.objects.filter(id__in=[interval_id for interval_id, _, _ in expired]).update(state='expired')
+        profile_ids = {profile_id for _, profile_id, _ in expired}
+        started = start_next(profile_ids, now)
+
+        audit_log = [ProfilePlanLog(profile_id=profile_id, plan_id=plan_id, interval_id=interval_id,
+                                    action='expired-interval', origin=ORIGIN)
+                     for interval_id, profile_id, plan_id in expired]
+        audit_log += [ProfilePlanLog(profile_id=profile_id, plan_id=plan_id, interval_id=interval_id,
+                                     action='start-interval', origin=ORIGIN)
+                      for interval_id, profile_id, plan_id in started]
+        ProfilePlanLog.objects.bulk_create(audit_log, batch_size=batch_size)
+        # Neither the updates nor bulk_create send signals. The rows are rewritten set-wise, like the intervals.
+        entitlements.refresh_users(profile_ids)
+    logger.info('Expired %d intervals, started %d intervals', len(expired), len(started))
+    return len(overdue_ids)
+
+
+def sweep(batch_size=500):
+    """Expire all overdue intervals (see sweep_chunk). Return the number of overdue intervals found."""
+    swept = 0
+    while True:
+        found = sweep_chunk(batch_size)
+        if not found:
+            return swept
+        swept += found
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from qabel_provider import audit
+
+
+class Command(BaseCommand):
+    help = 'Move the audit log entries of closed months into the archive table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hot-months', type=int, default=audit.HOT_MONTHS,
+                            help='Number of months (including the current one) not archived.')
+        parser.add_argument('--batch-size', type=int, default=audit.ARCHIVE_BATCH_SIZE,
+                            help='Number of entries moved per transaction.')
+
+    def handle(self, *args, **options):
+        before = audit.archive_before(hot_months=options['hot_months'])
+        moved = audit.archive(before, options['batch_size'])
+        self.stdout.write('Archived %d entries before %s.' % (moved, before.date()))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from qabel_provider import entitlements
+
+
+class Command(BaseCommand):
+    help = 'Compare the materialized entitlements (Entitlement table) with the entitlements computed from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of users checked at once.')
+        parser.add_argument('--fix', action='store_true',
+                            help='Rewrite wrong or missing rows.')
+
+    def handle(self, *args, **options):
+        checked = wrong = 0
+        for users in entitlements.users_in_batches(options['batch_size']):
+            problems = entitlements.check(users)
+            checked += len(users)
+            wrong += len(problems)
+            for user_id, differences in sorted(problems.items()):
+                self.stdout.write('User %d: %s' % (user_id, ', '.join(
+                    '%s is %r, expected %r' % (field, stored, expected)
+                    for field, (stored, expected) in sorted(differences.items()))))
+            if options['fix'] and problems:
+                with transaction.atomic():
+                    for user in users:
+                        if user.id in problems:
+                            entitlements.refresh(user)
+        self.stdout.write('Checked %d users, %d wrong.' % (checked, wrong))
+        if wrong and not options['fix']:
+            raise CommandError('Entitlements of %d users are wrong, rerun with --fix to rewrite them.' % wrong)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from qabel_provider import usage
+
+
+class Command(BaseCommand):
+    help = 'Add usage reported by block servers to the usage rollups and update the over quota flags.'
+
+    def handle(self, *args, **options):
+        flushed = usage.flush()
+        self.stdout.write('Flushed usage of %d users.' % flushed)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from qabel_provider import entitlements
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the materialized entitlements of all users (Entitlement table).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of users rewritten per transaction.')
+
+    def handle(self, *args, **options):
+        rebuilt = 0
+        for users in entitlements.users_in_batches(options['batch_size']):
+            with transaction.atomic():
+                for user in users:
+                    entitlements.refresh(user)
+            rebuilt += len(users)
+            if options['verbosity'] > 1:
+                self.stdout.write('Rebuilt entitlements of %d users' % rebuilt)
+        self.stdout.write('Rebuilt entitlements of %d users.' % rebuilt)
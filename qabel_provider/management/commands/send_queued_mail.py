@@ -0,0 +1,30 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from qabel_provider import outbox
+
+
+class Command(BaseCommand):
+    help = 'Send the mails queued in the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of mails sent over one connection.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, instead of stopping when no mails are due anymore.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait for new mails in --loop mode.')
+
+    def handle(self, *args, **options):
+        connection = get_connection()
+        while True:
+            sent, failed = outbox.send_pending(options['batch_size'], connection)
+            if sent or failed:
+                self.stdout.write('Sent %d mails, %d failed.' % (sent, failed))
+            if sent + failed >= options['batch_size']:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from qabel_provider import monitoring
+
+
+class Command(BaseCommand):
+    help = 'Count profiles, plan intervals, subscriptions and entitlements for the prometheus metrics.'
+
+    def handle(self, *args, **options):
+        snapshot = monitoring.take_snapshot()
+        self.stdout.write('Counted %d profiles.' % snapshot['profiles'])
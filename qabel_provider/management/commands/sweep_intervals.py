@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from qabel_provider import entitlements, intervals
+
+
+class Command(BaseCommand):
+    help = ('Expire overdue plan intervals and start the next prepaid interval of their users, '
+            'then rewrite outdated entitlements.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of intervals expired (or entitlements rewritten) per transaction.')
+
+    def handle(self, *args, **options):
+        swept = intervals.sweep(options['batch_size'])
+        self.stdout.write('Expired %d intervals.' % swept)
+        refreshed = entitlements.refresh_outdated(options['batch_size'])
+        self.stdout.write('Rewrote %d outdated entitlements.' % refreshed)
@@ -0,0 +1,98 @@
+"""
+SQL query budgets of requests.
+
+QueryBudgetMiddleware counts the queries of every request and the time they took in the database, using the debug
+cursor Django uses for DEBUG, which it forces on for the request. Budgets are set by URL name (including the namespace,
+like 'admin:auth_user_changelist') in QUERY_BUDGETS, other views get QUERY_BUDGET; None disables the budget. Requests
+over budget are logged and counted in the query_budget_exceeded_total metric; for a sample of them
+(QUERY_BUDGET_EXPLAIN_RATE) the plan of their slowest statement is logged as well, on PostgreSQL.
+
+With QUERY_BUDGET_STRICT (which the tests set) requests running more queries than their budget fail with
+QueryBudgetExceeded instead, so that a view regressing into one query per object fails its tests. The time budget is
+never enforced that way, timing is too noisy for that.
+
+Queries run while streaming responses are not counted, they happen after the middleware is done.
+"""
+import logging
+import random
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+budget_exceeded = Counter('query_budget_exceeded_total', 'Requests exceeding their SQL query budget',
+                          ['view', 'budget'])
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised for requests running more queries than their budget, with QUERY_BUDGET_STRICT."""
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else None
+
+
+def explain(connection, sql):
+    """Return the plan of the statement *sql* (as run), or None if it can't be explained."""
+    if connection.vendor != 'postgresql' or not sql.lstrip().upper().startswith('SELECT'):
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+    except DatabaseError as exc:
+        logger.warning('Unable to explain query: %s', exc)
+
+
+class QueryBudgetMiddleware:
+    def process_request(self, request):
+        request.query_budget_start = {}
+        for connection in connections.all():
+            request.query_budget_start[connection.alias] = connection.force_debug_cursor, len(connection.queries_log)
+            connection.force_debug_cursor = True
+
+    def process_response(self, request, response):
+        start = getattr(request, 'query_budget_start', None)
+        if start is None:
+            return response
+        queries = []
+        for connection in connections.all():
+            if connection.alias not in start:
+                continue
+            forced, executed = start[connection.alias]
+            connection.force_debug_cursor = forced
+            queries += [(connection, query) for query in list(connection.queries_log)[executed:]]
+        self.check(request, queries)
+        return response
+
+    def check(self, request, queries):
+        """Log and count (or fail) the request if its *queries*, tuples (connection, query), exceed the budget."""
+        name = view_name(request)
+        budget = settings.QUERY_BUDGETS.get(name, settings.QUERY_BUDGET)
+        if budget is None:
+            return
+        max_queries, max_seconds = budget
+        seconds = sum(float(query['time']) for _, query in queries)
+        exceeded = []
+        if len(queries) > max_queries:
+            exceeded.append('queries')
+        if seconds > max_seconds:
+            exceeded.append('time')
+        if not exceeded:
+            return
+        message = '%s %s ran %d queries in %.3f seconds, over its budget of %d queries in %.3f seconds' % (
+            request.method, name or request.path, len(queries), seconds, max_queries, max_seconds)
+        if settings.QUERY_BUDGET_STRICT and 'queries' in exceeded:
+            raise QueryBudgetExceeded(message + ':\n' + '\n'.join(query['sql'] for _, query in queries))
+        for kind in exceeded:
+            budget_exceeded.labels(name or '', kind).inc()
+        logger.warning(message)
+        if queries and random.random() < settings.QUERY_BUDGET_EXPLAIN_RATE:
+            connection, slowest = max(queries, key=lambda item: float(item[1]['time']))
+            plan = explain(connection, slowest['sql'])
+            if plan:
+                logger.warning('Plan of the slowest query (%s seconds) of %s:\n%s\n%s',
+                               slowest['time'], name or request.path, slowest['sql'], plan)
@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+def expire_duplicate_intervals(apps, schema_editor):
+    """Keep only the most recently started interval in use per profile, so that the unique index can be created."""
+    PlanInterval = apps.get_model('qabel_provider', 'PlanInterval')
+    ProfilePlanLog = apps.get_model('qabel_provider', 'ProfilePlanLog')
+
+    profiles_seen = set()
+    for interval in PlanInterval.objects.filter(state='in_use').order_by('profile', '-started_at', '-id'):
+        if interval.profile_id not in profiles_seen:
+            profiles_seen.add(interval.profile_id)
+            continue
+        interval.state = 'expired'
+        interval.save()
+        ProfilePlanLog.objects.create(profile_id=interval.profile_id, action='expired-interval',
+                                      plan_id=interval.plan_id, interval=interval,
+                                      origin='migration 0016_planinterval_one_in_use')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0015_profile_created_on_behalf'),
+    ]
+
+    operations = [
+        migrations.RunPython(expire_duplicate_intervals, migrations.RunPython.noop),
+
+        # At most one interval per profile may be in use; PlanInterval.start relies on this.
+        # Partial indexes are supported by both PostgreSQL and SQLite.
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX qabel_provider_planinterval_one_in_use "
+            "ON qabel_provider_planinterval (profile_id) WHERE state = 'in_use'",
+            "DROP INDEX qabel_provider_planinterval_one_in_use",
+        ),
+    ]
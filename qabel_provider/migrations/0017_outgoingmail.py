@@ -0,0 +1,35 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0016_planinterval_one_in_use'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('subject', models.TextField()),
+                ('body', models.TextField()),
+                ('html_body', models.TextField(blank=True)),
+                ('from_email', models.CharField(max_length=254)),
+                ('to', models.TextField()),
+                ('cc', models.TextField(blank=True)),
+                ('state', models.CharField(choices=[('pending', 'waiting to be sent'), ('sent', 'sent'), ('failed', 'failed permanently')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='outgoingmail',
+            index_together={('state', 'next_attempt_at')},
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0017_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Entitlement',
+            fields=[
+                ('profile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='qabel_provider.Profile')),
+                ('block_quota', models.BigIntegerField()),
+                ('monthly_traffic_quota', models.BigIntegerField()),
+                ('active', models.BooleanField()),
+                ('confirmed', models.BooleanField()),
+                ('valid_until', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='qabel_provider.Plan', verbose_name='effective plan')),
+            ],
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0018_entitlement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EntitlementChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0019_entitlementchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entitlement',
+            name='over_quota',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='DailyUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('traffic', models.BigIntegerField(default=0)),
+                ('stored', models.BigIntegerField(default=0)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='qabel_provider.Profile')),
+            ],
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='MonthlyUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('traffic', models.BigIntegerField(default=0)),
+                ('stored', models.BigIntegerField(default=0)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='qabel_provider.Profile')),
+            ],
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='UsageFlush',
+            fields=[
+                ('bucket', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('flushed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyusage',
+            unique_together=set([('profile', 'day')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlyusage',
+            unique_together=set([('profile', 'month')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0007_alter_validators_add_error_messages'),
+        ('qabel_provider', '0020_usage'),
+    ]
+
+    operations = [
+        # Users are looked up by email ignoring case (email__iexact), which compares UPPER(email) on PostgreSQL.
+        # Expression indexes are supported by both PostgreSQL and SQLite.
+        migrations.RunSQL(
+            "CREATE INDEX qabel_provider_user_email_upper ON auth_user (UPPER(email))",
+            "DROP INDEX qabel_provider_user_email_upper",
+        ),
+    ]
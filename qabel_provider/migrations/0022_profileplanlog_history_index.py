@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-16 23:17
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0021_user_email_upper'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='profileplanlog',
+            index_together=set([('timestamp',), ('profile', 'timestamp', 'id')]),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-16 23:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0023_profileplanlog_export_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedProfilePlanLog',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField()),
+                ('action', models.CharField(max_length=100)),
+                ('origin', models.CharField(max_length=200, verbose_name='Request origin')),
+                ('interval', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='qabel_provider.PlanInterval')),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='qabel_provider.Plan')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='qabel_provider.Profile')),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedprofileplanlog',
+            index_together=set([('timestamp', 'id'), ('profile', 'timestamp', 'id')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-16 23:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def number_existing_changes(apps, schema_editor):
+    """Number the existing changes by ID, so that the cursors clients got so far stay valid."""
+    EntitlementChange = apps.get_model('qabel_provider', 'EntitlementChange')
+    EntitlementFeed = apps.get_model('qabel_provider', 'EntitlementFeed')
+    EntitlementChange.objects.update(sequence=F('id'))
+    last = EntitlementChange.objects.aggregate(Max('id'))['id__max'] or 0
+    EntitlementFeed.objects.create(pk=1, last_sequence=last)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0024_archivedprofileplanlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EntitlementFeed',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_sequence', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='entitlementchange',
+            name='sequence',
+            field=models.BigIntegerField(blank=True, null=True, unique=True),
+        ),
+        migrations.RunPython(number_existing_changes, migrations.RunPython.noop),
+    ]
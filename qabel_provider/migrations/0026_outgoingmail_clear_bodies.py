@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def clear_bodies(apps, schema_editor):
+    """Clear the bodies of mails which are done, they may contain live password reset tokens."""
+    OutgoingMail = apps.get_model('qabel_provider', 'OutgoingMail')
+    OutgoingMail.objects.exclude(state='pending').update(body='', html_body='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0025_entitlement_feed_sequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_bodies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-17 00:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qabel_provider', '0026_outgoingmail_clear_bodies'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entitlementchange',
+            name='plan_id',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AlterField(
+            model_name='entitlementchange',
+            name='user_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -4,7 +4,8 @@ import logging
 from allauth.account.models import EmailAddress
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, transaction, DatabaseError
+from django.db import models, transaction, DatabaseError, IntegrityError
+from django.db.models import Prefetch
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
@@ -59,11 +60,18 @@ class Profile(models.Model, ExportModelOperationsMixin('profile')):
 
     @property
     def primary_email(self):
-        return EmailAddress.objects.get_primary(self.user)
+        try:
+            # Loaded along by select_entitlement_data
+            addresses = self.user.primary_email_addresses
+        except AttributeError:
+            return EmailAddress.objects.get_primary(self.user)
+        if addresses:
+            return addresses[0]
 
     @property
     def is_confirmed(self):
-        return self.primary_email.verified
+        email = self.primary_email
+        return email is not None and email.verified
 
     def confirm_email(self):
         email = self.primary_email
@@ -89,39 +97,34 @@ class Profile(models.Model, ExportModelOperationsMixin('profile')):
 
     def check_confirmation_and_send_mail(self) -> bool:
         if not self.is_allowed():
-            # First we commit to the DB as-if we already sent the mail. If that fails, then another concurrent txn
-            # already did this. Then we actually send the mail, if that fails, we rollback the DB manually.
-            # In other words, 2PC between the DB and the mail server.
+            if self.primary_email is None:
+                # Nothing to confirm, e.g. the address was deleted in the admin. Keep the date of the next mail.
+                logger.warning('check_confirmation_and_send_mail: user %r has no primary email address', self.user_id)
+                return True
+            # The mail is queued in the outbox (qabel_provider.outbox) in the same transaction that moves the date of
+            # the next mail, conditional on that date not having been moved by a concurrent transaction already.
             try:
-                with transaction.atomic():
-                    self.refresh_from_db()
-                    send_mail = not self.was_email_sent_last_24_hours()
-                    if send_mail:
-                        # Store original timestamp, so we can rollback manually
-                        original_next_confirmation_mail = self.next_confirmation_mail
+                if not self.was_email_sent_last_24_hours():
+                    now = timezone.now()
+                    with transaction.atomic():
                         self.set_next_mail_date()
-                        self.save()
+                        due = (models.Q(next_confirmation_mail__isnull=True) |
+                               models.Q(next_confirmation_mail__lt=now))
+                        if Profile.objects.filter(due, pk=self.pk).update(next_confirmation_mail=self.next_confirmation_mail):
+                            self.send_confirmation_mail()
             except DatabaseError as exc:
                 logger.warning('check_confirmation_and_send_mail: raced transaction, assuming it worked for the other end: %s', str(exc))
-                # Raced commit, someone else send it already.
-                return True
-            if send_mail:
-                try:
-                    self.send_confirmation_mail()
-                except Exception:
-                    logger.exception('Failed to send confirmation mail to user %d, email %r', self.user.pk, self.primary_email)
-                    # Rollback!
-                    with transaction.atomic():
-                        self.next_confirmation_mail = original_next_confirmation_mail
-                        self.save()
             return True
         return False
 
     def send_confirmation_mail(self):
+        """Queue a confirmation mail to the primary email address, see IgnoreInvalidMailsAdapter."""
         mail = self.primary_email
-        logger.info('Sending confirmation mail to %r', mail.email)
+        if mail is None:
+            logger.warning('Not queueing confirmation mail, user %r has no primary email address', self.user_id)
+            return
+        logger.info('Queueing confirmation mail to %r', mail.email)
         mail.send_confirmation(signup=False)
-        logger.info('Sent confirmation mail to %r', mail.email)
 
 
 class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
@@ -147,7 +150,8 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
         """
         Return false-ish if plan is expired, self otherwise.
 
-        Update state if expired.
+        Update state if expired. The update is conditional on the interval still being in use, so that only one
+        of several concurrent callers writes the audit log entry.
         """
         if self.state == 'pristine':
             raise ValueError('Cannot check expiry on pristine interval.')
@@ -155,48 +159,77 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
             logger.warning('PlanInterval.check_expiry on expired interval.')
             return
         if timezone.now() > (self.started_at + self.duration):
-            self.state = 'expired'
-            audit_log = ProfilePlanLog(profile=self.profile,
-                                       action='expired-interval', plan=self.plan, interval=self)
             with transaction.atomic():
-                self.save()
-                audit_log.save()
+                expired = PlanInterval.objects.filter(pk=self.pk, state='in_use').update(state='expired')
+                if expired:
+                    audit_log = ProfilePlanLog(profile=self.profile,
+                                               action='expired-interval', plan=self.plan, interval=self)
+                    audit_log.save()
+            self.state = 'expired'
             return
         return self
 
     def start(self):
-        """Start using this (pristine) interval."""
+        """
+        Start using this (pristine) interval.
+
+        Return whether this call started the interval. This is false if a concurrent caller started this interval
+        or another interval of the profile first (at most one interval per profile can be in use, see migration
+        0016); the state of this interval is reloaded in that case.
+        """
         if self.state != 'pristine':
             raise ValueError('Cannot start using a %s interval' % self.state)
-        self.state = 'in_use'
-        self.started_at = timezone.now()
-        audit_log = ProfilePlanLog(profile=self.profile,
-                                   action='start-interval', plan=self.plan, interval=self)
-        with transaction.atomic():
-            self.save()
-            audit_log.save()
+        started_at = timezone.now()
+        try:
+            with transaction.atomic():
+                started = PlanInterval.objects.filter(pk=self.pk, state='pristine').update(state='in_use', started_at=started_at)
+                if started:
+                    audit_log = ProfilePlanLog(profile=self.profile,
+                                               action='start-interval', plan=self.plan, interval=self)
+                    audit_log.save()
+        except IntegrityError:
+            started = False
+        if started:
+            self.state = 'in_use'
+            self.started_at = started_at
+        else:
+            self.refresh_from_db(fields=('state', 'started_at'))
+        return bool(started)
 
     @classmethod
     def peek_interval(model, profile):
-        """Return a plan interval for *profile* that is in use or would be used next."""
-        with transaction.atomic():
-            interval = model._get_interval(profile)  # The state update via check_expiry is ok
-            if not interval:
-                interval = model._get_pristine_interval(profile)
-            return interval
+        """
+        Return a plan interval for *profile* that is in use or would be used next.
+
+        This is a pure read, unless the interval in use just expired.
+        """
+        interval = model._get_interval(profile)  # The state update via check_expiry is ok
+        if not interval:
+            interval = model._get_pristine_interval(profile)
+        return interval
 
     @classmethod
     def get_or_start_interval(model, profile):
-        """Return/activate a plan interval for *profile*, or None."""
-        with transaction.atomic():
-            interval = model._get_interval(profile)
-            if not interval:
-                interval = model._start_interval(profile)
-            return interval
+        """
+        Return/activate a plan interval for *profile*, or None.
+
+        Only state transitions (starting or expiring an interval) write, in their own transactions;
+        looking at an interval that is in use or finding no interval at all is a pure read.
+        """
+        interval = model._get_interval(profile)
+        if not interval:
+            interval = model._start_interval(profile)
+        return interval
 
     @classmethod
     def _get_interval(model, profile):
         """Return plan interval used by *profile*, or None."""
+        usable_intervals = getattr(profile, 'usable_intervals', None)
+        if usable_intervals is not None:
+            interval = next((interval for interval in usable_intervals if interval.state == 'in_use'), None)
+            if not interval:
+                return
+            return interval.check_expiry()
         try:
             interval = model.objects.get(profile=profile, state='in_use')
         except ObjectDoesNotExist:
@@ -206,6 +239,10 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
 
     @classmethod
     def _get_pristine_interval(model, profile):
+        usable_intervals = getattr(profile, 'usable_intervals', None)
+        if usable_intervals is not None:
+            # Loaded along by select_entitlement_data, in the model ordering
+            return next((interval for interval in usable_intervals if interval.state == 'pristine'), None)
         return model.objects.filter(profile=profile, state='pristine').first()
 
     @classmethod
@@ -214,7 +251,10 @@ class PlanInterval(models.Model, ExportModelOperationsMixin('planinterval')):
         usable_interval = model._get_pristine_interval(profile)
         if not usable_interval:
             return
-        usable_interval.start()
+        if not usable_interval.start():
+            # A concurrent caller started an interval first, so the loaded intervals are outdated.
+            profile.__dict__.pop('usable_intervals', None)
+            return model._get_interval(profile)
         return usable_interval
 
     def __str__(self):
@@ -250,14 +290,202 @@ class ProfilePlanLog(models.Model, ExportModelOperationsMixin('profileplanlog'))
 
     class Meta:
         index_together = [
-            ['timestamp'],
-            ['profile']
+            # Audit log exports, see qabel_provider.audit
+            ['timestamp', 'id'],
+            # Account history pages, see views.history_page
+            ['profile', 'timestamp', 'id'],
         ]
         ordering = ['-timestamp']
 
 
+class ArchivedProfilePlanLog(models.Model, ExportModelOperationsMixin('archivedprofileplanlog')):
+    """
+    ProfilePlanLog entries of closed months, moved here with their IDs by the archive_audit_log command.
+
+    This keeps the ProfilePlanLog table (and its indexes) small for inserts. Readers of the whole audit log, like the
+    account history and the audit log export, read both tables; archived entries are older than all others.
+    """
+    id = models.IntegerField(primary_key=True)
+    profile = models.ForeignKey(Profile)
+    timestamp = models.DateTimeField()
+    action = models.CharField(max_length=100)
+    plan = models.ForeignKey(Plan)
+    interval = models.ForeignKey(PlanInterval, blank=True, null=True)
+    origin = models.CharField(max_length=200, verbose_name='Request origin')
+
+    def save(self, *args, **kwargs):
+        raise ValueError('Archived ProfilePlanLog entries are only written by archive_audit_log.')
+
+    def delete(self, *args, **kwargs):
+        raise ValueError('Cannot delete ProfilePlanLog entry.')
+
+    def __str__(self):
+        return ''
+
+    class Meta:
+        index_together = [
+            ['timestamp', 'id'],
+            ['profile', 'timestamp', 'id'],
+        ]
+        ordering = ['-timestamp']
+
+
+class Entitlement(models.Model, ExportModelOperationsMixin('entitlement')):
+    """
+    Effective entitlements of a profile, materialized from its subscribed plan, plan intervals and email
+    confirmation state.
+
+    Rows are rewritten by qabel_provider.entitlements whenever one of these changes. A row may become outdated
+    without any write after *valid_until* (e.g. when the interval in use ends), readers must not use it then.
+    """
+    profile = models.OneToOneField(Profile, primary_key=True, on_delete=models.CASCADE)
+    plan = models.ForeignKey(Plan, verbose_name='effective plan')
+    block_quota = models.BigIntegerField()
+    monthly_traffic_quota = models.BigIntegerField()
+    active = models.BooleanField()
+    confirmed = models.BooleanField()
+    valid_until = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+    # Maintained from the usage rollups by qabel_provider.usage, not by refresh
+    over_quota = models.BooleanField(default=False)
+
+    def is_valid(self):
+        return self.valid_until is None or self.valid_until > timezone.now()
+
+    def __str__(self):
+        return ''
+
+
+class EntitlementChange(models.Model):
+    """
+    Entry of the entitlement change feed: the answer of auth_resource for the user may have changed.
+
+    The sequence numbers form the cursor of the feed, they are assigned after the change was committed, see
+    qabel_provider.entitlements.sequence_changes. *user_id* is no foreign key, so that changes of deleted users are kept.
+    Changes of a plan are recorded once, with *plan_id* instead of *user_id*: the answers of all its users may have
+    changed.
+    """
+    user_id = models.IntegerField(null=True, blank=True)
+    plan_id = models.CharField(max_length=50, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sequence = models.BigIntegerField(null=True, blank=True, unique=True)
+
+    def __str__(self):
+        return ''
+
+
+class EntitlementFeed(models.Model):
+    """Single row holding the last sequence number of the entitlement change feed, locked while assigning more."""
+    last_sequence = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return ''
+
+
+class DailyUsage(models.Model, ExportModelOperationsMixin('dailyusage')):
+    """
+    Usage of a profile on the block servers during one day (UTC), rolled up by qabel_provider.usage.
+
+    *traffic* is the number of bytes transferred, *stored* the change of the number of bytes stored.
+    """
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    day = models.DateField()
+    traffic = models.BigIntegerField(default=0)
+    stored = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return ''
+
+    class Meta:
+        unique_together = [
+            ['profile', 'day'],
+        ]
+
+
+class MonthlyUsage(models.Model, ExportModelOperationsMixin('monthlyusage')):
+    """Like DailyUsage, for one month (*month* is its first day)."""
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    month = models.DateField()
+    traffic = models.BigIntegerField(default=0)
+    stored = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return ''
+
+    class Meta:
+        unique_together = [
+            ['profile', 'month'],
+        ]
+
+
+class UsageFlush(models.Model):
+    """Bucket of usage deltas which was added to the rollups, so that it isn't added twice."""
+    bucket = models.BigIntegerField(primary_key=True)
+    flushed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return ''
+
+
+def select_entitlement_data(queryset, user_lookup=None):
+    """
+    Return *queryset* loading everything along that is needed to determine the entitlements of users.
+
+    *queryset* either yields users, or objects referring to users via *user_lookup* (e.g. 'user' for tokens).
+    The profile, subscribed plan, Entitlement row, primary email address and the usable (in use or pristine) plan
+    intervals are fetched with three queries in total, regardless of the number of users. Profile.primary_email,
+    Profile.plan and Profile.use_plan use the loaded objects instead of querying them again.
+    """
+    prefix = user_lookup + '__' if user_lookup else ''
+    return queryset.select_related(prefix + 'profile__subscribed_plan', prefix + 'profile__entitlement').prefetch_related(
+        Prefetch(prefix + 'emailaddress_set',
+                 queryset=EmailAddress.objects.filter(primary=True),
+                 to_attr='primary_email_addresses'),
+        Prefetch(prefix + 'profile__planinterval_set',
+                 queryset=PlanInterval.objects.filter(state__in=('in_use', 'pristine')).select_related('plan'),
+                 to_attr='usable_intervals'),
+    )
+
+
 @receiver(post_save, sender=User)
 def create_profile_for_new_user(sender, created, instance, **kwargs):
     if created:
         profile = Profile(user=instance)
         profile.save()
+
+
+class OutgoingMail(models.Model, ExportModelOperationsMixin('outgoingmail')):
+    """
+    Mail waiting in the outbox.
+
+    Mails are stored in the transaction causing them and sent later by the send_queued_mail command,
+    see qabel_provider.outbox.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    subject = models.TextField()
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254)
+    # Addresses, one per line
+    to = models.TextField()
+    cc = models.TextField(blank=True)
+
+    STATES = (
+        ('pending', 'waiting to be sent'),
+        ('sent', 'sent'),
+        ('failed', 'failed permanently'),
+    )
+    state = models.CharField(choices=STATES, default='pending', max_length=10)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        index_together = [
+            ['state', 'next_attempt_at'],
+        ]
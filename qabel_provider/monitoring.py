@@ -1,31 +1,170 @@
+"""
+Prometheus metrics of profiles, plan intervals, subscriptions and entitlements.
+
+Counting these takes queries over the large tables, so scrapes don't count: ProfileStatsCollector exports a snapshot
+of the counts kept in the MONITORING_CACHE (shared by all processes). Only the snapshot_stats management command takes
+new snapshots, run it every few minutes (the deployment does, see tasks_django.UwsgiConfiguration). Scrapes only read
+the cache. Snapshots older than MONITORING_STATS_MAX_AGE are not exported, but their age is, as
+stats_snapshot_age_seconds: alert on that to notice the job stopped.
+
+Under uWSGI every worker has its own metrics. If the prometheus_multiproc_dir environment variable names a directory
+(the deployment sets it up, see tasks_django.UwsgiConfiguration), prometheus_client keeps the metrics of all workers
+in files there, and the metrics view exports their aggregate, plus the ProfileStatsCollector once. Workers clean up
+their files when exiting (see mark_worker_dead, called from qabel_id.wsgi): the files of live gauges are removed, and
+counters, histograms and summaries are added to one archive file per type, so that the directory doesn't grow with
+every worker uWSGI starts. Gauges therefore need one of the live multiprocess modes (e.g. liveall), the files of other
+gauges stay. Workers killed without running atexit handlers (e.g. by harakiri) leave their files behind until the next
+restart, which removes all of them.
+"""
+import datetime
+import fcntl
+import os
+
+from django.conf import settings
+from django.core.cache import caches
 from django.db.models import Count
-from prometheus_client.core import CounterMetricFamily, REGISTRY
+from django.http import HttpResponse
+from django.utils import timezone
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+from prometheus_client.mmap_dict import MmapedDict
+
+from .models import Entitlement, Profile, PlanInterval, Plan
+
+SNAPSHOT_KEY = 'monitoring-stats'
+# How long snapshots are kept for exporting them stale
+KEEP = datetime.timedelta(days=1)
+# Metric types whose values of exited workers are added up in archive files, see compact_worker_files
+ARCHIVED_TYPES = ('counter', 'histogram', 'summary')
+
+# Newer prometheus_client versions prefer the upper case variable
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
 
-from .models import Profile, PlanInterval, Plan
+
+def get_cache():
+    return caches[settings.MONITORING_CACHE]
+
+
+def take_snapshot():
+    """Count profiles, plan intervals, subscriptions and entitlements, store and return the snapshot."""
+    snapshot = {
+        'taken_at': timezone.now(),
+        'profiles': Profile.objects.count(),
+        'plan_intervals': PlanInterval.objects.count(),
+        'subscriptions': list(Plan.objects.annotate(Count('profile')).values_list('id', 'profile__count')),
+        'entitlements': list(Entitlement.objects.values_list('plan', 'active').annotate(Count('pk')).order_by()),
+    }
+    get_cache().set(SNAPSHOT_KEY, snapshot, int(KEEP.total_seconds()))
+    return snapshot
+
+
+def get_snapshot():
+    """Return the latest snapshot, however old, or None if there is none."""
+    return get_cache().get(SNAPSHOT_KEY)
 
 
 class ProfileStatsCollector:
-    def profile(self):
+    def profile(self, snapshot):
         c = CounterMetricFamily('profile_count', 'Number of profiles')
-        c.add_metric([], Profile.objects.count())
+        c.add_metric([], snapshot['profiles'])
         yield c
 
-    def plan_interval(self):
+    def plan_interval(self, snapshot):
         c = CounterMetricFamily('plan_intervals_count', 'Number of plan intervals')
-        c.add_metric([], PlanInterval.objects.count())
+        c.add_metric([], snapshot['plan_intervals'])
         yield c
 
-    def subscriptions(self):
+    def subscriptions(self, snapshot):
         c = CounterMetricFamily('subscriptions_count', 'Subscriptions by plan', labels=['plan'])
-        plans = Plan.objects.annotate(Count('profile'))
-        for plan in plans:
-            c.add_metric([plan.id], plan.profile__count)
+        for plan, count in snapshot['subscriptions']:
+            c.add_metric([plan], count)
         yield c
 
+    def entitlements(self, snapshot):
+        c = CounterMetricFamily('entitlements_count', 'Users by effective plan', labels=['plan', 'active'])
+        for plan, active, count in snapshot['entitlements']:
+            c.add_metric([plan, str(active).lower()], count)
+        yield c
+
+    def snapshot_age(self, snapshot):
+        g = GaugeMetricFamily('stats_snapshot_age_seconds', 'Age of the exported profile stats')
+        g.add_metric([], (timezone.now() - snapshot['taken_at']).total_seconds())
+        yield g
+
     def collect(self):
-        yield from self.profile()
-        yield from self.plan_interval()
-        yield from self.subscriptions()
+        snapshot = get_snapshot()
+        if not snapshot:
+            return
+        yield from self.snapshot_age(snapshot)
+        if timezone.now() - snapshot['taken_at'] > datetime.timedelta(seconds=settings.MONITORING_STATS_MAX_AGE):
+            # Outdated counts would hide that the job stopped
+            return
+        yield from self.profile(snapshot)
+        yield from self.plan_interval(snapshot)
+        yield from self.subscriptions(snapshot)
+        yield from self.entitlements(snapshot)
+
+
+collector = ProfileStatsCollector()
+if not MULTIPROC_DIR:
+    REGISTRY.register(collector)
+
+
+def get_registry():
+    """Return the registry to export: the one of this process, or the aggregate of all workers in multiprocess mode."""
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=MULTIPROC_DIR)
+    registry.register(collector)
+    return registry
+
+
+def metrics(request):
+    try:
+        output = generate_latest(get_registry())
+    except FileNotFoundError:
+        # A worker compacted its files while they were read
+        output = generate_latest(get_registry())
+    return HttpResponse(output, content_type=CONTENT_TYPE_LATEST)
+
+
+def compact_worker_files(pid, path):
+    """
+    Add the counters, histograms and summaries of the exited process *pid* to the archive files in *path*, and remove
+    its files.
+
+    Archives are replaced atomically, under a lock shared by all workers. Scrapes reading between replacing an archive
+    and removing the file of the worker count its values twice, once.
+    """
+    with open(os.path.join(path, 'archive.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for kind in ARCHIVED_TYPES:
+            worker_file = os.path.join(path, '%s_%d.db' % (kind, pid))
+            if not os.path.exists(worker_file):
+                continue
+            archive_file = os.path.join(path, '%s_archive.db' % kind)
+            values = {}
+            for source in (archive_file, worker_file):
+                if os.path.exists(source):
+                    for key, value, _, _ in MmapedDict.read_all_values_from_file(source):
+                        values[key] = values.get(key, 0) + value
+            # Not named *.db, so that scrapes don't read it before it's complete
+            new_file = archive_file + '.new'
+            if os.path.exists(new_file):
+                os.remove(new_file)
+            archive = MmapedDict(new_file)
+            try:
+                for key, value in values.items():
+                    archive.write_value(key, value, 0)
+            finally:
+                archive.close()
+            os.replace(new_file, archive_file)
+            os.remove(worker_file)
 
 
-REGISTRY.register(ProfileStatsCollector())
+def mark_worker_dead():
+    """Clean up the metric files of this process, which is exiting, in multiprocess mode."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid(), path=MULTIPROC_DIR)
+        compact_worker_files(os.getpid(), MULTIPROC_DIR)
@@ -0,0 +1,144 @@
+"""
+Transactional outbox for mails.
+
+Request handlers queue mails with enqueue(), inside the transaction which causes the mail. This keeps slow or
+unavailable mail servers off the request path and ties the mail to the commit of the transaction. The queued mails
+are sent by the send_queued_mail management command, in batches over one connection, with retries and exponential
+backoff. The deployment runs it as a uWSGI daemon (see tasks_django.UwsgiConfiguration).
+
+Once a mail is sent or given up on, its bodies are cleared: they may contain links with live tokens (like password
+resets), which shouldn't linger in the database.
+"""
+import datetime
+import logging
+import smtplib
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutgoingMail
+
+logger = logging.getLogger(__name__)
+
+# Attempts after which a mail is given up
+MAX_ATTEMPTS = 10
+# Delay before the second attempt; doubled for every further attempt, up to MAX_RETRY_DELAY.
+RETRY_DELAY = datetime.timedelta(minutes=1)
+MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+# Claimed mails are not picked up by other workers for this long.
+CLAIM_DURATION = datetime.timedelta(minutes=10)
+
+
+def to_outgoing_mail(message):
+    """Return an (unsaved) OutgoingMail for *message* (an EmailMessage)."""
+    html_body = ''
+    for content, mimetype in getattr(message, 'alternatives', ()):
+        if mimetype == 'text/html':
+            html_body = content
+    return OutgoingMail(
+        subject=message.subject,
+        body=message.body,
+        html_body=html_body,
+        from_email=message.from_email,
+        to='\n'.join(message.to),
+        cc='\n'.join(message.cc),
+    )
+
+
+def enqueue(message):
+    """Queue *message* (an EmailMessage) for sending. Return the OutgoingMail."""
+    mail = to_outgoing_mail(message)
+    mail.save()
+    return mail
+
+
+def enqueue_many(messages):
+    """Queue *messages* for sending, with one insert."""
+    OutgoingMail.objects.bulk_create([to_outgoing_mail(message) for message in messages], batch_size=500)
+
+
+def to_message(mail, connection=None):
+    """Return EmailMultiAlternatives for the OutgoingMail *mail*."""
+    message = EmailMultiAlternatives(mail.subject, mail.body, mail.from_email,
+                                     mail.to.splitlines(), cc=mail.cc.splitlines(), connection=connection)
+    if mail.html_body:
+        message.attach_alternative(mail.html_body, 'text/html')
+    return message
+
+
+def retry_delay(attempts):
+    """Return the delay before the next attempt after *attempts* failed attempts."""
+    # Bound the exponent, timedelta overflows quickly.
+    return min(RETRY_DELAY * 2 ** min(attempts - 1, 20), MAX_RETRY_DELAY)
+
+
+def claim(batch_size):
+    """Return up to *batch_size* mails due for sending, which are hidden from other workers for CLAIM_DURATION."""
+    now = timezone.now()
+    with transaction.atomic():
+        mails = list(OutgoingMail.objects
+                     .select_for_update()
+                     .filter(state='pending', next_attempt_at__lte=now)
+                     .order_by('next_attempt_at')[:batch_size])
+        OutgoingMail.objects.filter(pk__in=[mail.pk for mail in mails]).update(next_attempt_at=now + CLAIM_DURATION)
+    return mails
+
+
+def send_mail(mail, connection):
+    """Send OutgoingMail *mail* over *connection* and record the outcome. Return whether the mail was sent."""
+    mail.attempts += 1
+    try:
+        connection.send_messages([to_message(mail, connection)])
+    except Exception as exc:
+        mail.last_error = repr(exc)
+        if isinstance(exc, smtplib.SMTPRecipientsRefused) or mail.attempts >= MAX_ATTEMPTS:
+            logger.error('Giving up on mail %d to %r after %d attempts: %r', mail.pk, mail.to, mail.attempts, exc)
+            mail.state = 'failed'
+            mail.body = mail.html_body = ''
+        else:
+            logger.warning('Failed to send mail %d to %r (attempt %d): %r', mail.pk, mail.to, mail.attempts, exc)
+            mail.next_attempt_at = timezone.now() + retry_delay(mail.attempts)
+        mail.save(update_fields=('state', 'attempts', 'next_attempt_at', 'last_error', 'body', 'html_body'))
+        return False
+    mail.state = 'sent'
+    mail.sent_at = timezone.now()
+    mail.body = mail.html_body = ''
+    mail.save(update_fields=('state', 'attempts', 'sent_at', 'body', 'html_body'))
+    logger.info('Sent mail %d to %r', mail.pk, mail.to)
+    return True
+
+
+def send_pending(batch_size=100, connection=None):
+    """
+    Send up to *batch_size* due mails over one connection (the default mail backend, if *connection* is None).
+
+    Return a tuple (sent, failed) of the numbers of mails.
+    """
+    mails = claim(batch_size)
+    if not mails:
+        return 0, 0
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except Exception:
+        logger.exception('Failed to connect to the mail server, claimed mails are retried in %s', CLAIM_DURATION)
+        return 0, len(mails)
+    sent = 0
+    try:
+        for index, mail in enumerate(mails):
+            if send_mail(mail, connection):
+                sent += 1
+                continue
+            # The connection might be broken, replace it for the remaining mails. Without reopening it explicitly
+            # the backend would open (and close) a connection per mail.
+            connection.close()
+            try:
+                connection.open()
+            except Exception:
+                logger.exception('Failed to reconnect to the mail server, %d claimed mails are retried in %s',
+                                 len(mails) - index - 1, CLAIM_DURATION)
+                break
+    finally:
+        connection.close()
+    return sent, len(mails) - sent
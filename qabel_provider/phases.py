@@ -0,0 +1,68 @@
+"""
+Duration and number of SQL queries of the phases of auth_resource calls, exported as prometheus metrics.
+
+instrument() wraps the view. Code run by it records its phases with the phase() context manager, which does nothing
+outside of instrumented views, so helpers shared with other views (like require_api_key) can use it as well. Time
+and queries of a phase entered several times per call are added up. When the view returns, every recorded phase is
+observed once, labelled with the status of the response.
+
+Queries are counted with the debug cursor Django uses for DEBUG, which is forced on during instrumented calls.
+"""
+import contextlib
+import functools
+import threading
+import time
+
+from django.db import connection
+from prometheus_client import Histogram
+
+PHASES = (
+    'api_key',        # check of the API key of the block server
+    'lookup',         # parsing the user identification, cached answers and the token or user lookup
+    'confirmation',   # checking the email confirmation, including queueing confirmation mails
+    'intervals',      # resolving the plan interval in use
+    'entitlement',    # rewriting the Entitlement row and caching the answer
+    'serialization',  # building the answer and the ticket
+)
+
+phase_duration = Histogram('auth_resource_phase_duration_seconds', 'Duration of the phases of auth_resource calls',
+                           ['phase', 'status'])
+phase_queries = Histogram('auth_resource_phase_queries', 'SQL queries run by the phases of auth_resource calls',
+                          ['phase', 'status'], buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, float('inf')))
+
+_local = threading.local()
+
+
+def instrument(view):
+    @functools.wraps(view)
+    def view_wrapper(request, *args, **kwargs):
+        _local.phases = phases = {}
+        forced = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            connection.force_debug_cursor = forced
+            _local.phases = None
+        status = str(response.status_code)
+        for name, (seconds, queries) in phases.items():
+            phase_duration.labels(name, status).observe(seconds)
+            phase_queries.labels(name, status).observe(queries)
+        return response
+    return view_wrapper
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Record the time and queries spent in the block as phase *name* of the current instrumented call, if any."""
+    phases = getattr(_local, 'phases', None)
+    if phases is None:
+        yield
+        return
+    started = time.monotonic()
+    executed = len(connection.queries_log)
+    try:
+        yield
+    finally:
+        seconds, queries = phases.get(name, (0, 0))
+        phases[name] = (seconds + time.monotonic() - started, queries + len(connection.queries_log) - executed)
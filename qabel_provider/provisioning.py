@@ -0,0 +1,182 @@
+"""
+Bulk variant of register_on_behalf, for onboarding many users of a partner at once.
+
+Records are read as NDJSON, at most LIMIT per request, and processed in chunks of BATCH_SIZE, one transaction each,
+with a fixed number of statements per chunk:
+addresses in use (by users or as allauth email addresses, primary or not) are looked up with two queries, usernames
+are allocated set-wise (see utils.allocate_usernames), users, profiles and email addresses are inserted with bulk
+inserts, and the password-set mails are queued in the outbox (see qabel_provider.outbox) with one insert.
+"""
+import json
+import logging
+import os
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.contrib.sites.shortcuts import get_current_site
+from django.db import transaction, IntegrityError
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from . import outbox
+from .forms import QueuedPasswordResetForm
+from .models import Profile
+from .serializers import RegisterOnBehalfSerializer
+from .utils import allocate_usernames, filter_by_emails
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+LIMIT = 10000
+# Attempts to insert a chunk, usernames may be taken concurrently between allocating and inserting them
+ATTEMPTS = 3
+
+ACCOUNT_CREATED_MAIL = {
+    'subject_template_name': 'registration/account_created_subject.txt',
+    'email_template_name': 'registration/account_created_email.txt',
+    'html_email_template_name': 'registration/account_created_email.html',
+}
+
+
+def parse(lines):
+    """Yield (line number, record) tuples for the NDJSON *lines*, *record* is a ValueError for malformed lines."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line.decode() if isinstance(line, bytes) else line)
+            if not isinstance(record, dict):
+                raise ValueError('Expected an object')
+        except ValueError as exc:
+            record = ValueError(str(exc))
+        yield number, record
+
+
+def taken_emails(emails):
+    """Return the set of *emails* (lower-cased) used by users or allauth email addresses, ignoring case."""
+    taken = set(filter_by_emails(User.objects, emails).values_list('email', flat=True))
+    taken.update(filter_by_emails(EmailAddress.objects, emails).values_list('email', flat=True))
+    return {email.lower() for email in taken}
+
+
+def emails_of(record):
+    """Return the set of addresses (lower-cased) of *record*, primary and secondary."""
+    return {email.lower() for email in [record.email] + list(record.secondary_emails)}
+
+
+def email_addresses(user, record):
+    """Return the (unsaved) verified allauth email addresses of *user* for *record*, the primary one first."""
+    addresses = [EmailAddress(user=user, email=record.email, primary=True, verified=True)]
+    seen = {record.email.lower()}
+    for email in record.secondary_emails:
+        # Repeated addresses would violate the unique constraint of allauth
+        if email.lower() not in seen:
+            seen.add(email.lower())
+            addresses.append(EmailAddress(user=user, email=email, primary=False, verified=True))
+    return addresses
+
+
+def create_users(records):
+    """
+    Create the accounts of *records* (RegisterOnBehalf tuples) with bulk inserts. Return the users, in order.
+
+    Raise IntegrityError if a username was taken concurrently.
+    """
+    usernames = allocate_usernames([record.email for record in records])
+    # PasswordResetForm requires a usable password, see register_on_behalf. Nobody knows it, so one hash per chunk
+    # does as well as one per user, and hashing is slow on purpose.
+    password = make_password(os.urandom(64).hex())
+    User.objects.bulk_create([
+        User(username=username, email=User.objects.normalize_email(record.email), password=password,
+             first_name=record.first_name, last_name=record.last_name)
+        for username, record in zip(usernames, records)
+    ])
+    # bulk_create doesn't set primary keys on every backend
+    by_username = {user.username: user for user in User.objects.filter(username__in=usernames)}
+    users = [by_username[username] for username in usernames]
+    # bulk_create sends no signals, so the profiles are not created by create_profile_for_new_user
+    Profile.objects.bulk_create([Profile(user=user, created_on_behalf=True) for user in users])
+    EmailAddress.objects.bulk_create([address for user, record in zip(users, records)
+                                      for address in email_addresses(user, record)])
+    return users
+
+
+def account_created_mails(users, records, request):
+    """Return the password-set mails for *users* and their *records*, like PasswordSetForm renders them."""
+    form = QueuedPasswordResetForm()
+    site = get_current_site(request)
+    mails = []
+    for user, record in zip(users, records):
+        context = {
+            'email': user.email,
+            'domain': site.domain,
+            'site_name': site.name,
+            'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+            'user': user,
+            'token': default_token_generator.make_token(user),
+            'protocol': 'https' if request.is_secure() else 'http',
+        }
+        mails.append(form.render_mail(context=context, from_email=settings.DEFAULT_FROM_EMAIL, to_email=user.email,
+                                      cc_emails=record.secondary_emails, **ACCOUNT_CREATED_MAIL))
+    return mails
+
+
+def register_chunk(entries, request):
+    """Register the accounts of *entries* (from parse). Return one result per entry, in order."""
+    results = {}
+    valid = []
+    for number, record in entries:
+        if isinstance(record, ValueError):
+            results[number] = {'line': number, 'status': 'Malformed record', 'error': str(record)}
+            continue
+        serializer = RegisterOnBehalfSerializer(data=record)
+        if not serializer.is_valid():
+            results[number] = {'line': number, 'status': 'Invalid record', 'errors': serializer.errors}
+            continue
+        valid.append((number, serializer.save()))
+
+    # Only usernames can collide when inserting the chunk, addresses in use are sorted out before. Addresses taken
+    # concurrently make the next attempt sort them out as well.
+    for attempt in range(1, ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                taken = taken_emails([email for _, record in valid for email in emails_of(record)])
+                new = []
+                for number, record in valid:
+                    emails = emails_of(record)
+                    if emails & taken:
+                        results[number] = {'line': number, 'email': record.email, 'status': 'Account exists'}
+                    else:
+                        # Later records with one of these addresses exist by then
+                        taken |= emails
+                        new.append((number, record))
+                records = [record for _, record in new]
+                users = create_users(records) if records else []
+                outbox.enqueue_many(account_created_mails(users, records, request))
+            break
+        except IntegrityError:
+            if attempt == ATTEMPTS:
+                # Earlier chunks are committed, so the client needs the results of every record
+                logger.exception('Unable to register chunk of %d accounts', len(entries))
+                new = users = []
+                for number, record in valid:
+                    results.setdefault(number, {'line': number, 'email': record.email,
+                                                'status': 'Registration failed'})
+                break
+            logger.info('Usernames taken concurrently, retrying chunk (attempt %d)', attempt)
+    for (number, record), user in zip(new, users):
+        results[number] = {'line': number, 'email': record.email, 'status': 'Account created',
+                           'username': user.username}
+    logger.info('Registered %d of %d accounts', len(users), len(entries))
+    return [results[number] for number, _ in entries]
+
+
+def register(entries, request):
+    """Register the accounts of *entries* (from parse), chunk by chunk. Return one result per entry, in order."""
+    results = []
+    for start in range(0, len(entries), BATCH_SIZE):
+        results += register_chunk(entries[start:start + BATCH_SIZE], request)
+    return results
@@ -0,0 +1,59 @@
+"""
+Stale-while-revalidate cache of the storage used by users on the block server, for the profile page.
+
+Values younger than FRESH are served as they are. Older values are served as well, while the one worker which
+acquires a short per-user lock fetches the current value; concurrent views don't wait for it nor contact the block
+server themselves. If fetching fails, the old value (and the time it was fetched) keeps being served, and the
+lock delays the next attempt by LOCK_TIMEOUT.
+"""
+import datetime
+import logging
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .block import BlockUnavailable, get_block_quota_of_user
+
+logger = logging.getLogger(__name__)
+
+FRESH = datetime.timedelta(seconds=60)
+# How long values are kept for serving them stale
+KEEP = datetime.timedelta(days=7)
+LOCK_TIMEOUT = datetime.timedelta(seconds=30)
+
+
+def cache_key(user_id):
+    return 'user-used-quota-%d' % user_id
+
+
+def lock_key(user_id):
+    return 'user-used-quota-lock-%d' % user_id
+
+
+def get_used_quota(user):
+    """
+    Return tuple (used storage in bytes, time the value was fetched) for *user*.
+
+    The time is None if the value is not known (yet), the used storage is zero then.
+    """
+    entry = cache.get(cache_key(user.id))
+    if entry and timezone.now() - entry['updated_at'] < FRESH:
+        return entry['used'], entry['updated_at']
+    if cache.add(lock_key(user.id), True, int(LOCK_TIMEOUT.total_seconds())):
+        try:
+            _, used = get_block_quota_of_user(user)
+        except BlockUnavailable as exc:
+            logger.warning('Unable to retrieve block quota: %s', exc)
+        except Exception:
+            logger.exception('Unable to retrieve block quota.')
+        else:
+            entry = {'used': used, 'updated_at': timezone.now()}
+            cache.set(cache_key(user.id), entry, int(KEEP.total_seconds()))
+            cache.delete(lock_key(user.id))
+    if entry:
+        return entry['used'], entry['updated_at']
+    return 0, None
+
+
+def is_stale(updated_at):
+    return updated_at is None or timezone.now() - updated_at >= FRESH
@@ -3,9 +3,11 @@ from collections import namedtuple
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
 from rest_auth.registration.serializers import RegisterSerializer
+from rest_auth.serializers import PasswordResetSerializer
 from rest_framework import serializers
 
-from . import models
+from . import models, usage
+from .forms import QueuedPasswordResetForm
 
 
 class UserSerializer(RegisterSerializer):
@@ -31,6 +33,10 @@ class UserSerializer(RegisterSerializer):
         read_only = ('username',)
 
 
+class QueuedPasswordResetSerializer(PasswordResetSerializer):
+    password_reset_form_class = QueuedPasswordResetForm
+
+
 class SecondaryEmailsField(serializers.ListField):
     child = serializers.EmailField(max_length=254)
 
@@ -56,8 +62,12 @@ class PlanSubscriptionSerializer(serializers.Serializer):
     plan = serializers.PrimaryKeyRelatedField(queryset=models.Plan.objects.all())
 
     def validate_user_email(self, email):
-        if not models.User.objects.filter(email=email).count():
+        # Addresses are compared ignoring case, several users may have one that differs only in case
+        profiles = models.Profile.objects.filter(user__email__iexact=email)[:2].count()
+        if not profiles:
             raise serializers.ValidationError('No such user.')
+        if profiles > 1:
+            raise serializers.ValidationError('Several users with this email.')
         return email
 
     def create(self, validated_data):
@@ -67,7 +77,7 @@ class PlanSubscriptionSerializer(serializers.Serializer):
         )
 
     def _get_profile(self, validated_data):
-        return models.Profile.objects.get(user__email=validated_data['user_email'])
+        return models.Profile.objects.get(user__email__iexact=validated_data['user_email'])
 
 
 class PlanIntervalSerializer(PlanSubscriptionSerializer):
@@ -79,3 +89,50 @@ class PlanIntervalSerializer(PlanSubscriptionSerializer):
             plan=validated_data['plan'],
             duration=validated_data['duration'],
         )
+
+
+class PlanChangeSerializer(serializers.Serializer):
+    """
+    One change of the plan_batch endpoint, validated without queries.
+
+    The plans are passed in the context as a dict mapping plan IDs to plans (*plans*).
+    """
+    action = serializers.ChoiceField(choices=('set-plan', 'add-interval'))
+    user_email = serializers.EmailField()
+    plan = serializers.CharField()
+    duration = serializers.DurationField(required=False)
+
+    def validate_plan(self, plan_id):
+        try:
+            return self.context['plans'][plan_id]
+        except KeyError:
+            raise serializers.ValidationError('Invalid pk "%s" - object does not exist.' % plan_id)
+
+    def validate(self, data):
+        if data['action'] == 'add-interval' and 'duration' not in data:
+            raise serializers.ValidationError({'duration': ['This field is required.']})
+        return data
+
+
+class UsageSerializer(serializers.Serializer):
+    user_id = serializers.IntegerField()
+    traffic = serializers.IntegerField(min_value=0, required=False, default=0)
+    stored = serializers.IntegerField(required=False, default=0)
+
+
+class UsageReportSerializer(serializers.Serializer):
+    users = UsageSerializer(many=True)
+
+    def validate_users(self, users):
+        if len(users) > usage.REPORT_LIMIT:
+            raise serializers.ValidationError('Too many users, at most %d allowed' % usage.REPORT_LIMIT)
+        return users
+
+    def create(self, validated_data):
+        """Return dict mapping user IDs to their deltas, added up (see usage.record)."""
+        deltas = {}
+        for entry in validated_data['users']:
+            fields = deltas.setdefault(entry['user_id'], dict.fromkeys(usage.FIELDS, 0))
+            for field in usage.FIELDS:
+                fields[field] += entry[field]
+        return deltas
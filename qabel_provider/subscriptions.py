@@ -0,0 +1,151 @@
+"""
+Bulk plan subscription and interval changes, for the nightly reconciliation of the payment system.
+
+This is the batch variant of the plan_subscription and plan_add_interval endpoints. Changes are validated without
+queries, then applied in chunks of BATCH_SIZE, one transaction each, with a fixed number of statements per chunk:
+users are resolved by email with one query, subscriptions are set with one update per plan, intervals and audit log
+entries are inserted with bulk inserts (see insert_intervals for the primary keys of the intervals). Bulk writes don't
+send signals, so the Entitlement rows of the affected users are rewritten explicitly, set-wise as well (see
+entitlements.refresh_many).
+"""
+import logging
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from . import entitlements
+from .models import Plan, PlanInterval, Profile, ProfilePlanLog
+from .serializers import PlanChangeSerializer
+from .utils import filter_by_emails
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+# Upper bound for the number of changes of a single plan_batch request.
+LIMIT = 10000
+
+
+def resolve_profiles(emails):
+    """
+    Return dict mapping *emails* (in lower case) to profile IDs, or to None if several users share the address.
+
+    Addresses are compared ignoring case, like everywhere else (see utils.filter_by_emails).
+    """
+    profiles = {}
+    for email, profile_id in (filter_by_emails(User.objects.filter(profile__isnull=False), emails)
+                              .values_list('email', 'profile')):
+        email = email.lower()
+        profiles[email] = None if email in profiles else profile_id
+    return profiles
+
+
+def apply_chunk(changes, origin):
+    """
+    Apply *changes* (validated PlanChangeSerializer data) in one transaction. Return one result per change, in order.
+
+    Results are {'status': 200} or {'status': 400, 'errors': {...}}, like the responses of the single endpoints.
+    """
+    results = [None] * len(changes)
+    with transaction.atomic():
+        profiles = resolve_profiles({change['user_email'] for change in changes})
+        subscriptions = {}
+        intervals = []
+        for index, change in enumerate(changes):
+            profile_id = profiles.get(change['user_email'].lower())
+            if profile_id is None:
+                error = 'No such user.' if change['user_email'].lower() not in profiles else 'Several users with this email.'
+                results[index] = {'status': 400, 'errors': {'user_email': [error]}}
+                continue
+            if change['action'] == 'set-plan':
+                # Later changes of the same profile win, like they would one by one
+                subscriptions[profile_id] = change['plan']
+            else:
+                intervals.append(PlanInterval(profile_id=profile_id, plan=change['plan'], duration=change['duration']))
+            results[index] = {'status': 200}
+
+        by_plan = defaultdict(list)
+        for profile_id, plan in subscriptions.items():
+            by_plan[plan].append(profile_id)
+        for plan, profile_ids in by_plan.items():
+            Profile.objects.filter(pk__in=profile_ids).update(subscribed_plan=plan)
+
+        created = insert_intervals(intervals)
+        audit_log = []
+        for index, change in enumerate(changes):
+            if results[index]['status'] != 200:
+                continue
+            profile_id = profiles[change['user_email'].lower()]
+            if change['action'] == 'set-plan':
+                audit_log.append(ProfilePlanLog(profile_id=profile_id, action='set-plan', plan=change['plan'],
+                                                origin=origin))
+            else:
+                interval = created[profile_id, change['plan'].pk, change['duration']].pop(0)
+                audit_log.append(ProfilePlanLog(profile_id=profile_id, action='add-interval', plan=change['plan'],
+                                                interval=interval, origin=origin))
+        ProfilePlanLog.objects.bulk_create(audit_log, batch_size=BATCH_SIZE)
+        entitlements.refresh_users({log.profile_id for log in audit_log})
+    logger.info('Applied %d of %d plan changes', len(audit_log), len(changes))
+    return results
+
+
+def reserve_ids(model, count):
+    """Return *count* new primary keys of *model*, drawn from the sequence of its table (PostgreSQL only)."""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                       [model._meta.db_table, model._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def insert_intervals(intervals):
+    """
+    Insert *intervals* with one statement. Return dict mapping (profile_id, plan_id, duration) to lists of the
+    inserted intervals, in order.
+    """
+    if not intervals:
+        return {}
+    created = defaultdict(list)
+    if connection.vendor == 'postgresql':
+        # bulk_create doesn't set primary keys (before Django 1.10), so they are taken from the sequence up front
+        for interval, pk in zip(intervals, reserve_ids(PlanInterval, len(intervals))):
+            interval.pk = pk
+        PlanInterval.objects.bulk_create(intervals, batch_size=BATCH_SIZE)
+        for interval in intervals:
+            created[interval.profile_id, interval.plan_id, interval.duration].append(interval)
+        return created
+    # Elsewhere the inserted intervals are looked up. This relies on writes being serialized (as on SQLite, which
+    # doesn't commit other transactions while this one read), otherwise concurrently added intervals of the same
+    # profile, plan and duration could be taken for these.
+    last = PlanInterval.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    PlanInterval.objects.bulk_create(intervals, batch_size=BATCH_SIZE)
+    for interval in (PlanInterval.objects
+                     .filter(id__gt=last, profile_id__in={interval.profile_id for interval in intervals},
+                             state='pristine')
+                     .order_by('id')):
+        created[interval.profile_id, interval.plan_id, interval.duration].append(interval)
+    return created
+
+
+def apply(entries, origin):
+    """
+    Validate and apply the plan changes *entries* (dicts, see views.plan_batch) chunk by chunk.
+
+    Return one result per entry, in order. *origin* is written to the audit log.
+    """
+    context = {'plans': {plan.pk: plan for plan in Plan.objects.all()}}
+    results = []
+    for start in range(0, len(entries), BATCH_SIZE):
+        chunk = entries[start:start + BATCH_SIZE]
+        chunk_results = [None] * len(chunk)
+        valid = []
+        for index, entry in enumerate(chunk):
+            serializer = PlanChangeSerializer(data=entry, context=context)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                chunk_results[index] = {'status': 400, 'errors': serializer.errors}
+        if valid:
+            for (index, _), result in zip(valid, apply_chunk([change for _, change in valid], origin)):
+                chunk_results[index] = result
+        results += chunk_results
+    return results
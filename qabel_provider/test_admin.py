@@ -1,6 +1,10 @@
 from allauth.account.models import EmailAddress
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.template.defaultfilters import filesizeformat
+
+from .block import BlockClient
+from .test_block import block_server
 
 
 def test_an_admin_view(admin_client):
@@ -36,3 +40,23 @@ def test_export_user_data(admin_client, user):
     assert 'no_mail' not in content
     assert 'unconfirmed' not in content
     assert 'unrelated' not in content
+
+
+def test_user_changelist_storage_used(admin_client, user, block_server, monkeypatch):
+    monkeypatch.setattr('qabel_provider.block._client', BlockClient(
+        block_server.url, connect_timeout=1, read_timeout=1, failure_threshold=1, reset_timeout=60))
+    User.objects.create_user('other', 'other@example.com', 'password')
+    response = admin_client.get(reverse('admin:auth_user_changelist'))
+    assert response.status_code == 200
+    # One request for the whole page
+    assert len(block_server.requests) == 1
+    _, _, _, data = block_server.requests[0]
+    assert sorted(data['user_ids']) == sorted(User.objects.values_list('id', flat=True))
+    assert filesizeformat(10 * user.id) in response.content.decode()
+
+
+def test_user_changelist_block_down(admin_client, user, monkeypatch):
+    monkeypatch.setattr('qabel_provider.block._client', BlockClient(
+        'http://127.0.0.1:1', connect_timeout=1, read_timeout=1, failure_threshold=1, reset_timeout=60))
+    response = admin_client.get(reverse('admin:auth_user_changelist'))
+    assert response.status_code == 200
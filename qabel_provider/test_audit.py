@@ -0,0 +1,124 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from . import audit
+from .models import ArchivedProfilePlanLog, PlanInterval, ProfilePlanLog
+from .test_rest import best_plan
+
+
+@pytest.fixture
+def audit_log(user, best_plan):
+    """Return the entries of an audit log of the last five days, one per day, oldest first."""
+    now = timezone.now()
+    interval = PlanInterval.objects.create(profile=user.profile, plan=best_plan, duration=timedelta(days=30))
+    for days in range(5, 0, -1):
+        entry = ProfilePlanLog.objects.create(profile=user.profile, action='add-interval', plan=best_plan,
+                                              interval=interval, origin='test')
+        ProfilePlanLog.objects.filter(pk=entry.pk).update(timestamp=now - timedelta(days=days))
+    return list(ProfilePlanLog.objects.order_by('timestamp'))
+
+
+def test_export_csv(export, audit_log, user, best_plan):
+    content_type, content = export(audit_log[1].timestamp, audit_log[4].timestamp)
+    assert content_type == 'text/csv'
+    rows = list(csv.DictReader(io.StringIO(content)))
+    assert [int(row['id']) for row in rows] == [entry.id for entry in audit_log[1:4]]
+    row = rows[0]
+    assert row['timestamp'] == audit_log[1].timestamp.isoformat()
+    assert (row['user_id'], row['username']) == (str(user.id), user.username)
+    assert (row['action'], row['plan'], row['origin']) == ('add-interval', best_plan.id, 'test')
+    assert row['interval'] == str(audit_log[1].interval_id)
+
+
+def test_export_ndjson(export, audit_log):
+    content_type, content = export(audit_log[0].timestamp, timezone.now(), type='ndjson')
+    assert content_type == 'application/x-ndjson'
+    entries = [json.loads(line) for line in content.splitlines()]
+    assert [entry['id'] for entry in entries] == [entry.id for entry in audit_log]
+
+
+def test_export_chunks(export, audit_log, monkeypatch):
+    monkeypatch.setattr('qabel_provider.audit.CHUNK_SIZE', 2)
+    # Ties of the timestamp are ordered by ID
+    ProfilePlanLog.objects.filter(pk__in=[entry.pk for entry in audit_log[1:4]]).update(timestamp=audit_log[1].timestamp)
+    _, content = export(audit_log[0].timestamp, timezone.now(), type='ndjson')
+    assert [json.loads(line)['id'] for line in content.splitlines()] == [entry.id for entry in audit_log]
+
+
+def test_export_naive_utc(export, audit_log):
+    since = timezone.make_naive(audit_log[4].timestamp, timezone.utc)
+    _, content = export(since, since + timedelta(seconds=1), type='ndjson')
+    assert [json.loads(line)['id'] for line in content.splitlines()] == [audit_log[4].id]
+
+
+@pytest.mark.parametrize('params', (
+    {},
+    {'since': '2016-01-01T00:00:00'},
+    {'since': 'yesterday', 'until': '2016-01-01T00:00:00'},
+    {'since': '2016-01-01T00:00:00', 'until': '2016-02-01T00:00:00', 'type': 'xls'},
+))
+def test_export_malformed(external_api_client, audit_log_path, params):
+    response = external_api_client.get(audit_log_path, params)
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_export_requires_api_key(api_client, audit_log_path):
+    response = api_client.get(audit_log_path, {'since': '2016-01-01T00:00:00', 'until': '2016-02-01T00:00:00'})
+    assert response.status_code == 403
+
+
+def test_archive(audit_log):
+    assert audit.archive(audit_log[2].timestamp, batch_size=1) == 2
+    assert list(ProfilePlanLog.objects.order_by('timestamp')) == audit_log[2:]
+    archived = list(ArchivedProfilePlanLog.objects.order_by('timestamp'))
+    assert [(entry.id, entry.timestamp, entry.profile_id, entry.action, entry.plan_id, entry.interval_id, entry.origin)
+            for entry in archived] == \
+        [(entry.id, entry.timestamp, entry.profile_id, entry.action, entry.plan_id, entry.interval_id, entry.origin)
+         for entry in audit_log[:2]]
+    assert audit.archive(audit_log[2].timestamp) == 0
+
+
+def test_archive_command(audit_log, monkeypatch):
+    monkeypatch.setattr('qabel_provider.audit.archive_before', lambda hot_months: audit_log[1].timestamp)
+    out = io.StringIO()
+    call_command('archive_audit_log', stdout=out)
+    assert 'Archived 1 entries' in out.getvalue()
+    assert ArchivedProfilePlanLog.objects.get().id == audit_log[0].id
+
+
+@pytest.mark.parametrize('now, hot_months, before', (
+    (datetime(2016, 6, 15), 6, datetime(2016, 1, 1)),
+    (datetime(2016, 6, 15), 1, datetime(2016, 6, 1)),
+    (datetime(2016, 1, 31), 2, datetime(2015, 12, 1)),
+    (datetime(2016, 1, 1), 13, datetime(2015, 1, 1)),
+))
+def test_archive_before(now, hot_months, before):
+    assert audit.archive_before(timezone.make_aware(now), hot_months) == timezone.make_aware(before)
+
+
+def test_export_archived(export, audit_log):
+    audit.archive(audit_log[3].timestamp)
+    _, content = export(audit_log[1].timestamp, timezone.now(), type='ndjson')
+    assert [json.loads(line)['id'] for line in content.splitlines()] == [entry.id for entry in audit_log[1:]]
+
+
+def test_history_archived(user_client, audit_log, user):
+    audit.archive(audit_log[3].timestamp)
+    events = []
+    params = {'limit': 2}
+    while True:
+        data = user_client.get('/api/v0/account/history/', params).json()
+        events += data['events']
+        if not data['cursor']:
+            break
+        params['before'] = data['cursor']
+    assert [event['timestamp'][:19] for event in events] == \
+        [entry.timestamp.isoformat()[:19] for entry in reversed(audit_log)]
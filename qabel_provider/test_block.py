@@ -0,0 +1,188 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+import requests
+
+from rest_framework.authtoken.models import Token
+
+from .block import BlockClient, BlockUnavailable, CircuitBreaker, get_block_quota_of_user, get_block_quotas
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(None)
+
+    def do_POST(self):
+        self.respond(json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+
+    def respond(self, data):
+        server = self.server
+        server.requests.append((self.command, self.path, dict(self.headers), data))
+        server.connections.add(self.client_address)
+        time.sleep(server.delay)
+        body = server.body(data) if callable(server.body) else server.body
+        body = json.dumps(body).encode()
+        self.send_response(server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Block server stand-in, answering every request with *status* and *body* after *delay* seconds.
+
+    *body* may be a callable, which gets the decoded JSON payload of the request.
+    """
+    # Don't wait for kept alive connections on shutdown
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.requests = []
+        self.connections = set()
+        self.status = 200
+        self.body = self.quotas
+        self.delay = 0
+
+    @staticmethod
+    def quotas(data):
+        """Answer internal/quota/ requests, every user has used ten bytes per ID."""
+        return {'users': {str(user_id): {'quota': 100, 'size': 10 * user_id} for user_id in data['user_ids']}}
+
+    def handle_error(self, request, client_address):
+        # Clients timing out close the connection before the response is written
+        pass
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+@pytest.yield_fixture
+def block_server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def block_client(block_server):
+    return BlockClient(block_server.url, connect_timeout=1, read_timeout=0.5, failure_threshold=2, reset_timeout=60)
+
+
+def test_quota(block_client, block_server, user, api_secret):
+    assert get_block_quota_of_user(user, block_client) == (100, 10 * user.id)
+    method, path, headers, data = block_server.requests[0]
+    assert (method, path) == ('POST', '/api/v0/internal/quota/')
+    assert headers['APISECRET'] == api_secret
+    assert data == {'user_ids': [user.id]}
+    # No tokens are created for asking the block server
+    assert not Token.objects.exists()
+
+
+def test_quotas_batches(block_client, block_server, monkeypatch):
+    monkeypatch.setattr('qabel_provider.block.QUOTA_BATCH_SIZE', 2)
+    quotas = get_block_quotas([1, 2, 3], block_client)
+    assert quotas == {1: (100, 10), 2: (100, 20), 3: (100, 30)}
+    assert [data['user_ids'] for _, _, _, data in block_server.requests] == [[1, 2], [3]]
+
+
+def test_quotas_incomplete(block_client, block_server):
+    block_server.body = {'users': {}}
+    with pytest.raises(ValueError):
+        get_block_quotas([1], block_client)
+
+
+def test_connection_reuse(block_client, block_server, user):
+    for i in range(3):
+        get_block_quota_of_user(user, block_client)
+    assert len(block_server.requests) == 3
+    assert len(block_server.connections) == 1
+
+
+def test_read_timeout(block_client, block_server):
+    block_server.delay = 1
+    with pytest.raises(requests.Timeout):
+        get_block_quotas([1], block_client)
+
+
+def test_circuit_breaker(block_client, block_server):
+    block_server.status = 503
+    for i in range(2):
+        with pytest.raises(requests.HTTPError):
+            get_block_quotas([1], block_client)
+    with pytest.raises(BlockUnavailable):
+        get_block_quotas([1], block_client)
+    assert len(block_server.requests) == 2
+
+
+def test_server_errors_raise(block_client, block_server, user):
+    block_server.status = 500
+    with pytest.raises(requests.HTTPError):
+        get_block_quota_of_user(user, block_client)
+
+
+def test_connection_refused():
+    client = BlockClient('http://127.0.0.1:1', connect_timeout=1, read_timeout=1, failure_threshold=1, reset_timeout=60)
+    with pytest.raises(requests.ConnectionError):
+        client.get('quota/')
+    with pytest.raises(BlockUnavailable):
+        client.get('quota/')
+
+
+def test_circuit_breaker_half_open():
+    now = [0]
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+    breaker.before_call()
+    breaker.failed()
+    with pytest.raises(BlockUnavailable):
+        breaker.before_call()
+
+    now[0] = 11
+    # One trial call, concurrent calls still fail fast
+    breaker.before_call()
+    with pytest.raises(BlockUnavailable):
+        breaker.before_call()
+    breaker.failed()
+    with pytest.raises(BlockUnavailable):
+        breaker.before_call()
+
+    now[0] = 22
+    breaker.before_call()
+    breaker.succeeded()
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_circuit_breaker_trial_unexpected_error(block_client, block_server, monkeypatch):
+    now = [0]
+    block_client.breaker.clock = lambda: now[0]
+    block_server.status = 503
+    for i in range(2):
+        with pytest.raises(requests.HTTPError):
+            get_block_quotas([1], block_client)
+
+    now[0] = 60
+    monkeypatch.setattr(block_client, 'send', lambda *args, **kwargs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        get_block_quotas([1], block_client)
+    monkeypatch.undo()
+    # The trial call ended without outcome, the next call is a trial again
+    block_server.status = 200
+    assert get_block_quotas([1], block_client) == {1: (100, 10)}
+    assert len(block_server.requests) == 3
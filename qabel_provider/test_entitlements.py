@@ -0,0 +1,382 @@
+import io
+from datetime import timedelta
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import entitlements
+from .models import Entitlement, EntitlementChange, Plan, PlanInterval, Profile, ProfilePlanLog
+from .test_rest import best_plan
+
+
+def test_cache_hit_no_queries(auth_call, user, assert_num_queries):
+    # The user was invalidated just now (created), so its answer is stored by the first call knowing its version
+    auth_call()
+    first = auth_call()
+    with assert_num_queries(0):
+        assert auth_call() == first
+        assert auth_call(user_id=user.id) == first
+
+
+def test_cache_unknown_token(auth_call, external_api_client, auth_resource_path):
+    auth_call()
+    response = external_api_client.post(auth_resource_path, {'auth': 'Token foobar'})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('change', ('user', 'profile', 'email'))
+def test_cache_invalidation(auth_call, user, change):
+    assert auth_call()['active']
+    if change == 'user':
+        user.is_active = False
+        user.save()
+    elif change == 'profile':
+        user.profile.needs_confirmation_after = timezone.now() - timedelta(days=1)
+        user.profile.save()
+    else:
+        user.profile.needs_confirmation_after = timezone.now() - timedelta(days=1)
+        user.profile.save()
+        auth_call()
+        user.profile.confirm_email()
+    assert auth_call()['active'] == (change == 'email')
+
+
+def test_cache_invalidation_token_deleted(auth_call, user, external_api_client, auth_resource_path, token):
+    auth_call()
+    user.auth_token.delete()
+    response = external_api_client.post(auth_resource_path, {'auth': 'Token {}'.format(token)})
+    assert response.status_code == 404
+
+
+def test_cache_invalidation_plan(auth_call, user):
+    plan = user.profile.plan
+    assert auth_call()['block_quota'] == plan.block_quota
+    plan.block_quota = 1234
+    plan.save()
+    assert auth_call()['block_quota'] == 1234
+
+
+def test_cache_invalidation_interval(auth_call, user, best_plan):
+    auth_call()
+    PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(days=1)).save()
+    assert auth_call()['block_quota'] == best_plan.block_quota
+
+
+def test_cache_timeout_capped_by_interval(auth_call, user, best_plan, entitlement_cache, settings, monkeypatch):
+    interval = PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(seconds=30))
+    interval.save()
+    timeouts = []
+    original_set_many = entitlement_cache.set_many
+    monkeypatch.setattr(entitlement_cache, 'set_many', lambda data, timeout: timeouts.append(timeout) or
+                        original_set_many(data, timeout))
+    # The first call starts the interval, which invalidates its answer
+    auth_call()
+    timeouts.clear()
+    auth_call()
+    assert timeouts
+    assert 0 < timeouts[0] <= 30 < settings.ENTITLEMENT_CACHE_TIMEOUT
+
+
+@pytest.mark.parametrize('invalidate', (
+    lambda user: entitlements.invalidate_user(user.id),
+    lambda user: entitlements.invalidate_all(),
+))
+def test_store_after_invalidation(user, invalidate):
+    identification = ('user_id', user.id)
+    answers, versions = entitlements.lookup([identification])
+    assert not answers
+    invalidate(user)
+    # Computed before the invalidation, so possibly outdated
+    entitlements.store(user.id, {'user_id': user.id}, None, versions)
+    assert entitlements.lookup([identification])[0] == {}
+
+    answers, versions = entitlements.lookup([identification])
+    entitlements.store(user.id, {'user_id': user.id}, None, versions)
+    assert entitlements.lookup([identification])[0] == {identification: ({'user_id': user.id}, None)}
+
+
+def test_store_token_after_invalidation(user, token, entitlement_cache):
+    identification = ('token', token)
+    answers, versions = entitlements.lookup([identification])
+    entitlements.invalidate_token(token)
+    entitlements.store(user.id, {'user_id': user.id}, None, versions, token=token)
+    assert entitlement_cache.get(entitlements.token_key(token)) is None
+
+    answers, versions = entitlements.lookup([identification])
+    entitlements.store(user.id, {'user_id': user.id}, None, versions, token=token)
+    assert entitlement_cache.get(entitlements.token_key(token)) == user.id
+
+
+def test_valid_until_inactive(user):
+    profile = user.profile
+    profile.next_confirmation_mail = timezone.now() + timedelta(hours=1)
+    assert entitlements.valid_until(profile, active=False) == profile.next_confirmation_mail
+
+
+def test_cache_disabled(auth_call, settings, queries_for):
+    settings.ENTITLEMENT_CACHE_TIMEOUT = 0
+    auth_call()
+    assert queries_for(auth_call)
+
+
+def test_entitlement_row(user):
+    entitlement = Entitlement.objects.get(profile=user.profile)
+    assert entitlement.plan_id == 'free'
+    assert entitlement.active
+    assert not entitlement.confirmed
+    assert entitlement.valid_until == user.profile.needs_confirmation_after
+
+
+def test_entitlement_row_confirmed(user):
+    user.profile.confirm_email()
+    entitlement = Entitlement.objects.get(profile=user.profile)
+    assert entitlement.confirmed
+    assert entitlement.valid_until is None
+
+
+def test_entitlement_row_plan(user, best_plan):
+    user.profile.subscribed_plan = best_plan
+    user.profile.save()
+    assert Entitlement.objects.get(profile=user.profile).block_quota == best_plan.block_quota
+    best_plan.block_quota = 1234
+    best_plan.save()
+    assert Entitlement.objects.get(profile=user.profile).block_quota == 1234
+
+
+def test_entitlement_row_interval(auth_call, user, best_plan):
+    PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(days=1)).save()
+    # The interval is only started by auth_resource, until then the row is outdated
+    assert not Entitlement.objects.get(profile=user.profile).is_valid()
+    assert auth_call()['block_quota'] == best_plan.block_quota
+    entitlement = Entitlement.objects.get(profile=user.profile)
+    assert entitlement.plan == best_plan
+    assert entitlement.is_valid()
+
+
+def test_entitlement_row_inactive(user):
+    user.is_active = False
+    user.save()
+    assert not Entitlement.objects.get(profile=user.profile).active
+
+
+def test_entitlement_row_last_login(user, mocker):
+    refresh = mocker.spy(entitlements, 'refresh')
+    user.last_login = timezone.now()
+    user.save(update_fields=['last_login'])
+    assert not refresh.called
+
+
+def committed_user_and_plan():
+    # Tables are flushed after transactional tests, including the plans created by migrations
+    Plan.objects.get_or_create(id='free', defaults={'name': 'Free', 'block_quota': 1, 'monthly_traffic_quota': 1})
+    best_plan = Plan.objects.create(id='best_plan', name='best plan', block_quota=2, monthly_traffic_quota=2)
+    return User.objects.create_user('foo', 'foo@example.com'), best_plan
+
+
+def test_entitlement_row_once_per_transaction(transactional_db, mocker):
+    user, best_plan = committed_user_and_plan()
+    refresh = mocker.spy(entitlements, 'refresh_many')
+    changes = EntitlementChange.objects.filter(user_id=user.id).count()
+    with transaction.atomic():
+        user.profile.subscribed_plan = best_plan
+        user.profile.save()
+        ProfilePlanLog.objects.create(profile=user.profile, action='set-plan', plan=best_plan)
+        assert not refresh.called
+    assert refresh.call_count == 1
+    assert Entitlement.objects.get(profile=user.profile).plan == best_plan
+    assert EntitlementChange.objects.filter(user_id=user.id).count() == changes + 1
+
+
+def test_entitlement_row_once_per_auth_call(transactional_db, api_secret, auth_resource_path, mocker):
+    user, best_plan = committed_user_and_plan()
+    PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(days=1)).save()
+    refresh = mocker.spy(entitlements, 'refresh')
+    refresh_many = mocker.spy(entitlements, 'refresh_many')
+    response = APIClient(HTTP_APISECRET=api_secret).post(auth_resource_path, {'user_id': user.id})
+    assert response.json()['block_quota'] == best_plan.block_quota
+    # Starting the interval schedules a refresh, which the call makes redundant by rewriting the row itself
+    assert refresh.call_count == 1
+    assert not refresh_many.called
+    assert Entitlement.objects.get(profile=user.profile).valid_until
+
+
+def test_pending_refresh_after_rollback(transactional_db):
+    user, best_plan = committed_user_and_plan()
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            entitlements.schedule_refresh(user.id)
+            raise RuntimeError
+    assert entitlements.pending_refresh() is None
+    with transaction.atomic():
+        Profile.objects.filter(pk=user.pk).update(subscribed_plan=best_plan)
+        entitlements.schedule_refresh(user.id)
+        assert entitlements.pending_refresh().user_ids == {user.id}
+    assert entitlements.pending_refresh() is None
+    assert Entitlement.objects.get(profile=user.profile).plan == best_plan
+
+
+def test_entitlement_row_rollback(transactional_db):
+    user, best_plan = committed_user_and_plan()
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            user.profile.subscribed_plan = best_plan
+            user.profile.save()
+            raise RuntimeError
+    # Changes of later transactions are not lost
+    with transaction.atomic():
+        user.is_active = False
+        user.save()
+    assert not Entitlement.objects.get(profile=user.profile).active
+
+
+def test_entitlement_row_deleted_user(user):
+    profile_id = user.profile.pk
+    user.delete()
+    assert not Entitlement.objects.filter(profile_id=profile_id).exists()
+
+
+def test_entitlement_row_missing(auth_call, user):
+    Entitlement.objects.all().delete()
+    assert auth_call()['active']
+    assert Entitlement.objects.get(profile=user.profile).active
+
+
+def test_refresh_users(user, best_plan):
+    other = User.objects.create_user('other', 'other@example.com', 'password')
+    Entitlement.objects.filter(profile=other.profile).delete()
+    Profile.objects.filter(pk=user.profile.pk).update(subscribed_plan=best_plan)
+    Entitlement.objects.filter(profile=user.profile).update(over_quota=True)
+    EntitlementChange.objects.all().delete()
+    entitlements.refresh_users([user.id, other.id])
+    entitlement = Entitlement.objects.get(profile=user.profile)
+    assert (entitlement.plan, entitlement.block_quota, entitlement.over_quota) == (best_plan, best_plan.block_quota, True)
+    assert Entitlement.objects.get(profile=other.profile).plan_id == 'free'
+    assert sorted(EntitlementChange.objects.values_list('user_id', flat=True)) == [user.id, other.id]
+
+    # Unchanged answers are no changes
+    entitlements.refresh_users([user.id, other.id])
+    assert EntitlementChange.objects.count() == 2
+
+
+def test_rebuild_entitlements(user):
+    Entitlement.objects.all().delete()
+    call_command('rebuild_entitlements', batch_size=1)
+    assert Entitlement.objects.get(profile=user.profile).active
+
+
+def test_check_entitlements(user):
+    call_command('check_entitlements')
+    Entitlement.objects.update(block_quota=1)
+    with pytest.raises(CommandError):
+        call_command('check_entitlements')
+    call_command('check_entitlements', fix=True)
+    assert Entitlement.objects.get(profile=user.profile).block_quota == user.profile.plan.block_quota
+    call_command('check_entitlements')
+
+
+def test_feed(feed, user, best_plan):
+    cursor = feed()['cursor']
+    assert feed(after=cursor) == {'changes': [], 'cursor': cursor}
+
+    user.profile.subscribed_plan = best_plan
+    user.profile.save()
+    page = feed(after=cursor)
+    assert [change['user_id'] for change in page['changes']] == [user.id]
+    cursor = page['cursor']
+    assert page['changes'][0]['cursor'] == cursor
+
+    # Writes not changing the answer are not in the feed
+    user.last_name = 'Foo'
+    user.save()
+    assert feed(after=cursor)['changes'] == []
+
+    user.is_active = False
+    user.save()
+    assert [change['user_id'] for change in feed(after=cursor)['changes']] == [user.id]
+
+
+def test_feed_plan_and_delete(feed, user, assert_num_queries):
+    cursor = feed()['cursor']
+    plan = user.profile.plan
+    plan.block_quota = 1234
+    # Saving, rewriting the rows of the plan and recording one change, however many users it has
+    with assert_num_queries(3):
+        plan.save()
+    page = feed(after=cursor)
+    assert [(change['user_id'], change['plan_id']) for change in page['changes']] == [(None, plan.id)]
+    assert Entitlement.objects.get(profile=user.profile).block_quota == 1234
+
+    user_id = user.id
+    user.delete()
+    assert user_id in [change['user_id'] for change in feed(after=page['cursor'])['changes']]
+
+
+def test_feed_limit(feed, user):
+    cursor = feed()['cursor']
+    for active in (False, True, False):
+        user.is_active = active
+        user.save()
+    page = feed(after=cursor, limit=2)
+    assert len(page['changes']) == 2
+    assert len(feed(after=page['cursor'])['changes']) == 1
+
+
+def test_feed_late_commit(feed, user):
+    cursor = feed()['cursor']
+    # A transaction took an ID but commits after another one with a later ID was handed out
+    late = EntitlementChange.objects.create(user_id=user.id)
+    late.delete()
+    user.is_active = False
+    user.save()
+    cursor = feed(after=cursor)['cursor']
+    EntitlementChange.objects.create(id=late.id, user_id=user.id)
+    page = feed(after=cursor)
+    assert [change['user_id'] for change in page['changes']] == [user.id]
+    assert page['cursor'] > cursor
+    assert feed(after=page['cursor'])['changes'] == []
+
+
+def test_feed_wait(feed, user, monkeypatch, settings):
+    clock = [0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    cursor = feed()['cursor']
+    monkeypatch.setattr('time.monotonic', lambda: clock[0])
+    monkeypatch.setattr('time.sleep', sleep)
+    # Within the query budget
+    assert feed(after=cursor, wait=settings.ENTITLEMENT_FEED_MAX_WAIT)['changes'] == []
+    assert sum(sleeps) == settings.ENTITLEMENT_FEED_MAX_WAIT
+
+
+def test_feed_outdated(feed, user):
+    cursor = feed()['cursor']
+    # The confirmation deadline passes without any write
+    deadline = timezone.now() - timedelta(minutes=1)
+    Profile.objects.filter(pk=user.pk).update(needs_confirmation_after=deadline)
+    Entitlement.objects.filter(profile_id=user.id).update(valid_until=deadline)
+    out = io.StringIO()
+    call_command('sweep_intervals', stdout=out)
+    assert 'Rewrote 1 outdated entitlements.' in out.getvalue()
+    assert not Entitlement.objects.get(profile_id=user.id).active
+    page = feed(after=cursor)
+    assert [change['user_id'] for change in page['changes']] == [user.id]
+
+    # Rows of inactive users stay outdated, rewriting them again records nothing
+    assert entitlements.refresh_outdated(batch_size=1) == 1
+    assert feed(after=page['cursor'])['changes'] == []
+
+
+@pytest.mark.parametrize('params', ({'after': 'foo'}, {'after': 0, 'limit': 0}, {'after': 0, 'wait': 'bar'}))
+def test_feed_malformed(external_api_client, entitlement_changes_path, params):
+    response = external_api_client.get(entitlement_changes_path, params)
+    assert response.status_code == 400
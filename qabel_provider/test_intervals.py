@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
+
+from . import intervals
+from .models import Entitlement, PlanInterval, ProfilePlanLog
+from .test_rest import best_plan
+
+
+@pytest.fixture
+def in_use(profile, best_plan):
+    def make(ago, duration=timedelta(days=1), profile=profile):
+        # Saving an overdue interval would expire it right away (when its Entitlement row is rewritten)
+        interval = PlanInterval.objects.create(profile=profile, plan=best_plan, duration=duration)
+        PlanInterval.objects.filter(pk=interval.pk).update(state='in_use', started_at=timezone.now() - ago)
+        interval.refresh_from_db()
+        return interval
+    return make
+
+
+def test_sweep_expires_overdue(in_use):
+    overdue = in_use(ago=timedelta(days=2))
+    assert intervals.sweep() == 1
+    overdue.refresh_from_db()
+    assert overdue.state == 'expired'
+    log = ProfilePlanLog.objects.get(interval=overdue)
+    assert log.action == 'expired-interval'
+    assert log.origin == intervals.ORIGIN
+    assert intervals.sweep() == 0
+
+
+def test_sweep_keeps_running(in_use):
+    running = in_use(ago=timedelta(hours=1))
+    assert intervals.sweep() == 0
+    running.refresh_from_db()
+    assert running.state == 'in_use'
+    assert not ProfilePlanLog.objects.exists()
+
+
+def test_sweep_starts_next(in_use, profile, best_plan):
+    older = PlanInterval.objects.create(profile=profile, plan=best_plan, duration=timedelta(days=1))
+    newer = PlanInterval.objects.create(profile=profile, plan=best_plan, duration=timedelta(days=1))
+    in_use(ago=timedelta(days=2))
+    intervals.sweep()
+    older.refresh_from_db()
+    newer.refresh_from_db()
+    # Same choice as PlanInterval._get_pristine_interval
+    assert newer.state == 'in_use'
+    assert newer.started_at
+    assert older.state == 'pristine'
+    assert ProfilePlanLog.objects.get(interval=newer).action == 'start-interval'
+
+    entitlement = Entitlement.objects.get(profile=profile)
+    assert entitlement.plan == best_plan
+    assert entitlement.valid_until == newer.started_at + newer.duration
+
+
+def test_sweep_entitlement_row(in_use, profile):
+    in_use(ago=timedelta(days=2))
+    intervals.sweep()
+    entitlement = Entitlement.objects.get(profile=profile)
+    assert entitlement.plan_id == 'free'
+    assert entitlement.is_valid()
+
+
+def test_sweep_chunks(in_use):
+    users = [User.objects.create_user('user%d' % i, 'user%d@example.com' % i, 'password') for i in range(5)]
+    for user in users:
+        in_use(ago=timedelta(days=2), profile=user.profile)
+    assert intervals.sweep_chunk(batch_size=2) == 2
+    assert PlanInterval.objects.filter(state='in_use').count() == 3
+    call_command('sweep_intervals', batch_size=2)
+    assert not PlanInterval.objects.filter(state='in_use').exists()
+    assert ProfilePlanLog.objects.filter(action='expired-interval').count() == 5
+
+
+def test_sweep_chunk_queries(in_use, queries_for):
+    def overdue(count):
+        for i in range(count):
+            name = 'user%d-%d' % (count, i)
+            user = User.objects.create_user(name, name + '@example.com', 'password')
+            in_use(ago=timedelta(days=2), profile=user.profile)
+
+    def sweep(count):
+        assert intervals.sweep_chunk(batch_size=100) == count
+
+    overdue(1)
+    one = queries_for(sweep, 1)
+    overdue(10)
+    assert len(queries_for(sweep, 10)) == len(one)
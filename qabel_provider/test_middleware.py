@@ -0,0 +1,65 @@
+import pytest
+
+from django.db import connection
+from prometheus_client import REGISTRY
+
+from . import middleware
+
+
+def exceeded(view, budget):
+    return REGISTRY.get_sample_value('query_budget_exceeded_total', {'view': view, 'budget': budget}) or 0
+
+
+def test_budget_strict(external_api_client, auth_resource_path, user, settings):
+    settings.QUERY_BUDGETS = dict(settings.QUERY_BUDGETS, **{'api-auth': (0, 1)})
+    with pytest.raises(middleware.QueryBudgetExceeded) as excinfo:
+        external_api_client.post(auth_resource_path, {'user_id': user.id})
+    assert 'POST api-auth ran ' in str(excinfo.value)
+    assert not connection.force_debug_cursor
+
+
+def test_budget_exceeded(external_api_client, auth_resource_path, user, settings, mocker):
+    warning = mocker.patch.object(middleware.logger, 'warning')
+    settings.QUERY_BUDGET_STRICT = False
+    settings.QUERY_BUDGETS = dict(settings.QUERY_BUDGETS, **{'api-auth': (0, 1)})
+    before = exceeded('api-auth', 'queries')
+    response = external_api_client.post(auth_resource_path, {'user_id': user.id})
+    assert response.status_code == 200
+    assert exceeded('api-auth', 'queries') == before + 1
+    assert 'over its budget' in warning.call_args[0][0]
+
+
+def test_budget_time(external_api_client, auth_resource_path, user, settings):
+    settings.QUERY_BUDGET_STRICT = False
+    settings.QUERY_BUDGETS = dict(settings.QUERY_BUDGETS, **{'api-auth': (100, -1)})
+    before = exceeded('api-auth', 'time')
+    external_api_client.post(auth_resource_path, {'user_id': user.id})
+    assert exceeded('api-auth', 'time') == before + 1
+
+
+def test_budget_disabled(external_api_client, auth_resource_path, user, settings):
+    settings.QUERY_BUDGETS = dict(settings.QUERY_BUDGETS, **{'api-auth': None})
+    settings.QUERY_BUDGET = (0, -1)
+    response = external_api_client.post(auth_resource_path, {'user_id': user.id})
+    assert response.status_code == 200
+
+
+def test_budget_explain(external_api_client, auth_resource_path, user, settings, mocker):
+    settings.QUERY_BUDGET_STRICT = False
+    settings.QUERY_BUDGET_EXPLAIN_RATE = 1
+    settings.QUERY_BUDGETS = dict(settings.QUERY_BUDGETS, **{'api-auth': (0, 1)})
+    explain = mocker.patch('qabel_provider.middleware.explain', return_value=None)
+    external_api_client.post(auth_resource_path, {'user_id': user.id})
+    assert explain.call_count == 1
+    settings.QUERY_BUDGET_EXPLAIN_RATE = 0
+    external_api_client.post(auth_resource_path, {'user_id': user.id})
+    assert explain.call_count == 1
+
+
+@pytest.mark.django_db
+def test_explain():
+    if connection.vendor != 'postgresql':
+        assert middleware.explain(connection, 'SELECT 1') is None
+        return
+    assert middleware.explain(connection, 'SELECT 1')
+    assert middleware.explain(connection, 'DELETE FROM auth_user') is None
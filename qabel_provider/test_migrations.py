@@ -1,6 +1,9 @@
 
+from datetime import timedelta
+
 from django.db.migrations.executor import MigrationExecutor
-from django.db import connection
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
 
 import pytest
 
@@ -122,3 +125,37 @@ def test_0014_add_plans_profile_plan_null(user):
     profile = Profile.objects.get(pk=profile_pk)
     with pytest.raises(ValueError):
         profile.subscribed_plan = None
+
+
+@pytest.mark.django_db
+def test_0016_planinterval_one_in_use(user):
+    profile_pk = user.profile.pk
+    Profile, Plan, PlanInterval, ProfilePlanLog = migrate_to_and_get_models(
+        '0015_profile_created_on_behalf', 'Profile', 'Plan', 'PlanInterval', 'ProfilePlanLog')
+    profile = Profile.objects.get(pk=profile_pk)
+    plan = Plan.objects.get(id='free')
+    now = timezone.now()
+    older, newer = (PlanInterval.objects.create(profile=profile, plan=plan, duration=timedelta(days=1),
+                                                state='in_use', started_at=now - timedelta(hours=hours))
+                    for hours in (2, 1))
+
+    PlanInterval, ProfilePlanLog = migrate_to_and_get_models('0016_planinterval_one_in_use',
+                                                             'PlanInterval', 'ProfilePlanLog')
+    assert PlanInterval.objects.get(pk=older.pk).state == 'expired'
+    assert PlanInterval.objects.get(pk=newer.pk).state == 'in_use'
+    assert ProfilePlanLog.objects.get().interval_id == older.pk
+
+    with pytest.raises(IntegrityError), transaction.atomic():
+        PlanInterval.objects.filter(pk=older.pk).update(state='in_use')
+
+
+@pytest.mark.django_db
+def test_0025_entitlement_feed_sequence(user):
+    EntitlementChange, = migrate_to_and_get_models('0024_archivedprofileplanlog', 'EntitlementChange')
+    change = EntitlementChange.objects.create(user_id=user.id)
+
+    EntitlementChange, EntitlementFeed = migrate_to_and_get_models('0025_entitlement_feed_sequence',
+                                                                   'EntitlementChange', 'EntitlementFeed')
+    # Cursors handed out before stay valid
+    assert EntitlementChange.objects.get(pk=change.pk).sequence == change.pk
+    assert EntitlementFeed.objects.get().last_sequence >= change.pk
@@ -123,3 +123,31 @@ class TestPlanInterval:
         assert log.plan == best_plan
         assert log.interval == interval
         assert log.action == 'expired-interval'
+
+    def test_start_race(self, interval, profile_plan_log):
+        concurrent = PlanInterval.objects.get(pk=interval.pk)
+        assert concurrent.start()
+        assert not interval.start()
+        assert interval.state == 'in_use'
+        assert interval.started_at == concurrent.started_at
+        assert profile_plan_log.count() == 1
+
+    def test_start_other_interval_in_use(self, interval, profile_plan_log, user, best_plan):
+        other = PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(days=1))
+        other.save()
+        assert other.start()
+        assert not interval.start()
+        assert interval.state == 'pristine'
+        assert profile_plan_log.count() == 1
+        assert PlanInterval.get_or_start_interval(user.profile) == other
+
+    def test_check_expiry_race(self, interval, profile_plan_log, monkeypatch):
+        interval.start()
+        concurrent = PlanInterval.objects.get(pk=interval.pk)
+        into_the_future = interval.started_at + timedelta(days=2)
+        monkeypatch.setattr(timezone, 'now', lambda: into_the_future)
+
+        assert not concurrent.check_expiry()
+        assert not interval.check_expiry()
+        assert interval.state == 'expired'
+        assert profile_plan_log.filter(action='expired-interval').count() == 1
@@ -0,0 +1,135 @@
+import os
+from datetime import timedelta
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from . import block, monitoring
+from .models import PlanInterval, Profile
+from .test_rest import best_plan
+
+
+@pytest.fixture(autouse=True)
+def monitoring_cache(settings):
+    settings.CACHES = dict(settings.CACHES, monitoring={
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'monitoring',
+    })
+    settings.MONITORING_CACHE = 'monitoring'
+    cache = monitoring.get_cache()
+    cache.clear()
+    return cache
+
+
+def scrape():
+    """Return dict mapping (metric name, label values) to the values exported by ProfileStatsCollector."""
+    values = {}
+    for metric in monitoring.ProfileStatsCollector().collect():
+        for sample in metric.samples:
+            if not sample.name.endswith('_created'):
+                values[metric.name, tuple(sample.labels.values())] = sample.value
+    return values
+
+
+def test_scrape(user, best_plan):
+    Profile.objects.filter(user=user).update(subscribed_plan=best_plan)
+    PlanInterval.objects.create(profile=user.profile, plan=best_plan, duration=timedelta(days=1))
+    call_command('snapshot_stats')
+    values = scrape()
+    assert values['profile_count', ()] == 1
+    assert values['plan_intervals_count', ()] == 1
+    assert values['subscriptions_count', ('best_plan',)] == 1
+    assert values['stats_snapshot_age_seconds', ()] < 1
+
+
+def test_scrape_fresh(user, monitoring_cache, assert_num_queries):
+    call_command('snapshot_stats')
+    with assert_num_queries(0):
+        values = scrape()
+    assert values['profile_count', ()] == 1
+
+
+def test_scrape_almost_stale(user, monitoring_cache, settings, age):
+    call_command('snapshot_stats')
+    age(monitoring_cache, monitoring.SNAPSHOT_KEY, 'taken_at', timedelta(seconds=settings.MONITORING_STATS_MAX_AGE - 10))
+    assert scrape()['profile_count', ()] == 1
+
+
+def test_scrape_stale(user, monitoring_cache, age, assert_num_queries):
+    call_command('snapshot_stats')
+    User.objects.create_user('other')
+    age(monitoring_cache, monitoring.SNAPSHOT_KEY, 'taken_at', timedelta(hours=1))
+    # Scrapes never count, and don't export stale counts, only their age
+    with assert_num_queries(0):
+        values = scrape()
+    assert list(values) == [('stats_snapshot_age_seconds', ())]
+    assert values['stats_snapshot_age_seconds', ()] >= 3600
+    call_command('snapshot_stats')
+    assert scrape()['profile_count', ()] == 2
+
+
+@pytest.mark.django_db
+def test_scrape_no_snapshot(assert_num_queries):
+    with assert_num_queries(0):
+        assert scrape() == {}
+
+
+def test_metrics(client, user):
+    call_command('snapshot_stats')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert b'profile_count' in response.content
+    assert b'process_cpu_seconds_total' in response.content
+
+
+def test_metrics_multiprocess(client, user, tmpdir, monkeypatch):
+    monkeypatch.setattr(monitoring, 'MULTIPROC_DIR', str(tmpdir))
+    call_command('snapshot_stats')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content.count(b'Number of profiles') == 1
+    # Metrics of the scraped worker are not exported, only those in the directory
+    assert b'process_cpu_seconds_total' not in response.content
+
+
+def test_mark_worker_dead(tmpdir, monkeypatch, mocker):
+    mark_process_dead = mocker.patch('prometheus_client.multiprocess.mark_process_dead')
+    monitoring.mark_worker_dead()
+    assert not mark_process_dead.called
+    monkeypatch.setattr(monitoring, 'MULTIPROC_DIR', str(tmpdir))
+    monitoring.mark_worker_dead()
+    assert mark_process_dead.called
+
+
+def test_mark_worker_dead_gauges(tmpdir, monkeypatch):
+    monkeypatch.setattr(monitoring, 'MULTIPROC_DIR', str(tmpdir))
+    # Other modes keep the files of exited workers, which would pile up
+    assert block.circuit_open._multiprocess_mode == 'liveall'
+    gauge_file = tmpdir.join('gauge_liveall_%d.db' % os.getpid())
+    MmapedDict(str(gauge_file)).close()
+    monitoring.mark_worker_dead()
+    assert not gauge_file.exists()
+
+
+def test_compact_worker_files(tmpdir):
+    path = str(tmpdir)
+    key = mmap_key('requests', 'requests_total', ['view'], ['foo'], 'Requests')
+    for pid, value in ((1, 2), (2, 3), (3, 4)):
+        values = MmapedDict(os.path.join(path, 'counter_%d.db' % pid))
+        values.write_value(key, value, 0)
+        values.close()
+
+    def exported():
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, path=path)
+        return registry.get_sample_value('requests_total', {'view': 'foo'})
+    monitoring.compact_worker_files(1, path)
+    monitoring.compact_worker_files(2, path)
+    assert sorted(name for name in os.listdir(path) if name.endswith('.db')) == ['counter_3.db', 'counter_archive.db']
+    assert exported() == 9
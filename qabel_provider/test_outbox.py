@@ -0,0 +1,93 @@
+from datetime import timedelta
+from smtplib import SMTPException
+
+import pytest
+
+from django.core import mail
+from django.utils import timezone
+
+from . import outbox
+from .models import OutgoingMail
+
+
+@pytest.fixture
+def queued(db):
+    def enqueue(number=1):
+        for i in range(number):
+            message = mail.EmailMultiAlternatives('Subject %d' % i, 'Body', 'noreply@example.com',
+                                                  ['to@example.com'], cc=['cc@example.com'])
+            message.attach_alternative('<p>Body</p>', 'text/html')
+            outbox.enqueue(message)
+    return enqueue
+
+
+def test_send_pending(queued):
+    queued(3)
+    assert not mail.outbox
+    assert outbox.send_pending() == (3, 0)
+    assert [message.subject for message in mail.outbox] == ['Subject 0', 'Subject 1', 'Subject 2']
+    message = mail.outbox[0]
+    assert message.to == ['to@example.com']
+    assert message.cc == ['cc@example.com']
+    assert message.alternatives == [('<p>Body</p>', 'text/html')]
+    assert not OutgoingMail.objects.filter(state='pending')
+    # Bodies may contain live tokens
+    assert set(OutgoingMail.objects.values_list('body', 'html_body')) == {('', '')}
+    assert outbox.send_pending() == (0, 0)
+
+
+def test_send_pending_batch_size(queued):
+    queued(3)
+    assert outbox.send_pending(batch_size=2) == (2, 0)
+    assert outbox.send_pending(batch_size=2) == (1, 0)
+
+
+def test_send_pending_one_connection(queued, mocker):
+    queued(3)
+    connection = mail.get_connection()
+    opened = mocker.spy(connection, 'open')
+    outbox.send_pending(connection=connection)
+    assert opened.call_count == 1
+    assert len(mail.outbox) == 3
+
+
+def test_send_pending_reconnect(queued, mocker):
+    queued(3)
+    connection = mail.get_connection()
+    mocker.patch.object(connection, 'send_messages', side_effect=[SMTPException('Broken pipe'), 1, 1])
+    opened = mocker.spy(connection, 'open')
+    assert outbox.send_pending(connection=connection) == (2, 1)
+    # The connection is reopened once after the failure, not per mail
+    assert opened.call_count == 2
+
+
+def test_claimed_mails_hidden(queued):
+    queued(1)
+    assert len(outbox.claim(10)) == 1
+    assert not outbox.claim(10)
+
+
+def test_retry_backoff(queued, monkeypatch):
+    queued(1)
+
+    def explode(self, messages):
+        raise SMTPException('Try again later')
+    monkeypatch.setattr(mail.get_connection().__class__, 'send_messages', explode)
+
+    for attempt in range(1, outbox.MAX_ATTEMPTS):
+        assert outbox.send_pending() == (0, 1)
+        queued_mail = OutgoingMail.objects.get()
+        assert queued_mail.state == 'pending'
+        assert queued_mail.attempts == attempt
+        assert queued_mail.next_attempt_at > timezone.now() + outbox.retry_delay(attempt) - timedelta(seconds=5)
+        OutgoingMail.objects.update(next_attempt_at=timezone.now())
+
+    assert outbox.send_pending() == (0, 1)
+    queued_mail = OutgoingMail.objects.get()
+    assert (queued_mail.state, queued_mail.body) == ('failed', '')
+
+
+def test_retry_delay():
+    assert outbox.retry_delay(1) == outbox.RETRY_DELAY
+    assert outbox.retry_delay(2) == 2 * outbox.RETRY_DELAY
+    assert outbox.retry_delay(100) == outbox.MAX_RETRY_DELAY
@@ -0,0 +1,67 @@
+import pytest
+
+from prometheus_client import REGISTRY
+
+from . import phases
+from .models import Entitlement
+
+
+@pytest.fixture
+def observed():
+    """Return a function returning the (calls, queries) observed for a phase and status since the fixture was set up."""
+    def sample(metric, phase, status):
+        return REGISTRY.get_sample_value(metric, {'phase': phase, 'status': status}) or 0
+
+    def totals(phase, status):
+        return (sample('auth_resource_phase_queries_count', phase, status),
+                sample('auth_resource_phase_queries_sum', phase, status))
+    before = {(phase, status): totals(phase, status)
+              for phase in phases.PHASES for status in ('200', '400', '403', '404')}
+
+    def delta(phase, status):
+        calls, queries = totals(phase, status)
+        calls_before, queries_before = before[phase, status]
+        return calls - calls_before, queries - queries_before
+    return delta
+
+
+def test_phases(external_api_client, auth_resource_path, token, observed):
+    # Users without an up to date Entitlement row run through every phase
+    Entitlement.objects.all().delete()
+    response = external_api_client.post(auth_resource_path, {'auth': 'Token {}'.format(token)})
+    assert response.status_code == 200
+    for phase in phases.PHASES:
+        assert observed(phase, '200')[0] == 1, phase
+    assert observed('api_key', '200') == (1, 0)
+    assert observed('lookup', '200')[1] > 0
+    assert observed('serialization', '200') == (1, 0)
+
+
+def test_phases_cached(external_api_client, auth_resource_path, token, observed):
+    Entitlement.objects.all().delete()
+    for _ in range(2):
+        external_api_client.post(auth_resource_path, {'auth': 'Token {}'.format(token)})
+    # The second answer is cached, it doesn't run the confirmation check nor touches intervals
+    assert observed('lookup', '200')[0] == 2
+    assert observed('confirmation', '200')[0] == 1
+    assert observed('intervals', '200')[0] == 1
+
+
+@pytest.mark.parametrize('payload,status', (
+    ({}, '400'),
+    ({'user_id': 0}, '404'),
+))
+def test_phases_errors(external_api_client, auth_resource_path, observed, payload, status):
+    response = external_api_client.post(auth_resource_path, payload)
+    assert str(response.status_code) == status
+    assert observed('api_key', status)[0] == 1
+    assert observed('lookup', status)[0] == 1
+    assert observed('serialization', status)[0] == 0
+
+
+@pytest.mark.django_db
+def test_phases_invalid_api_key(api_client, auth_resource_path, observed):
+    response = api_client.post(auth_resource_path, {'user_id': 1}, HTTP_APISECRET='wrong')
+    assert response.status_code == 403
+    assert observed('api_key', '403')[0] == 1
+    assert observed('lookup', '403')[0] == 0
@@ -0,0 +1,159 @@
+import json
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.db import IntegrityError
+from allauth.account.models import EmailAddress
+
+from .middleware import QueryBudgetExceeded
+from .models import OutgoingMail
+from .provisioning import create_users
+from .test_rest import send_queued_mail
+from .utils import allocate_usernames
+
+
+def record(email, **fields):
+    return dict({'email': email, 'newsletter': True, 'language': 'Deutsch'}, **fields)
+
+
+def test_register_bulk(register_bulk, user, send_queued_mail):
+    results = register_bulk(
+        record('manfred@example.net', secondary_emails=['mmueller@example.com']),
+        record(user.email),
+        '',
+        record('manfred@example.com', first_name='Manfred'),
+        record('not an address'),
+        '{"email": ',
+        record('manfred@example.net'),
+    )
+    assert [(result['line'], result['status']) for result in results] == [
+        (1, 'Account created'),
+        (2, 'Account exists'),
+        (4, 'Account created'),
+        (5, 'Invalid record'),
+        (6, 'Malformed record'),
+        (7, 'Account exists'),
+    ]
+    assert results[0]['username'] == 'manfred'
+    assert results[2]['username'] == 'manfred1'
+    assert 'email' in results[3]['errors']
+
+    manfred = User.objects.get(username='manfred1')
+    assert manfred.first_name == 'Manfred'
+    assert manfred.profile.created_on_behalf
+    assert manfred.has_usable_password()
+    assert EmailAddress.objects.get(email='mmueller@example.com', primary=False, verified=True).user.username == 'manfred'
+
+    assert OutgoingMail.objects.count() == 2
+    send_queued_mail()
+    sent = {sent_mail.to[0]: sent_mail for sent_mail in mail.outbox}
+    assert sent['manfred@example.net'].cc == ['mmueller@example.com']
+    assert ' manfred1\n' in sent['manfred@example.com'].body
+    assert '/accounts/reset/' in sent['manfred@example.com'].body
+
+
+def test_register_bulk_password_link(register_bulk, api_client, send_queued_mail):
+    register_bulk(record('foo@example.net'))
+    send_queued_mail()
+    body = mail.outbox.pop().body
+    url = body[body.find('/accounts/reset/'):].split(maxsplit=1)[0]
+    response = api_client.post(url, {'new_password1': 'testpassword', 'new_password2': 'testpassword'})
+    assert response.status_code == 302
+    response = api_client.post('/api/v0/auth/login/', {'username': 'foo', 'password': 'testpassword'})
+    assert response.status_code == 200
+
+
+def test_register_bulk_queries(register_bulk, queries_for):
+    def register(emails):
+        results = register_bulk(*[record(email) for email in emails])
+        assert all(result['status'] == 'Account created' for result in results)
+
+    # Warm up caches like the one of the current site
+    register_bulk(record('warm@example.net'))
+    one = queries_for(register, ['a@example.net'])
+    assert len(queries_for(register, ['b%d@example.net' % i for i in range(20)])) == len(one)
+
+
+def test_register_bulk_chunks(register_bulk, monkeypatch):
+    monkeypatch.setattr('qabel_provider.provisioning.BATCH_SIZE', 2)
+    results = register_bulk(*[record('foo@example.net')] * 3 + [record('foo@example.com')])
+    assert [result['status'] for result in results] == ['Account created'] + ['Account exists'] * 2 + ['Account created']
+    assert results[3]['username'] == 'foo1'
+
+
+def test_register_bulk_email_addresses(register_bulk, user):
+    EmailAddress.objects.create(user=user, email='Secondary@example.com', primary=False, verified=True)
+    results = register_bulk(
+        record('secondary@example.com'),
+        record('foo@example.net', secondary_emails=['SECONDARY@example.com']),
+        record('bar@example.net', secondary_emails=['shared@example.net', 'bar@example.net']),
+        record('baz@example.net', secondary_emails=['Shared@example.net']),
+        record('shared@example.net'),
+    )
+    assert [result['status'] for result in results] == [
+        'Account exists', 'Account exists', 'Account created', 'Account exists', 'Account exists']
+    assert list(EmailAddress.objects.filter(user__username='bar').order_by('pk').values_list('email', 'primary')) == [
+        ('bar@example.net', True), ('shared@example.net', False)]
+
+
+def test_register_bulk_failed(register_bulk, monkeypatch):
+    monkeypatch.setattr('qabel_provider.provisioning.BATCH_SIZE', 2)
+
+    def taken_username(records):
+        if records[0].email == 'baz@example.net':
+            raise IntegrityError
+        return create_users(records)
+    monkeypatch.setattr('qabel_provider.provisioning.create_users', taken_username)
+    results = register_bulk(record('foo@example.net'), record('bar@example.net'),
+                            record('baz@example.net'), record('foo@example.net'))
+    # The first chunk is registered, the second one is reported as failed instead of aborting the response
+    assert [result['status'] for result in results] == [
+        'Account created', 'Account created', 'Registration failed', 'Account exists']
+    assert results[2]['email'] == 'baz@example.net'
+    assert not User.objects.filter(email='baz@example.net')
+
+
+def test_register_bulk_limit(external_api_client, register_bulk_path, monkeypatch):
+    monkeypatch.setattr('qabel_provider.provisioning.LIMIT', 2)
+    body = '\n'.join(json.dumps(record('foo%d@example.net' % i)) for i in range(3))
+    response = external_api_client.post(register_bulk_path, body, content_type='application/x-ndjson')
+    assert response.status_code == 400
+    assert not User.objects.filter(email='foo0@example.net')
+
+
+def test_register_bulk_query_budget(register_bulk, settings):
+    # Accounts are registered before the response, so their queries count towards the budget of the request
+    settings.QUERY_BUDGETS = dict(settings.QUERY_BUDGETS, **{'api-register-bulk': (5, 10)})
+    with pytest.raises(QueryBudgetExceeded):
+        register_bulk(record('foo@example.net'))
+
+
+def test_register_on_behalf_secondary_taken(external_api_client, register_on_behalf_path, register_bulk, user):
+    EmailAddress.objects.create(user=user, email='taken@example.net', primary=False, verified=True)
+    taken = record('foo@example.net', secondary_emails=['Taken@example.net'])
+    response = external_api_client.post(register_on_behalf_path, taken, format='json')
+    assert response.json()['status'] == 'Account exists'
+    assert register_bulk(taken)[0]['status'] == 'Account exists'
+    assert not User.objects.filter(email='foo@example.net')
+
+
+def test_register_bulk_empty(register_bulk):
+    assert register_bulk() == []
+
+
+@pytest.mark.django_db
+def test_register_bulk_requires_api_key(api_client, register_bulk_path):
+    response = api_client.post(register_bulk_path, json.dumps(record('foo@example.net')),
+                               content_type='application/x-ndjson')
+    assert response.status_code == 403
+    assert not User.objects.filter(email='foo@example.net')
+
+
+def test_allocate_usernames(user):
+    User.objects.create_user('foo')
+    User.objects.create_user('foo2')
+    User.objects.create_user('foobar')
+    assert allocate_usernames(['foo@example.net', 'foo@example.com', 'foo@example.org', 'bar@example.net']) == \
+        ['foo1', 'foo3', 'foo4', 'bar']
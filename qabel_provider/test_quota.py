@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+import pytest
+
+from django.core.cache import cache
+
+from . import quota, views
+from .block import BlockUnavailable
+
+
+@pytest.fixture(autouse=True)
+def quota_cache(settings):
+    settings.CACHES = dict(settings.CACHES, default={
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'quota',
+    })
+    cache.clear()
+
+
+@pytest.fixture
+def block_quota(mocker):
+    return mocker.patch('qabel_provider.quota.get_block_quota_of_user', return_value=(100, 10))
+
+
+def test_fresh(user, block_quota):
+    used, updated_at = quota.get_used_quota(user)
+    assert used == 10
+    assert not quota.is_stale(updated_at)
+    assert quota.get_used_quota(user) == (used, updated_at)
+    assert block_quota.call_count == 1
+
+
+def test_stale_refresh(user, block_quota, age):
+    quota.get_used_quota(user)
+    age(cache, quota.cache_key(user.id), 'updated_at', quota.FRESH)
+    block_quota.return_value = (100, 20)
+    used, updated_at = quota.get_used_quota(user)
+    assert used == 20
+    assert not quota.is_stale(updated_at)
+
+
+def test_stale_single_flight(user, block_quota, age):
+    quota.get_used_quota(user)
+    age(cache, quota.cache_key(user.id), 'updated_at', quota.FRESH)
+    # Another worker is refreshing
+    cache.add(quota.lock_key(user.id), True)
+    block_quota.return_value = (100, 20)
+    used, updated_at = quota.get_used_quota(user)
+    assert used == 10
+    assert quota.is_stale(updated_at)
+    assert block_quota.call_count == 1
+
+
+@pytest.mark.parametrize('error', (BlockUnavailable('down'), ValueError('bad response')))
+def test_stale_block_down(user, block_quota, error, age):
+    quota.get_used_quota(user)
+    age(cache, quota.cache_key(user.id), 'updated_at', timedelta(hours=1))
+    block_quota.side_effect = error
+    used, updated_at = quota.get_used_quota(user)
+    assert used == 10
+    assert quota.is_stale(updated_at)
+    # The lock delays the next attempt
+    quota.get_used_quota(user)
+    assert block_quota.call_count == 2
+
+
+def test_unknown(user, block_quota):
+    block_quota.side_effect = BlockUnavailable('down')
+    assert quota.get_used_quota(user) == (0, None)
+    assert quota.is_stale(None)
+
+
+def test_profile_page(user, block_quota, rf):
+    # The profile URLs are disabled by default (FACET_USER_PROFILE)
+    request = rf.get('/')
+    request.user = user
+    response = views.user_profile(request)
+    assert response.context_data['block_used'] == 10
+    assert not response.context_data['block_used_stale']
@@ -7,11 +7,13 @@ import pytest
 
 from django.utils import timezone
 from django.core import mail
+from django.core.management import call_command
 from django.db import DatabaseError
 from django.contrib.auth.models import User
 from allauth.account.models import EmailConfirmation, EmailAddress
 
-from .models import Plan, PlanInterval, ProfilePlanLog, Profile
+from . import entitlements, views
+from .models import Plan, PlanInterval, ProfilePlanLog, Profile, OutgoingMail
 
 
 def loads(foo):
@@ -27,23 +29,10 @@ def write_mail(tests_output_path):
 
 
 @pytest.fixture
-def auth_resource_path():
-    return '/api/v0/internal/user/'
-
-
-@pytest.fixture
-def register_on_behalf_path():
-    return '/api/v0/internal/user/register/'
-
-
-@pytest.fixture
-def plan_subscription_path():
-    return '/api/v0/plan/subscription/'
-
-
-@pytest.fixture
-def plan_interval_path():
-    return '/api/v0/plan/add-interval/'
+def send_queued_mail():
+    def send():
+        call_command('send_queued_mail')
+    return send
 
 
 @pytest.mark.django_db
@@ -182,6 +171,7 @@ def test_auth_resource(user, call_auth_resource):
     plan = user.profile.plan
     assert data['block_quota'] == plan.block_quota
     assert data['monthly_traffic_quota'] == plan.monthly_traffic_quota
+    assert not data['over_quota']
 
 
 def test_auth_resource_with_disabled_user(call_auth_resource, user):
@@ -194,6 +184,91 @@ def test_auth_resource_with_disabled_user(call_auth_resource, user):
     assert data['active'] is False
 
 
+# Number of queries of the auth_resource branches, make sure to understand what changed before adjusting these.
+# Up to date answers are read from the Entitlement row with one query (token or user with profile and row).
+# Otherwise resolving the user takes three more queries (user with profile and plan, primary email, plan intervals),
+# and state transitions cost queries of their own plus rewriting the row (and recording the change, see the feed).
+# Tests run on_commit callbacks right away (see conftest), so start-interval includes the four queries of the refresh
+# scheduled by the transition, which is skipped after commits (see test_entitlement_row_once_per_auth_call).
+AUTH_RESOURCE_QUERIES = {
+    'active': 1,
+    'start-interval': 14,
+    'inactive': 1,
+    'not-found': 1,
+    'malformed': 0,
+    'cached': 0,
+}
+
+
+def test_auth_resource_queries(user, call_auth_resource, assert_num_queries):
+    with assert_num_queries(AUTH_RESOURCE_QUERIES['active']):
+        response = call_auth_resource()
+    assert response.status_code == 200
+    assert response.json()['active']
+
+    # Found by token, users invalidated recently (here: created) are cached by the second call, see entitlements.store
+    call_auth_resource()
+    with assert_num_queries(AUTH_RESOURCE_QUERIES['cached']):
+        response = call_auth_resource()
+    assert response.status_code == 200
+
+
+def test_auth_resource_queries_interval(user, call_auth_resource, assert_num_queries, best_plan):
+    PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(days=1)).save()
+    with assert_num_queries(AUTH_RESOURCE_QUERIES['start-interval']):
+        response = call_auth_resource()
+    assert response.json()['block_quota'] == best_plan.block_quota
+
+    entitlements.invalidate_user(user.id)
+    with assert_num_queries(AUTH_RESOURCE_QUERIES['active']):
+        response = call_auth_resource()
+    assert response.json()['block_quota'] == best_plan.block_quota
+
+
+def test_auth_resource_queries_inactive(user, call_auth_resource, assert_num_queries):
+    user.is_active = False
+    user.save()
+    user.profile.next_confirmation_mail = timezone.now() + timedelta(hours=1)
+    user.profile.save()
+    with assert_num_queries(AUTH_RESOURCE_QUERIES['inactive']):
+        response = call_auth_resource()
+    assert response.status_code == 200
+    assert not response.json()['active']
+    assert not mail.outbox
+
+
+@pytest.mark.parametrize('payload', ({'auth': 'Token foobar'}, {'user_id': 1234}))
+def test_auth_resource_queries_not_found(external_api_client, auth_resource_path, assert_num_queries, payload):
+    with assert_num_queries(AUTH_RESOURCE_QUERIES['not-found']):
+        response = external_api_client.post(auth_resource_path, payload)
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('payload', ({}, {'auth': 'Foobar baz'}, {'user_id': 'foo'}))
+def test_auth_resource_queries_malformed(external_api_client, auth_resource_path, assert_num_queries, payload):
+    with assert_num_queries(AUTH_RESOURCE_QUERIES['malformed']):
+        response = external_api_client.post(auth_resource_path, payload)
+    assert response.status_code == 400
+
+
+def test_auth_resource_queries_wrong_secret(client, auth_resource_path, assert_num_queries):
+    with assert_num_queries(0):
+        response = client.post(auth_resource_path, HTTP_APISECRET='wrong')
+    assert response.status_code == 403
+
+
+def test_auth_resource_batch_queries(external_api_client, user, token, auth_resource_batch_path, assert_num_queries):
+    users = [User.objects.create_user('user%d' % i, 'user%d@example.com' % i, 'password') for i in range(5)]
+    for other_user in users:
+        EmailAddress.objects.create(user=other_user, email=other_user.email, primary=True)
+    payload = {'users': [{'user_id': other_user.id} for other_user in users] + [{'auth': 'Token {}'.format(token)}]}
+    # One query per kind of identification, nothing per user
+    with assert_num_queries(2):
+        response = external_api_client.post(auth_resource_batch_path, payload, format='json')
+    assert response.status_code == 200
+    assert [result['status'] for result in response.json()['users']] == [200] * 6
+
+
 def test_auth_resource_invalid_auth_type(external_api_client, token, auth_resource_path):
     response = external_api_client.post(auth_resource_path, {'auth': 'Foobar {}'.format(token)})
     assert response.status_code == 400
@@ -222,7 +297,8 @@ def test_auth_resource_no_body(external_api_client, auth_resource_path):
     assert data['error']
 
 
-def test_failed_auth_resource_after_7_days(external_api_client, user, token, auth_resource_path, write_mail):
+def test_failed_auth_resource_after_7_days(external_api_client, user, token, auth_resource_path, write_mail,
+                                           send_queued_mail):
     user.profile.needs_confirmation_after = timezone.now() - timedelta(days=7)
     user.profile.save()
     user.profile.refresh_from_db()
@@ -231,6 +307,9 @@ def test_failed_auth_resource_after_7_days(external_api_client, user, token, aut
     assert response.status_code == 200
     data = loads(response.content)
     assert data['active'] is False
+    # Mails are queued, not sent on the request path
+    assert not mail.outbox
+    send_queued_mail()
     assert len(mail.outbox) == 1
     assert mail.outbox[0].subject.startswith('[example.com]')
     assert 'English version below.' in mail.outbox[0].body
@@ -240,6 +319,7 @@ def test_failed_auth_resource_after_7_days(external_api_client, user, token, aut
     data = loads(response.content)
     assert data['active'] is False
     assert response.status_code == 200
+    send_queued_mail()
     assert len(mail.outbox) == 1
 
     # Check, that a new mail is send after 24 hours
@@ -248,6 +328,7 @@ def test_failed_auth_resource_after_7_days(external_api_client, user, token, aut
     user.profile.refresh_from_db()
     response = external_api_client.post(auth_resource_path, request_body)
     assert response.status_code == 200
+    send_queued_mail()
     assert len(mail.outbox) == 2
     write_mail('email-confirm-repeated', outbox_index=-1)
 
@@ -276,31 +357,47 @@ def test_confirmation_mail_race1(external_api_client, token, auth_resource_path,
     assert len(mail.outbox) == 0
 
 
-def test_confirmation_mail_rollback(external_api_client, token, auth_resource_path, monkeypatch, user_needing_confirmation):
-    # Mail sending explodes after updating the mail state; mail state must be restored to pristinity.
+def test_confirmation_mail_retry(external_api_client, token, auth_resource_path, monkeypatch, user_needing_confirmation,
+                                 send_queued_mail):
+    # Mail sending explodes in the outbox worker; the mail is kept and retried later.
 
-    def explode(self):
+    def explode(self, messages):
         raise SMTPException('Have you in fact got any cheese here at all? ')
 
-    monkeypatch.setattr(Profile, 'send_confirmation_mail', explode)
-
-    profile = user_needing_confirmation.profile
-    original_state = profile.next_confirmation_mail
+    monkeypatch.setattr(mail.get_connection().__class__, 'send_messages', explode)
 
     request_body = {'auth': 'Token {}'.format(token)}
     response = external_api_client.post(auth_resource_path, request_body)
     assert response.status_code == 200
     data = loads(response.content)
     assert data['active'] is False
+    send_queued_mail()
     assert len(mail.outbox) == 0
+    monkeypatch.undo()
 
-    profile.refresh_from_db()
-    rollback_state = profile.next_confirmation_mail
-    assert rollback_state == original_state
+    queued = OutgoingMail.objects.get()
+    assert queued.state == 'pending'
+    assert queued.attempts == 1
+    assert 'cheese' in queued.last_error
+    assert queued.next_attempt_at > timezone.now()
+
+    # Not sent again before the retry is due, nor is a second mail queued
+    response = external_api_client.post(auth_resource_path, request_body)
+    assert response.status_code == 200
+    send_queued_mail()
+    assert len(mail.outbox) == 0
+    assert OutgoingMail.objects.count() == 1
+
+    OutgoingMail.objects.update(next_attempt_at=timezone.now())
+    send_queued_mail()
+    assert len(mail.outbox) == 1
+    queued.refresh_from_db()
+    assert queued.state == 'sent'
+    assert queued.attempts == 2
 
 
 @pytest.fixture
-def register_on_behalf_base(external_api_client, register_on_behalf_path, auth_resource_path):
+def register_on_behalf_base(external_api_client, register_on_behalf_path, auth_resource_path, send_queued_mail):
     def subtest():
         email = 'manfred@example.net'
         username = 'manfred'
@@ -313,6 +410,7 @@ def register_on_behalf_base(external_api_client, register_on_behalf_path, auth_r
         data = response.json()
         assert response.status_code == 200, data
         assert data['status'] == 'Account created'
+        send_queued_mail()
         user = User.objects.get(email='manfred@example.net')
         profile = user.profile
         assert user.is_active
@@ -362,6 +460,18 @@ def test_register_on_behalf_exists_external(external_api_client, register_on_beh
     assert response.json()['status'] == 'Account exists'
 
 
+@pytest.mark.django_db
+def test_register_on_behalf_exists_case(external_api_client, register_on_behalf_path, user):
+    response = external_api_client.post(register_on_behalf_path, {
+        'email': user.email.upper(),
+        'newsletter': True,
+        'language': 'Deutscher-mit-Umlauten',
+    })
+    assert response.status_code == 200, response.json()
+    assert response.json()['status'] == 'Account exists'
+    assert User.objects.count() == 1
+
+
 @pytest.mark.django_db
 def test_register_on_behalf_dup(external_api_client, register_on_behalf_path, register_on_behalf_base):
     # Compat: "username" is ignored
@@ -405,7 +515,7 @@ def test_register_on_behalf_email(api_client, register_on_behalf_base, write_mai
 
 
 @pytest.mark.django_db
-def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_path, write_mail):
+def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_path, write_mail, send_queued_mail):
     email = 'manfred@example.net'
     secondary_mail = 'mmueller@example.com'
     response = external_api_client.post(register_on_behalf_path, {
@@ -416,6 +526,7 @@ def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_pat
     })
     data = response.json()
     assert response.status_code == 200, data
+    send_queued_mail()
 
     write_mail('register-on-behalf-with-cc')
     sent_mail = mail.outbox.pop()
@@ -424,7 +535,7 @@ def test_register_on_behalf_email_cc(external_api_client, register_on_behalf_pat
     assert secondary_mail in sent_mail.cc
 
 
-def test_register_on_behalf_no_username(external_api_client, register_on_behalf_path):
+def test_register_on_behalf_no_username(external_api_client, register_on_behalf_path, send_queued_mail):
     email = 'foo@example.net'
     response = external_api_client.post(register_on_behalf_path, {
         'email': email,
@@ -434,6 +545,8 @@ def test_register_on_behalf_no_username(external_api_client, register_on_behalf_
     assert response.status_code == 200, response.json()
     assert response.json()['status'] == 'Account created'
     assert User.objects.filter(email=email)
+    assert not mail.outbox
+    send_queued_mail()
     assert mail.outbox
 
 
@@ -450,20 +563,24 @@ def test_register_on_behalf_invalid_mail(external_api_client, register_on_behalf
     assert not mail.outbox
 
 
-def test_register_on_behalf_smtp_error(external_api_client, register_on_behalf_path, monkeypatch):
-    def erroring_send(self):
+def test_register_on_behalf_smtp_error(external_api_client, register_on_behalf_path, monkeypatch, send_queued_mail):
+    def erroring_send(self, messages):
         raise SMTPRecipientsRefused(['foo@bar'])
-    monkeypatch.setattr(mail.EmailMultiAlternatives, 'send', erroring_send)
+    monkeypatch.setattr(mail.get_connection().__class__, 'send_messages', erroring_send)
     response = external_api_client.post(register_on_behalf_path, {
         'email': 'foo@example.com',
         'username': 'asdf',
         'newsletter': True,
         'language': 'Deutsch-mit-Umlauten',
     })
-    assert response.status_code == 400, response.json()
-    status = response.json()['status']
-    assert 'SMTP error' in status
-    assert not User.objects.filter(username='foo')
+    # Mail is sent by the outbox, so the registration doesn't depend on the mail server
+    assert response.status_code == 200, response.json()
+    assert User.objects.filter(username='foo')
+    send_queued_mail()
+    queued = OutgoingMail.objects.get()
+    # Refused recipients are not retried
+    assert queued.state == 'failed'
+    assert 'SMTPRecipientsRefused' in queued.last_error
 
 
 @pytest.fixture
@@ -507,10 +624,11 @@ def test_request_id_untrusted(capfd, api_client, patched_uuid):
 
 
 protected_apis = pytest.mark.parametrize('path', (
-    auth_resource_path(),
-    register_on_behalf_path(),
-    plan_subscription_path(),
-    plan_interval_path(),
+    '/api/v0/internal/user/',
+    '/api/v0/internal/user/batch/',
+    '/api/v0/internal/user/register/',
+    '/api/v0/plan/subscription/',
+    '/api/v0/plan/add-interval/',
 ))
 
 
@@ -587,7 +705,9 @@ def test_confirm_invalid_email(token, mocker, user, external_api_client, auth_re
     request_body = {'auth': 'Token {}'.format(token)}
     response = external_api_client.post(auth_resource_path, request_body)
     assert response.status_code == 200
-    send_mail.assert_called_with(fail_silently=True)
+    # The confirmation mail is queued, the mail server is not contacted on the request path
+    assert not send_mail.called
+    assert OutgoingMail.objects.get().to == user.email
 
 
 def test_api_root(api_client):
@@ -603,9 +723,11 @@ def test_no_login_throttle(api_client, user):
 
 
 @pytest.mark.django_db
-def test_password_reset(api_client, user, write_mail):
+def test_password_reset(api_client, user, write_mail, send_queued_mail):
     response = api_client.post('/api/v0/auth/password/reset/', {'email': user.email})
     assert response.status_code == 200
+    assert not mail.outbox
+    send_queued_mail()
     assert len(mail.outbox) == 1
     mail_body = mail.outbox[0].body
     write_mail('reset')
@@ -620,6 +742,16 @@ def test_password_reset(api_client, user, write_mail):
     assert response.status_code == 200
 
 
+@pytest.mark.django_db
+def test_password_reset_web(client, user, send_queued_mail):
+    response = client.post('/accounts/password_reset/', {'email': user.email})
+    assert response.status_code == 302
+    assert not mail.outbox
+    send_queued_mail()
+    assert len(mail.outbox) == 1
+    assert '/accounts/reset/' in mail.outbox[0].body
+
+
 @pytest.mark.django_db
 def test_enable_disabled_user(api_client, user, token):
     user.profile.needs_confirmation_after = timezone.now() - timedelta(days=7)
@@ -631,6 +763,19 @@ def test_enable_disabled_user(api_client, user, token):
     assert not user.profile.check_confirmation_and_send_mail()
 
 
+@pytest.mark.django_db
+def test_confirmation_mail_no_primary_email(user):
+    user.profile.needs_confirmation_after = timezone.now() - timedelta(days=7)
+    user.profile.save()
+    EmailAddress.objects.filter(user=user).delete()
+    profile = Profile.objects.get(user=user)
+    assert profile.check_confirmation_and_send_mail()
+    profile.send_confirmation_mail()
+    assert not OutgoingMail.objects.exists()
+    profile.refresh_from_db()
+    assert profile.next_confirmation_mail is None
+
+
 @pytest.fixture
 def require_audit_log(user):
     def num_log_entries():
@@ -688,6 +833,29 @@ def test_plan_subscription(external_api_client, plan_subscription_path, best_pla
     assert user.profile.plan.id == best_plan.id
 
 
+@pytest.mark.django_db
+def test_plan_subscription_email_case(external_api_client, plan_subscription_path, best_plan, user):
+    response = external_api_client.post(plan_subscription_path, {
+        'user_email': 'QabelUser@Example.com',
+        'plan': best_plan.id,
+    })
+    assert response.status_code == 200, response.json()
+    user.profile.refresh_from_db()
+    assert user.profile.plan.id == best_plan.id
+
+
+def test_plan_subscription_shared_email(external_api_client, plan_subscription_path, best_plan, user):
+    User.objects.create_user('twin', email=user.email.upper())
+    response = external_api_client.post(plan_subscription_path, {
+        'user_email': user.email,
+        'plan': best_plan.id,
+    })
+    assert response.status_code == 400, response.json()
+    assert response.json()['user_email'] == ['Several users with this email.']
+    user.profile.refresh_from_db()
+    assert user.profile.plan.id == 'free'
+
+
 @pytest.mark.django_db
 def test_plan_subscription_plan_missing(external_api_client, plan_subscription_path, user):
     assert user.profile.plan.id == 'free'
@@ -809,3 +977,87 @@ def test_plan_interval_expiry(external_api_client, plan_interval_path, best_plan
     assert profile.plan.id == 'free'
     require_audit_log(num_entries=1)
     require_interval_state('expired')
+
+
+@pytest.fixture
+def history(user, best_plan):
+    """Return function adding *count* interval events to the history of *user*, oldest first."""
+    def add(count):
+        for n in range(count):
+            interval = PlanInterval.objects.create(profile=user.profile, plan=best_plan, duration=timedelta(days=n + 1))
+            ProfilePlanLog.objects.create(profile=user.profile, action='add-interval', plan=best_plan,
+                                          interval=interval, origin='test')
+        return list(ProfilePlanLog.objects.filter(profile=user.profile).order_by('-timestamp', '-id'))
+    return add
+
+
+def history_pages(client, limit):
+    events = []
+    params = {'limit': limit}
+    while True:
+        response = client.get('/api/v0/account/history/', params)
+        assert response.status_code == 200, response.json()
+        data = response.json()
+        assert len(data['events']) <= limit
+        events += data['events']
+        if not data['cursor']:
+            return events
+        params['before'] = data['cursor']
+
+
+def test_account_history(user_client, history, best_plan):
+    events = history(5)
+    pages = history_pages(user_client, limit=2)
+    assert [event['description'] for event in pages] == \
+        ['Prepaid plan best plan of duration %s added' % event.interval.duration for event in events]
+    assert {event['action'] for event in pages} == {'add-interval'}
+    assert {event['plan'] for event in pages} == {best_plan.id}
+
+
+def test_account_history_same_timestamp(user_client, history):
+    events = history(5)
+    ProfilePlanLog.objects.update(timestamp=timezone.now())
+    pages = history_pages(user_client, limit=2)
+    assert len(pages) == len(events)
+    assert len({event['description'] for event in pages}) == len(events)
+
+
+def test_account_history_queries(user_client, history, queries_for):
+    def get_page():
+        assert user_client.get('/api/v0/account/history/', {'limit': 10}).status_code == 200
+
+    history(2)
+    few = queries_for(get_page)
+    history(20)
+    assert len(queries_for(get_page)) == len(few)
+
+
+@pytest.mark.parametrize('params', ({'before': 'yesterday'}, {'before': '9' * 30 + '-1'},
+                                    {'before': '1-' + '9' * 30}, {'limit': 0}, {'limit': 'all'}))
+def test_account_history_malformed(user_client, params):
+    response = user_client.get('/api/v0/account/history/', params)
+    assert response.status_code == 400
+
+
+def test_account_history_requires_login(api_client):
+    response = api_client.get('/api/v0/account/history/')
+    assert response.status_code in (401, 403)
+
+
+def test_history_page(user, history, rf, monkeypatch):
+    # The profile URLs are disabled by default (FACET_USER_PROFILE)
+    monkeypatch.setattr(views, 'HISTORY_PAGE_SIZE', 3)
+    events = history(4)
+    request = rf.get('/account/history')
+    request.user = user
+    response = views.user_history(request)
+    assert [event['timestamp'] for event in response.context_data['events']] == [event.timestamp for event in events[:3]]
+    cursor = response.context_data['cursor']
+    assert cursor
+    assert ('?before=%s' % cursor) in response.render().content.decode()
+
+    request = rf.get('/account/history', {'before': cursor})
+    request.user = user
+    response = views.user_history(request)
+    assert [event['timestamp'] for event in response.context_data['events']] == [events[3].timestamp]
+    assert response.context_data['cursor'] is None
@@ -0,0 +1,122 @@
+from datetime import timedelta
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.db import connection
+
+from . import entitlements
+from .models import Entitlement, PlanInterval, Profile, ProfilePlanLog
+from .test_rest import best_plan, better_plan
+
+
+def users(count):
+    return [User.objects.create_user('user%d' % n, email='user%d@example.com' % n) for n in range(count)]
+
+
+def test_plan_batch(plan_batch, user, best_plan, better_plan):
+    results = plan_batch(
+        {'action': 'set-plan', 'user_email': user.email, 'plan': best_plan.id},
+        {'action': 'add-interval', 'user_email': user.email, 'plan': better_plan.id, 'duration': '30 00:00'},
+        {'action': 'set-plan', 'user_email': 'nobody@example.com', 'plan': best_plan.id},
+        {'action': 'set-plan', 'user_email': user.email, 'plan': 'no_such_plan'},
+        {'action': 'add-interval', 'user_email': user.email, 'plan': best_plan.id},
+        {'action': 'cancel', 'user_email': user.email, 'plan': best_plan.id},
+    )
+    assert [result['status'] for result in results] == [200, 200, 400, 400, 400, 400]
+    assert results[2]['errors'] == {'user_email': ['No such user.']}
+    assert 'plan' in results[3]['errors']
+    assert 'duration' in results[4]['errors']
+    assert 'action' in results[5]['errors']
+
+    profile = Profile.objects.get(user=user)
+    assert profile.subscribed_plan == best_plan
+    interval = PlanInterval.objects.get(profile=profile)
+    assert (interval.plan, interval.duration, interval.state) == (better_plan, timedelta(days=30), 'pristine')
+    log = ProfilePlanLog.objects.filter(profile=profile).order_by('id')
+    assert [(entry.action, entry.plan, entry.interval) for entry in log] == [
+        ('set-plan', best_plan, None),
+        ('add-interval', better_plan, interval),
+    ]
+    # Pristine intervals take precedence over the subscribed plan
+    assert Entitlement.objects.get(profile=profile).plan == better_plan
+
+
+def test_plan_batch_order(plan_batch, user, best_plan, better_plan):
+    plan_batch(
+        {'action': 'set-plan', 'user_email': user.email, 'plan': better_plan.id},
+        {'action': 'set-plan', 'user_email': user.email, 'plan': best_plan.id},
+    )
+    assert Profile.objects.get(user=user).subscribed_plan == best_plan
+    assert entitlements.current(User.objects.get(pk=user.pk)).plan == best_plan
+
+
+def test_plan_batch_intervals(plan_batch, user, best_plan):
+    others = users(2)
+    results = plan_batch(*[{'action': 'add-interval', 'user_email': other.email, 'plan': best_plan.id, 'duration': '1 00:00'}
+                           for other in [user] + others + [user]])
+    assert all(result['status'] == 200 for result in results)
+    assert PlanInterval.objects.filter(profile__user=user).count() == 2
+    log = ProfilePlanLog.objects.filter(action='add-interval')
+    assert log.count() == 4
+    assert len({entry.interval_id for entry in log}) == 4
+    assert all(entry.interval.profile_id == entry.profile_id for entry in log)
+
+
+def test_plan_batch_intervals_reserved_ids(plan_batch, user, best_plan, monkeypatch):
+    def reserve_ids(model, count):
+        # An interval added concurrently, which matches the ones of the batch
+        PlanInterval.objects.create(id=5000, profile=user.profile, plan=best_plan, duration=timedelta(days=1))
+        return list(range(1000, 1000 + count))
+    monkeypatch.setattr(connection, 'vendor', 'postgresql')
+    monkeypatch.setattr('qabel_provider.subscriptions.reserve_ids', reserve_ids)
+    change = {'action': 'add-interval', 'user_email': user.email, 'plan': best_plan.id, 'duration': '1 00:00'}
+    assert plan_batch(change, change) == [{'status': 200}] * 2
+    log = ProfilePlanLog.objects.filter(action='add-interval').order_by('pk')
+    assert [entry.interval_id for entry in log] == [1000, 1001]
+
+
+def test_plan_batch_shared_email(plan_batch, user, best_plan):
+    User.objects.create_user('twin', email=user.email)
+    result, = plan_batch({'action': 'set-plan', 'user_email': user.email, 'plan': best_plan.id})
+    assert result['status'] == 400
+    assert not ProfilePlanLog.objects.exists()
+
+
+def test_plan_batch_queries(plan_batch, user, best_plan, better_plan, queries_for):
+    def apply(emails):
+        changes = []
+        for email in emails:
+            changes.append({'action': 'set-plan', 'user_email': email, 'plan': best_plan.id})
+            changes.append({'action': 'add-interval', 'user_email': email, 'plan': better_plan.id, 'duration': '1 00:00'})
+        assert all(result['status'] == 200 for result in plan_batch(*changes))
+
+    one = queries_for(apply, [user.email])
+    many = queries_for(apply, [other.email for other in users(10)])
+    assert len(many) == len(one)
+
+
+def test_plan_batch_chunks(plan_batch, best_plan, monkeypatch):
+    monkeypatch.setattr('qabel_provider.subscriptions.BATCH_SIZE', 2)
+    results = plan_batch(*[{'action': 'set-plan', 'user_email': other.email, 'plan': best_plan.id}
+                           for other in users(5)])
+    assert [result['status'] for result in results] == [200] * 5
+    assert Profile.objects.filter(subscribed_plan=best_plan).count() == 5
+
+
+@pytest.mark.parametrize('payload', ({}, {'changes': {}}, {'changes': 'set-plan'}))
+def test_plan_batch_invalid(external_api_client, plan_batch_path, payload):
+    response = external_api_client.post(plan_batch_path, payload, format='json')
+    assert response.status_code == 400
+
+
+def test_plan_batch_limit(external_api_client, plan_batch_path, monkeypatch):
+    monkeypatch.setattr('qabel_provider.subscriptions.LIMIT', 1)
+    response = external_api_client.post(plan_batch_path, {'changes': [{}, {}]}, format='json')
+    assert response.status_code == 400
+
+
+def test_plan_batch_email_case(plan_batch, user, best_plan):
+    result, = plan_batch({'action': 'set-plan', 'user_email': user.email.upper(), 'plan': best_plan.id})
+    assert result['status'] == 200
+    assert Profile.objects.get(user=user).subscribed_plan == best_plan
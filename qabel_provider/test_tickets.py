@@ -0,0 +1,81 @@
+from datetime import timedelta
+
+import pytest
+
+from django.utils import timezone
+
+from . import tickets
+from .models import PlanInterval
+from .test_rest import best_plan
+
+
+def test_issue_verify(settings):
+    expires = timezone.now() + timedelta(minutes=1)
+    ticket = tickets.issue({'user_id': 1, 'active': True}, expires)
+    payload = tickets.verify(ticket)
+    assert payload == {'user_id': 1, 'active': True, 'valid_until': int(expires.timestamp())}
+
+
+@pytest.mark.parametrize('mangle', (
+    lambda ticket: ticket[:-2],
+    lambda ticket: ticket.replace('.', ''),
+    lambda ticket: tickets.b64encode(b'{"user_id":2,"active":true,"valid_until":9999999999}') + ticket[ticket.index('.'):],
+))
+def test_verify_forged(mangle):
+    ticket = tickets.issue({'user_id': 1, 'active': True}, timezone.now() + timedelta(minutes=1))
+    with pytest.raises(ValueError):
+        tickets.verify(mangle(ticket))
+
+
+def test_verify_other_secret(settings):
+    ticket = tickets.issue({'user_id': 1, 'active': True}, timezone.now() + timedelta(minutes=1))
+    settings.API_SECRET = settings.API_SECRET + 'foo'
+    with pytest.raises(ValueError):
+        tickets.verify(ticket)
+
+
+def test_verify_expired():
+    ticket = tickets.issue({'user_id': 1, 'active': True}, timezone.now() - timedelta(seconds=1))
+    with pytest.raises(ValueError):
+        tickets.verify(ticket)
+
+
+def test_auth_resource_ticket(settings, external_api_client, auth_resource_path, user, token):
+    settings.ENTITLEMENT_TICKET_LIFETIME = 60
+    response = external_api_client.post(auth_resource_path, {'auth': 'Token {}'.format(token), 'ticket': True})
+    assert response.status_code == 200
+    data = response.json()
+    payload = tickets.verify(data.pop('ticket'))
+    assert payload['valid_until'] == data['valid_until']
+    assert payload == data
+    assert data['valid_until'] <= (timezone.now() + timedelta(seconds=60)).timestamp()
+    assert 'private' in response['Cache-Control']
+    assert 'max-age=' in response['Cache-Control']
+    assert response['Expires']
+
+    # Cached answers get tickets as well
+    response = external_api_client.post(auth_resource_path, {'user_id': user.id, 'ticket': True})
+    assert tickets.verify(response.json()['ticket'])['user_id'] == user.id
+
+
+def test_auth_resource_no_ticket(external_api_client, auth_resource_path, token):
+    response = external_api_client.post(auth_resource_path, {'auth': 'Token {}'.format(token)})
+    assert 'ticket' not in response.json()
+    assert 'Expires' not in response
+
+
+def test_auth_resource_ticket_interval_end(settings, external_api_client, auth_resource_path, user, best_plan):
+    settings.ENTITLEMENT_TICKET_LIFETIME = 24 * 60 * 60
+    PlanInterval(profile=user.profile, plan=best_plan, duration=timedelta(minutes=10)).save()
+    response = external_api_client.post(auth_resource_path, {'user_id': user.id, 'ticket': True})
+    data = response.json()
+    assert data['block_quota'] == best_plan.block_quota
+    assert data['valid_until'] <= (timezone.now() + timedelta(minutes=10)).timestamp()
+
+
+def test_auth_resource_batch_tickets(external_api_client, auth_resource_batch_path, user, token):
+    payload = {'users': [{'auth': 'Token {}'.format(token)}, {'user_id': 1234}], 'ticket': True}
+    response = external_api_client.post(auth_resource_batch_path, payload, format='json')
+    found, not_found = response.json()['users']
+    assert tickets.verify(found['ticket'])['user_id'] == user.id
+    assert 'ticket' not in not_found
@@ -0,0 +1,238 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from redis_cache import RedisCache
+
+from . import entitlements, usage, views
+from .models import DailyUsage, Entitlement, EntitlementChange, MonthlyUsage, UsageFlush
+from .test_quota import block_quota, quota_cache
+from .test_rest import best_plan
+
+
+@pytest.fixture(autouse=True)
+def usage_cache(settings):
+    settings.CACHES = dict(settings.CACHES, usage={
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'usage',
+    })
+    settings.USAGE_CACHE = 'usage'
+    cache = usage.get_cache()
+    cache.clear()
+    return cache
+
+
+NOW = datetime(2016, 8, 31, 23, 0, tzinfo=timezone.utc)
+
+
+def flush(now=NOW):
+    """Flush everything recorded up to a minute after *now*."""
+    return usage.flush(now + timedelta(seconds=3 * usage.BUCKET_SECONDS))
+
+
+def test_report_flush(report, user):
+    now = datetime.now(timezone.utc)
+    report({'user_id': user.id, 'traffic': 10, 'stored': 5},
+           {'user_id': user.id, 'traffic': 1},
+           {'user_id': user.id + 1000, 'traffic': 1})
+    report({'user_id': user.id, 'stored': -2})
+    assert flush(now) == 1
+
+    daily = DailyUsage.objects.get()
+    assert (daily.profile_id, daily.traffic, daily.stored) == (user.id, 11, 3)
+    monthly = MonthlyUsage.objects.get()
+    assert (monthly.month, monthly.traffic, monthly.stored) == (daily.day.replace(day=1), 11, 3)
+    # Flushed buckets are gone
+    assert flush(now) == 0
+    assert MonthlyUsage.objects.get().traffic == 11
+
+
+def test_flush_adds_up(user):
+    usage.record({user.id: {'traffic': 10}}, NOW)
+    usage.record({user.id: {'traffic': 10}}, NOW + timedelta(minutes=5))
+    usage.record({user.id: {'traffic': 10}}, NOW + timedelta(hours=2))
+    assert flush(NOW + timedelta(hours=2)) == 1
+    assert [(daily.day.day, daily.traffic) for daily in DailyUsage.objects.order_by('day')] == [(31, 20), (1, 10)]
+    assert [(monthly.month.month, monthly.traffic) for monthly in MonthlyUsage.objects.order_by('month')] == [(8, 20), (9, 10)]
+
+
+def test_flush_open_bucket(user):
+    usage.record({user.id: {'traffic': 10}}, NOW)
+    # record() may still add to the bucket which was closed last
+    assert usage.flush(NOW + timedelta(seconds=usage.BUCKET_SECONDS)) == 0
+    assert not DailyUsage.objects.exists()
+    assert flush() == 1
+
+
+def test_flush_bucket_once(user):
+    usage.record({user.id: {'traffic': 10}}, NOW)
+    # A previous flush committed, but didn't drop the bucket from the cache
+    UsageFlush.objects.create(bucket=usage.bucket_of(NOW))
+    assert flush() == 0
+    assert not DailyUsage.objects.exists()
+
+
+def test_flush_queries(db, queries_for):
+    def record(count, now):
+        users = [User.objects.create_user('flush%d-%d' % (count, number)) for number in range(count)]
+        for minutes in range(0, 60, 15):
+            usage.record({user.id: {'traffic': 1, 'stored': minutes} for user in users}, now + timedelta(minutes=minutes))
+
+    def flush(count, now):
+        assert usage.flush(now + timedelta(hours=3)) == count
+
+    record(1, NOW + timedelta(hours=2))
+    one = queries_for(flush, 1, NOW + timedelta(hours=2))
+    record(10, NOW + timedelta(days=2, hours=2))
+    assert len(queries_for(flush, 10, NOW + timedelta(days=2, hours=2))) == len(one)
+    daily = DailyUsage.objects.get(profile__user__username='flush10-0')
+    assert (daily.traffic, daily.stored) == (4, 90)
+
+
+def test_flush_adds_to_existing_rows(user):
+    usage.record({user.id: {'traffic': 10, 'stored': 3}}, NOW)
+    flush()
+    usage.record({user.id: {'traffic': 5}}, NOW + timedelta(minutes=5))
+    flush(NOW + timedelta(minutes=5))
+    assert [(daily.traffic, daily.stored) for daily in DailyUsage.objects.all()] == [(15, 3)]
+    assert [(monthly.traffic, monthly.stored) for monthly in MonthlyUsage.objects.all()] == [(15, 3)]
+
+
+class FakeRedis:
+    """Stand-in for the client of RedisCache, counting the round trips of the commands usage.record() sends."""
+
+    def __init__(self):
+        self.values = {}
+        self.queued = []
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def _incrby(self, key, delta):
+        self.values[key] = self.values.get(key, 0) + delta
+        return self.values[key]
+
+    def incrby(self, key, delta):
+        self.queued.append(lambda: self._incrby(key, delta))
+
+    def expire(self, key, timeout):
+        self.queued.append(lambda: True)
+
+    def setex(self, key, value, timeout):
+        self.queued.append(lambda: self.values.__setitem__(key, value))
+
+    def execute(self):
+        self.round_trips += 1
+        queued, self.queued = self.queued, []
+        return [command() for command in queued]
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [self.values.get(key) for key in keys]
+
+
+def test_record_redis_round_trips(monkeypatch):
+    cache = RedisCache('localhost:6379', {})
+    cache.master_client = FakeRedis()
+    monkeypatch.setattr(usage, 'get_cache', lambda: cache)
+    bucket = usage.bucket_of(NOW)
+
+    def round_trips(deltas):
+        cache.master_client.round_trips = 0
+        usage.record(deltas, NOW)
+        return cache.master_client.round_trips
+
+    assert round_trips({1: {'traffic': 1}}) == 3
+    assert round_trips({user_id: {'traffic': 2, 'stored': 1} for user_id in range(1, 21)}) == 3
+    # Users seen before only get their increments
+    assert round_trips({1: {'traffic': 3}}) == 1
+    count = cache.get_many([usage.count_key(bucket)])[usage.count_key(bucket)]
+    deltas, keys = usage.read_bucket(cache, bucket, count)
+    assert len(deltas) == 20
+    assert deltas[1] == {'traffic': 6, 'stored': 1}
+    assert deltas[20] == {'traffic': 2, 'stored': 1}
+
+
+def test_flush_locked(user, usage_cache):
+    usage.record({user.id: {'traffic': 10}}, NOW)
+    usage_cache.add(usage.FLUSH_LOCK_KEY, True)
+    assert flush() == 0
+    assert not DailyUsage.objects.exists()
+
+
+@pytest.mark.parametrize('entry', (
+    {'user_id': 'foo'},
+    {'user_id': 1, 'traffic': -1},
+    {'traffic': 1},
+))
+def test_report_malformed(external_api_client, usage_path, user, entry):
+    response = external_api_client.post(usage_path, {'users': [{'user_id': user.id, 'traffic': 1}, entry]},
+                                        format='json')
+    assert response.status_code == 400
+    # Nothing is recorded
+    assert flush(datetime.now(timezone.utc)) == 0
+
+
+def test_report_api_key(api_client, usage_path, user):
+    response = api_client.post(usage_path, {'users': [{'user_id': user.id, 'traffic': 1}]}, format='json')
+    assert response.status_code == 403
+
+
+def test_over_quota(user, best_plan, external_api_client, auth_resource_path):
+    user.profile.subscribed_plan = best_plan
+    user.profile.save()
+
+    def over_quota():
+        response = external_api_client.post(auth_resource_path, {'user_id': user.id})
+        return response.json()['over_quota']
+
+    assert not over_quota()
+    changes = EntitlementChange.objects.count()
+    usage.record({user.id: {'traffic': best_plan.monthly_traffic_quota + 1}}, NOW)
+    flush()
+    assert over_quota()
+    assert EntitlementChange.objects.count() == changes + 1
+
+    # A new month
+    flush(NOW + timedelta(days=1))
+    assert not over_quota()
+
+    later = NOW + timedelta(days=1, minutes=10)
+    usage.record({user.id: {'stored': best_plan.block_quota + 1}}, later)
+    flush(later)
+    assert over_quota()
+
+
+def test_flush_command(user):
+    usage.record({user.id: {'traffic': 10}}, datetime.now(timezone.utc) - timedelta(minutes=5))
+    call_command('flush_usage')
+    assert DailyUsage.objects.get().traffic == 10
+
+
+def test_profile_page_outdated_row(user, block_quota, rf):
+    entitlements.refresh(user)
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    Entitlement.objects.filter(profile_id=user.id).update(valid_until=past, over_quota=True)
+    request = rf.get('/')
+    request.user = User.objects.get(pk=user.pk)
+    response = views.user_profile(request)
+    assert response.context_data['over_quota']
+    assert response.context_data['plan'] == user.profile.subscribed_plan
+    # Page views don't write
+    assert Entitlement.objects.get(profile_id=user.id).valid_until == past
+
+
+def test_profile_page(user, best_plan, block_quota, rf):
+    user.profile.subscribed_plan = best_plan
+    user.profile.save()
+    now = datetime.now(timezone.utc)
+    usage.record({user.id: {'traffic': 5}}, now)
+    flush(now)
+    request = rf.get('/')
+    request.user = user
+    response = views.user_profile(request)
+    assert response.context_data['traffic_used'] == 5
+    assert response.context_data['over_quota']
@@ -1,9 +1,13 @@
 
+from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.models import User
+from django.db import connection
 
 import pytest
 
-from .utils import elide, get_request_origin, gen_username
+from . import utils
+from .models import Profile
+from .utils import elide, get_request_origin, gen_username, create_user, filter_by_emails
 
 
 @pytest.mark.parametrize('text, length, output', (
@@ -54,3 +58,88 @@ def test_gen_username_too_long(db):
     too_long = 'abcdefghijklmnopqrstuvwxyz12345@xyz'
     assert len(too_long) > 30
     assert gen_username(too_long) != too_long
+
+
+def test_gen_username_gap(db):
+    User.objects.create_user('user')
+    User.objects.create_user('user2')
+    User.objects.create_user('username')
+    assert gen_username('user@xyz') == 'user1'
+
+
+def test_gen_username_special_characters(db):
+    User.objects.create_user('a.b')
+    User.objects.create_user('axb1')
+    assert gen_username('a.b@xyz') == 'a.b1'
+    assert gen_username('a_b@xyz') == 'a_b'
+
+
+@pytest.mark.parametrize('taken', (10, 1000))
+def test_gen_username_colliding_queries(db, taken, assert_num_queries):
+    User.objects.bulk_create([User(username='info%s' % (n or '')) for n in range(taken)])
+    # Used to be one query per taken name
+    with assert_num_queries(1):
+        username = gen_username('info@xyz')
+    assert username == 'info%d' % taken
+
+
+def test_create_user(db):
+    user = create_user('user@xyz', first_name='Manfred')
+    assert user.username == 'user'
+    assert user.email == 'user@xyz'
+    assert user.first_name == 'Manfred'
+
+
+def test_create_user_race(db, monkeypatch):
+    taken_usernames = utils.taken_usernames
+    calls = []
+
+    def concurrently_taken(mailboxes):
+        # Another registration inserts "user" after the lookup
+        calls.append(mailboxes)
+        if len(calls) == 1:
+            User.objects.create_user('user')
+            return set()
+        return taken_usernames(mailboxes)
+    monkeypatch.setattr(utils, 'taken_usernames', concurrently_taken)
+
+    assert create_user('user@xyz').username == 'user1'
+    assert len(calls) == 2
+
+
+def test_filter_by_emails(db, queries_for):
+    manfred = User.objects.create_user('manfred', email='Manfred@Example.com')
+    User.objects.create_user('other', email='other@example.com')
+    assert list(filter_by_emails(User.objects, ['manfred@example.COM', 'nobody@example.com'])) == [manfred]
+    assert list(filter_by_emails(Profile.objects, ['MANFRED@example.com'], field='user__email')) == [manfred.profile]
+    assert not filter_by_emails(User.objects, [])
+    sql, = queries_for(list, filter_by_emails(User.objects, ['a@example.com', 'b@example.com']))
+    assert 'UPPER(' in sql and ' IN (' in sql
+
+
+def explain(queries):
+    """Return the query plans of the SQL *queries*, on PostgreSQL."""
+    plans = []
+    with connection.cursor() as cursor:
+        # The test tables are tiny, scanning them would always be cheaper
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        for sql in queries:
+            cursor.execute('EXPLAIN ' + sql)
+            plans.append('\n'.join(row[0] for row in cursor.fetchall()))
+    return plans
+
+
+@pytest.mark.parametrize('run', (
+    # PlanSubscriptionSerializer.validate_user_email, register_on_behalf
+    lambda: User.objects.filter(email__iexact='foo@example.com').exists(),
+    # PlanSubscriptionSerializer._get_profile
+    lambda: list(Profile.objects.filter(user__email__iexact='foo@example.com')),
+    # provisioning, subscriptions
+    lambda: list(filter_by_emails(User.objects, ['foo@example.com', 'bar@example.com'])),
+    lambda: list(PasswordResetForm().get_users('foo@example.com')),
+))
+def test_email_lookup_uses_index(db, run, queries_for):
+    if connection.vendor != 'postgresql':
+        pytest.skip('Index usage is only checked on PostgreSQL')
+    plan, = explain(queries_for(run))
+    assert 'qabel_provider_user_email_upper' in plan
@@ -0,0 +1,87 @@
+"""
+Signed, time-limited entitlement tickets.
+
+A ticket carries an auth_resource answer and the point in time until which it is valid. Block servers sharing the
+API_SECRET can verify tickets offline and authorize repeated requests of a user without calling auth_resource again,
+until the ticket expires.
+
+Format: ``<payload>.<signature>``, both base64url encoded without padding. The payload is the JSON encoded answer plus
+*valid_until* (UNIX timestamp), the signature is HMAC-SHA256 over the encoded payload, keyed with a key derived from
+the API_SECRET (see ticket_key).
+"""
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+
+
+@functools.lru_cache()
+def ticket_key(api_secret):
+    """Return the ticket signing key derived from *api_secret*, so that the secret itself is never used as a key."""
+    return hmac.new(api_secret.encode(), b'qabel-accounting entitlement ticket', hashlib.sha256).digest()
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def signature(encoded_payload):
+    return b64encode(hmac.new(ticket_key(settings.API_SECRET), encoded_payload.encode(), hashlib.sha256).digest())
+
+
+def expiry(valid_until):
+    """Return when a ticket issued now expires: after ENTITLEMENT_TICKET_LIFETIME, but not after *valid_until*."""
+    expires = timezone.now() + datetime.timedelta(seconds=settings.ENTITLEMENT_TICKET_LIFETIME)
+    if valid_until:
+        expires = min(expires, valid_until)
+    return expires
+
+
+def issue(data, expires):
+    """Return ticket for the auth_resource answer *data*, expiring at *expires*."""
+    payload = dict(data, valid_until=int(expires.timestamp()))
+    encoded_payload = b64encode(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode())
+    return encoded_payload + '.' + signature(encoded_payload)
+
+
+def verify(ticket):
+    """Return the payload of *ticket*. Raise ValueError if the ticket is malformed, forged or expired."""
+    try:
+        encoded_payload, ticket_signature = ticket.split('.')
+    except (AttributeError, ValueError):
+        raise ValueError('Malformed ticket')
+    if not hmac.compare_digest(ticket_signature, signature(encoded_payload)):
+        raise ValueError('Invalid ticket signature')
+    payload = json.loads(b64decode(encoded_payload).decode())
+    if payload['valid_until'] < timezone.now().timestamp():
+        raise ValueError('Ticket expired')
+    return payload
+
+
+def add_ticket(response, data, valid_until):
+    """
+    Add a ticket for *data* (as answered for *response*) and matching cache hints to *response*.
+
+    *valid_until* is when the answer may change on its own (see entitlements.valid_until).
+    """
+    expires = expiry(valid_until)
+    response.data['ticket'] = issue(data, expires)
+    response.data['valid_until'] = int(expires.timestamp())
+    set_cache_hints(response, expires)
+
+
+def set_cache_hints(response, expires):
+    max_age = max(0, int((expires - timezone.now()).total_seconds()))
+    patch_cache_control(response, private=True, max_age=max_age)
+    response['Expires'] = http_date(expires.timestamp())
@@ -0,0 +1,265 @@
+"""
+Usage of the block servers by users: bytes transferred (traffic) and the change of bytes stored.
+
+Block servers post usage deltas to the usage_report endpoint. record() adds them up in the USAGE_CACHE (Redis in
+production) with atomic increments, in buckets of BUCKET_SECONDS. The flush_usage management command sums up the closed
+buckets and adds them to the DailyUsage and MonthlyUsage rollups in one transaction. Flushed buckets are recorded in
+UsageFlush in the same transaction, so that a bucket is never added twice.
+
+After flushing, the over_quota flag of the Entitlement rows of users with new usage is updated, and so is the flag of
+users over quota so far, who may have got a bigger plan or a new month in the meantime. auth_resource and the profile
+page report the flag without asking the block server.
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, transaction
+from django.db.models import Case, F, Sum, Value, When
+from django.utils import timezone
+from redis_cache import RedisCache
+
+from . import entitlements
+from .models import DailyUsage, Entitlement, MonthlyUsage, Profile, UsageFlush
+
+logger = logging.getLogger(__name__)
+
+# Must divide a day, so that buckets don't span days
+BUCKET_SECONDS = 60
+# How long buckets are kept in the cache. Buckets which weren't flushed by then are lost.
+KEEP = datetime.timedelta(days=1)
+FLUSH_LOCK_TIMEOUT = datetime.timedelta(minutes=10)
+FLUSH_LOCK_KEY = 'usage-flush-lock'
+FLUSHED_KEY = 'usage-flushed-until'
+
+FIELDS = ('traffic', 'stored')
+
+# Upper bound for the number of entries of a single usage_report request.
+REPORT_LIMIT = 1000
+
+
+def get_cache():
+    return caches[settings.USAGE_CACHE]
+
+
+def bucket_of(moment):
+    return int(moment.timestamp()) // BUCKET_SECONDS
+
+
+def start_of(bucket):
+    return datetime.datetime.fromtimestamp(bucket * BUCKET_SECONDS, datetime.timezone.utc)
+
+
+def count_key(bucket):
+    return 'usage-%d-count' % bucket
+
+
+def slot_key(bucket, slot):
+    return 'usage-%d-slot-%d' % (bucket, slot)
+
+
+def seen_key(bucket, user_id):
+    return 'usage-%d-user-%d' % (bucket, user_id)
+
+
+def delta_key(bucket, user_id, field):
+    return 'usage-%d-user-%d-%s' % (bucket, user_id, field)
+
+
+def increment(cache, deltas, timeout):
+    """
+    Add *deltas* (mapping keys to integers) to the counters in *cache*, creating missing ones, and return their values.
+
+    Redis gets all increments in one round trip (a pipeline), other caches an add and an incr per key.
+    """
+    keys = list(deltas)
+    if isinstance(cache, RedisCache):
+        pipeline = cache.master_client.pipeline(transaction=False)
+        for key in keys:
+            versioned_key = cache.make_key(key)
+            pipeline.incrby(versioned_key, deltas[key])
+            pipeline.expire(versioned_key, timeout)
+        return dict(zip(keys, pipeline.execute()[::2]))
+    values = {}
+    for key in keys:
+        cache.add(key, 0, timeout)
+        values[key] = cache.incr(key, deltas[key])
+    return values
+
+
+def record(deltas, now=None):
+    """
+    Add *deltas* to the current bucket. *deltas* maps user IDs to dicts mapping FIELDS to deltas.
+
+    The users of a bucket are numbered through by a counter, so that flush can find them without scanning keys. The
+    first increment of a user's seen counter in a bucket takes the next slots; this takes at most three round trips to
+    Redis, however many users there are.
+    """
+    cache = get_cache()
+    bucket = bucket_of(now or timezone.now())
+    timeout = int(KEEP.total_seconds())
+    counters = {seen_key(bucket, user_id): 1 for user_id in deltas}
+    for user_id, fields in deltas.items():
+        for field in FIELDS:
+            if fields.get(field):
+                counters[delta_key(bucket, user_id, field)] = fields[field]
+    values = increment(cache, counters, timeout)
+    new = [user_id for user_id in deltas if values[seen_key(bucket, user_id)] == 1]
+    if new:
+        last = increment(cache, {count_key(bucket): len(new)}, timeout)[count_key(bucket)]
+        cache.set_many({slot_key(bucket, last - len(new) + number): user_id for number, user_id in enumerate(new, 1)},
+                       timeout)
+
+
+# Number of rollup rows updated per statement
+ADD_BATCH_SIZE = 500
+
+
+def add_usage(model, period, deltas):
+    """
+    Add *deltas* (mapping profile IDs to dicts of FIELDS) to the rollup rows of *model* for *period*.
+
+    *period* is a dict like {'day': date}. Existing rows are incremented in place with one statement per
+    ADD_BATCH_SIZE profiles, missing ones are created with one statement (Django has no upserts).
+    """
+    profile_ids = sorted(deltas)
+    missing = []
+    for start in range(0, len(profile_ids), ADD_BATCH_SIZE):
+        batch = profile_ids[start:start + ADD_BATCH_SIZE]
+        existing = set(model.objects.filter(profile_id__in=batch, **period).values_list('profile_id', flat=True))
+        missing += [profile_id for profile_id in batch if profile_id not in existing]
+        increments = {}
+        for field in FIELDS:
+            whens = [When(profile_id=profile_id, then=Value(deltas[profile_id][field]))
+                     for profile_id in existing if deltas[profile_id][field]]
+            if whens:
+                increments[field] = F(field) + Case(*whens, default=Value(0), output_field=models.BigIntegerField())
+        if increments:
+            model.objects.filter(profile_id__in=existing, **period).update(**increments)
+    model.objects.bulk_create([model(profile_id=profile_id, **period, **deltas[profile_id]) for profile_id in missing],
+                              batch_size=ADD_BATCH_SIZE)
+
+
+def read_bucket(cache, bucket, count):
+    """Return the deltas of the *count* users of *bucket* (like record() takes them) and the cache keys it uses."""
+    slots = [slot_key(bucket, slot) for slot in range(1, count + 1)]
+    user_ids = set(cache.get_many(slots).values())
+    keys = {(user_id, field): delta_key(bucket, user_id, field) for user_id in user_ids for field in FIELDS}
+    values = cache.get_many(list(keys.values()))
+    deltas = {user_id: {field: values.get(keys[user_id, field], 0) for field in FIELDS} for user_id in user_ids}
+    return deltas, [count_key(bucket)] + slots + [seen_key(bucket, user_id) for user_id in user_ids] + list(keys.values())
+
+
+def add_up(totals, deltas):
+    """Add *deltas* (user IDs -> dicts of FIELDS) to *totals*, a dict of the same shape."""
+    for user_id, fields in deltas.items():
+        total = totals.setdefault(user_id, dict.fromkeys(FIELDS, 0))
+        for field in FIELDS:
+            total[field] += fields[field]
+
+
+def flush_buckets(buckets):
+    """
+    Add the deltas of the (closed) *buckets* to the rollups and drop them from the cache.
+
+    The deltas are summed up per day and month first and written in one transaction, along with the UsageFlush rows of
+    the buckets; buckets flushed before are skipped. Return the IDs of the profiles with usage in the buckets. Deltas of
+    deleted users are dropped.
+    """
+    cache = get_cache()
+    counts = cache.get_many([count_key(bucket) for bucket in buckets])
+    read = {}
+    for bucket in buckets:
+        count = counts.get(count_key(bucket))
+        if count:
+            read[bucket] = read_bucket(cache, bucket, count)
+    if not read:
+        return set()
+
+    with transaction.atomic():
+        flushed = set(UsageFlush.objects.filter(bucket__range=(min(read), max(read))).values_list('bucket', flat=True))
+        if flushed:
+            logger.info('Buckets %s were flushed already', sorted(flushed))
+        daily = {}
+        monthly = {}
+        for bucket, (deltas, keys) in read.items():
+            if bucket in flushed:
+                continue
+            day = start_of(bucket).date()
+            add_up(daily.setdefault(day, {}), deltas)
+            add_up(monthly.setdefault(day.replace(day=1), {}), deltas)
+        user_ids = set().union(*daily.values())
+        profile_ids = set(Profile.objects.filter(pk__in=user_ids).values_list('pk', flat=True)) if user_ids else set()
+        for model, period_field, periods in ((DailyUsage, 'day', daily), (MonthlyUsage, 'month', monthly)):
+            for period, deltas in periods.items():
+                add_usage(model, {period_field: period},
+                          {profile_id: fields for profile_id, fields in deltas.items() if profile_id in profile_ids})
+        UsageFlush.objects.bulk_create([UsageFlush(bucket=bucket) for bucket in read if bucket not in flushed])
+    cache.delete_many([key for deltas, keys in read.values() for key in keys])
+    logger.debug('Flushed %d buckets: %d users', len(read) - len(flushed), len(profile_ids))
+    return profile_ids
+
+
+def over_quota(profile_ids, now):
+    """Return the subset of *profile_ids* which store more than their block quota, or exceeded their traffic quota."""
+    month = now.date().replace(day=1)
+    month_traffic = Case(When(month=month, then='traffic'), default=0, output_field=models.BigIntegerField())
+    totals = (MonthlyUsage.objects
+              .filter(profile_id__in=profile_ids)
+              .values('profile_id')
+              .annotate(total_stored=Sum('stored'), month_traffic=Sum(month_traffic))
+              .order_by())
+    quotas = {profile_id: (block_quota, traffic_quota) for profile_id, block_quota, traffic_quota
+              in Entitlement.objects.filter(profile_id__in=profile_ids)
+              .values_list('profile_id', 'block_quota', 'monthly_traffic_quota')}
+    over = set()
+    for total in totals:
+        block_quota, traffic_quota = quotas.get(total['profile_id'], (None, None))
+        if block_quota is None:
+            # No row yet, which will be created without the flag; it is set by the next flush with usage.
+            continue
+        if total['total_stored'] > block_quota or total['month_traffic'] > traffic_quota:
+            over.add(total['profile_id'])
+    return over
+
+
+def update_over_quota(profile_ids, now):
+    """Update the over_quota flags of *profile_ids* and of all users over quota so far."""
+    profile_ids = set(profile_ids) | set(Entitlement.objects.filter(over_quota=True).values_list('profile_id', flat=True))
+    over = over_quota(profile_ids, now)
+    changed = entitlements.set_over_quota(over, True) + entitlements.set_over_quota(profile_ids - over, False)
+    if changed:
+        logger.info('over_quota changed for %d users', len(changed))
+
+
+def flush(now=None):
+    """
+    Flush the closed buckets of the last KEEP into the rollups and update the over_quota flags.
+
+    Return the number of profiles with new usage. Concurrent calls return zero right away.
+    """
+    now = now or timezone.now()
+    cache = get_cache()
+    if not cache.add(FLUSH_LOCK_KEY, True, int(FLUSH_LOCK_TIMEOUT.total_seconds())):
+        logger.info('Flush running already')
+        return 0
+    try:
+        # record() may still be adding to the bucket which was just closed
+        until = bucket_of(now) - 2
+        oldest = bucket_of(now - KEEP)
+        first = max(oldest, cache.get(FLUSHED_KEY, oldest - 1) + 1)
+        profile_ids = flush_buckets(range(first, until + 1))
+        cache.set(FLUSHED_KEY, until, int(KEEP.total_seconds()))
+        UsageFlush.objects.filter(bucket__lt=oldest).delete()
+        update_over_quota(profile_ids, now)
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+    return len(profile_ids)
+
+
+def month_traffic(profile, now=None):
+    """Return the traffic of *profile* in the month of *now*, as far as flushed."""
+    month = (now or timezone.now()).date().replace(day=1)
+    rollup = MonthlyUsage.objects.filter(profile=profile, month=month).first()
+    return rollup.traffic if rollup else 0
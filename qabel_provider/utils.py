@@ -1,10 +1,17 @@
+import logging
 import os
+import re
 
 from django.utils.text import Truncator
 from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.db.models.functions import Upper
 
 from allauth.utils import get_username_max_length
 
+logger = logging.getLogger(__name__)
+
 
 def elide(string, length):
     if length:
@@ -32,17 +39,85 @@ def get_request_origin(request, max_length=None):
     return elide(origin, max_length)
 
 
-def gen_username(email):
-    mailbox, domain = email.rsplit('@', maxsplit=1)
-    username = mailbox
-    n = 1
-    while User.objects.filter(username=username).count():
-        username = '%s%d' % (mailbox, n)
-        n += 1
+def filter_by_emails(queryset, emails, field='email'):
+    """
+    Filter the *queryset* (of users, unless *field* says otherwise) by *emails*, ignoring case.
+
+    This compares UPPER(email) with the upper-cased *emails* in one IN clause, which is covered by an index on
+    PostgreSQL (see migration 0021_user_email_upper).
+    """
+    emails = {email.upper() for email in emails}
+    if not emails:
+        return queryset.none()
+    upper = 'upper_' + field.replace('__', '_')
+    return queryset.annotate(**{upper: Upper(field)}).filter(**{upper + '__in': emails})
+
+
+# Number of mailboxes looked up with one query by taken_usernames
+USERNAME_QUERY_BATCH_SIZE = 100
+
+
+def taken_usernames(mailboxes):
+    """Return the set of existing usernames consisting of one of *mailboxes*, optionally followed by a number."""
+    mailboxes = list(mailboxes)
+    taken = set()
+    for start in range(0, len(mailboxes), USERNAME_QUERY_BATCH_SIZE):
+        query = Q()
+        for mailbox in mailboxes[start:start + USERNAME_QUERY_BATCH_SIZE]:
+            # The prefix match can use the index of the username column, the regex sorts out other names.
+            query |= Q(username__startswith=mailbox, username__regex=r'^%s[0-9]*$' % re.escape(mailbox))
+        taken.update(User.objects.filter(query).values_list('username', flat=True))
+    return taken
+
 
+def allocate_usernames(emails):
+    """
+    Return a list of unused usernames for *emails*, see gen_username.
+
+    The taken names of all mailboxes are looked up at once (one query per USERNAME_QUERY_BATCH_SIZE mailboxes), instead
+    of probing foo, foo1, foo2, ... one by one. Emails sharing a mailbox get successive free names.
+    """
+    mailboxes = [email.rsplit('@', maxsplit=1)[0] for email in emails]
+    taken = taken_usernames(set(mailboxes))
     max_length = get_username_max_length()
-    if max_length and len(username) > max_length:
-        # I give up.
-        return os.urandom(max_length // 2).hex()
+    next_suffix = {}
+    usernames = []
+    for mailbox in mailboxes:
+        n = next_suffix.get(mailbox, 0)
+        username = '%s%d' % (mailbox, n) if n else mailbox
+        while username in taken:
+            n += 1
+            username = '%s%d' % (mailbox, n)
+        next_suffix[mailbox] = n + 1
+        taken.add(username)
+        if max_length and len(username) > max_length:
+            username = os.urandom(max_length // 2).hex()
+        usernames.append(username)
+    return usernames
+
+
+def gen_username(email):
+    """Return an unused username for *email*: its mailbox, followed by the lowest free number if it's taken."""
+    return allocate_usernames([email])[0]
+
+
+# Attempts of create_user, the username may be taken concurrently between generating and inserting it
+CREATE_USER_ATTEMPTS = 3
+
+
+def create_user(email, **fields):
+    """
+    Create and return a user for *email* with a generated username (see gen_username). *fields* go to create_user.
 
-    return username
+    The unique constraint of the username column decides races with concurrent registrations; the loser generates
+    the username again, seeing the winner's.
+    """
+    for attempt in range(1, CREATE_USER_ATTEMPTS + 1):
+        username = gen_username(email)
+        try:
+            with transaction.atomic():
+                return User.objects.create_user(username, email=email, **fields)
+        except IntegrityError:
+            if attempt == CREATE_USER_ATTEMPTS:
+                raise
+            logger.info('Username %r was taken concurrently, retrying', username)
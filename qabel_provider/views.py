@@ -1,39 +1,44 @@
+import datetime
 import functools
 import hashlib
 import hmac
+import json
 import os
 import logging
-from smtplib import SMTPException
+import time
 
 from allauth.account.models import EmailAddress
 from axes import decorators as axes_dec
 from django.conf import settings
-from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.auth.views import login
-from django.core.cache import cache
-from django.core.mail import EmailMultiAlternatives
 from django.db import transaction
+from django.db.models import Q
 from django import forms
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect
-from django.template import loader
 from django.template.response import TemplateResponse as render
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext_lazy as _
 from rest_auth.registration.views import RegisterView
 from rest_auth.views import LoginView
 from rest_framework.authtoken.models import Token
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
 from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
 from log_request_id import local as request_local
 
-from .block import get_block_quota_of_user
-from .serializers import UserSerializer, PlanSubscriptionSerializer, PlanIntervalSerializer, RegisterOnBehalfSerializer
-from .models import ProfilePlanLog
-from .utils import get_request_origin, gen_username
+from . import audit, entitlements, outbox, phases, provisioning, quota, subscriptions, tickets, usage
+from .forms import QueuedPasswordResetForm
+from .serializers import (UserSerializer, PlanSubscriptionSerializer, PlanIntervalSerializer, RegisterOnBehalfSerializer,
+                          UsageReportSerializer)
+from .models import ArchivedProfilePlanLog, ProfilePlanLog, select_entitlement_data
+from .utils import get_request_origin, create_user
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +55,7 @@ def api_root(request, format=None):
         'password_change': reverse('rest_password_change', request=request, format=format),
         'password_reset': reverse('rest_password_reset', request=request, format=format),
         'password_confirm': reverse('rest_password_reset_confirm', request=request, format=format),
+        'history': reverse('api-account-history', request=request, format=format),
     })
 
 
@@ -73,7 +79,9 @@ def api_key_error():
 def require_api_key(view):
     @functools.wraps(view)
     def view_wrapper(request, format=None):
-        if not check_api_key(request):
+        with phases.phase('api_key'):
+            authorized = check_api_key(request)
+        if not authorized:
             return api_key_error()
         # Request authorized by API key, so imbue our logs with X-Request-ID
         request_id = request.META.get('HTTP_X_REQUEST_ID')
@@ -84,7 +92,129 @@ def require_api_key(view):
     return view_wrapper
 
 
+class AuthResourceError(Exception):
+    """Raised for auth_resource requests which can't be answered, carries the HTTP status and error message."""
+
+    def __init__(self, status, error):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+    def response(self):
+        return Response(status=self.status, data={'error': self.error})
+
+
+def parse_user_identification(data):
+    """
+    Parse the user identification of an auth_resource request.
+
+    Return a tuple (*kind*, *value*) where *kind* is either 'token' (*value* is the token key)
+    or 'user_id' (*value* is the user ID). Raise AuthResourceError if *data* is malformed.
+    """
+    if 'auth' in data and 'user_id' in data:
+        raise AuthResourceError(400, 'Pass *either* an auth token *or* an user ID')
+    elif 'auth' in data:
+        try:
+            auth_type, token = data['auth'].split()
+            if auth_type != 'Token':
+                raise ValueError()
+        except (AttributeError, ValueError):
+            raise AuthResourceError(400, 'Invalid auth type')
+        return 'token', token
+    elif 'user_id' in data:
+        try:
+            user_id = int(data['user_id'])
+        except (TypeError, ValueError):
+            raise AuthResourceError(400, 'Malformed user ID')
+        return 'user_id', user_id
+    else:
+        raise AuthResourceError(400, 'No user identification supplied')
+
+
+NOT_FOUND_ERRORS = {
+    'token': 'Invalid token',
+    'user_id': 'Invalid user ID',
+}
+
+
+def wants_ticket(data):
+    """Return whether an auth_resource request asked for a ticket (see qabel_provider.tickets)."""
+    return str(data.get('ticket', '')).lower() in ('1', 'true')
+
+
+def resolve_entitlements(kind, values):
+    """
+    Return a dict mapping the *values* of identification *kind* to users. Unknown values are omitted.
+
+    The users come with their Entitlement row, all with one query, see entitlement_answers.
+    """
+    if kind == 'token':
+        tokens = Token.objects.filter(key__in=values).select_related('user__profile__entitlement')
+        return {token.key: token.user for token in tokens}
+    users = User.objects.filter(id__in=values).select_related('profile__entitlement')
+    return {user.id: user for user in users}
+
+
+def resolve_users(kind, values):
+    """
+    Return a dict mapping the *values* of identification *kind* to users. Unknown values are omitted.
+
+    The users come with everything auth_resource_data needs, see select_entitlement_data.
+    """
+    if kind == 'token':
+        tokens = select_entitlement_data(Token.objects.filter(key__in=values), 'user')
+        return {token.key: token.user for token in tokens}
+    users = select_entitlement_data(User.objects.filter(id__in=values))
+    return {user.id: user for user in users}
+
+
+def auth_resource_data(user):
+    """Return the auth_resource answer for *user*. Processes active use of the user's plan."""
+    profile = user.profile
+    with phases.phase('confirmation'):
+        is_disabled = profile.check_confirmation_and_send_mail()
+    with phases.phase('intervals'):
+        profile.use_plan()
+        plan = profile.plan
+    return {
+        'user_id': user.id,
+        'active': (not is_disabled),
+        'block_quota': plan.block_quota,
+        'monthly_traffic_quota': plan.monthly_traffic_quota,
+        'over_quota': entitlements.over_quota_of(user),
+    }
+
+
+def entitlement_answers(users):
+    """
+    Return a dict mapping the IDs of *users* (from resolve_entitlements) to (answer, valid_until) tuples.
+
+    Up to date Entitlement rows are answered as they are. All other users are processed by auth_resource_data,
+    with a fixed number of queries, and get their row rewritten.
+    """
+    answers = {}
+    outdated = []
+    for user in users:
+        entitlement = entitlements.current(user)
+        if entitlement:
+            answers[user.id] = entitlements.data_of(entitlement), entitlement.valid_until
+        else:
+            outdated.append(user.id)
+    if outdated:
+        with phases.phase('lookup'):
+            users = resolve_users('user_id', outdated).values()
+        for user in users:
+            # Transitions (e.g. starting an interval) schedule a refresh of the row for the commit, which the refresh
+            # below makes redundant
+            with transaction.atomic(savepoint=False):
+                data = auth_resource_data(user)
+                with phases.phase('entitlement'):
+                    answers[user.id] = data, entitlements.refresh(user).valid_until
+    return answers
+
+
 @api_view(('POST',))
+@phases.instrument
 @require_api_key
 def auth_resource(request, format=None):
     """
@@ -100,64 +230,239 @@ def auth_resource(request, format=None):
     if the user is authenticated. The block server should set the same
     Authorization header that itself received by the user.
 
+    If *ticket* is true, the response additionally contains a signed *ticket* and its *valid_until*
+    (UNIX timestamp), see qabel_provider.tickets. The block server can use the ticket to authorize further requests
+    of the user until it expires. The Cache-Control and Expires headers of the response match the ticket.
+
+    *over_quota* is true if the usage reported by the block servers (see usage_report) exceeds the block quota
+    or the monthly traffic quota of the user.
+
+    Duration and queries of the phases of calls are exported as metrics, see qabel_provider.phases.
+
     :return: HttpResponseBadRequest|HttpResponse(status=204)|HttpResponse(status=403)|HttpResponse(status=404)
     """
-    if 'auth' in request.data and 'user_id' in request.data:
-        return Response(status=400, data={'error': 'Pass *either* an auth token *or* an user ID'})
-    elif 'auth' in request.data:
-        user_auth = request.data['auth']
+    with phases.phase('lookup'):
         try:
-            auth_type, token = user_auth.split()
-            if auth_type != 'Token':
-                raise ValueError()
-        except ValueError:
-            return Response(status=400, data={'error': 'Invalid auth type'})
-        try:
-            user = Token.objects.get(key=token).user
-        except Token.DoesNotExist:
-            return Response(status=404, data={'error': 'Invalid token'})
-    elif 'user_id' in request.data:
-        try:
-            user_id = int(request.data['user_id'])
-        except (KeyError, ValueError):
-            return Response(status=400, data={'error': 'Malformed user ID'})
-        try:
-            user = User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return Response(status=404, data={'error': 'Invalid user ID'})
+            kind, value = parse_user_identification(request.data)
+        except AuthResourceError as error:
+            return error.response()
+        cached, versions = entitlements.lookup([(kind, value)])
+        if not cached:
+            user = resolve_entitlements(kind, [value]).get(value)
+            if user is None:
+                return Response(status=404, data={'error': NOT_FOUND_ERRORS[kind]})
+    if cached:
+        data, valid_until = cached[(kind, value)]
     else:
-        return Response(status=400, data={'error': 'No user identification supplied'})
+        logger.debug('Auth resource called: user={}'.format(user))
+        data, valid_until = entitlement_answers([user])[user.id]
+        with phases.phase('entitlement'):
+            entitlements.store(user.id, data, valid_until, versions, token=value if kind == 'token' else None)
 
-    logger.debug('Auth resource called: user={}'.format(user))
-    is_disabled = user.profile.check_confirmation_and_send_mail()
-    profile = user.profile
-    profile.use_plan()
+    with phases.phase('serialization'):
+        response = Response(dict(data))
+        if wants_ticket(request.data):
+            tickets.add_ticket(response, data, valid_until)
+    return response
+
+
+# Upper bound for the number of entries of a single auth_resource_batch request.
+AUTH_RESOURCE_BATCH_LIMIT = 1000
+
+
+@api_view(('POST',))
+@require_api_key
+def auth_resource_batch(request, format=None):
+    """
+    Batch variant of auth_resource, for authorizing many block server requests with one call.
+
+    Payload layout::
+
+        {
+            'users': [
+                {'auth': STR} | {'user_id': INT},
+                ...
+            ]
+        }
+
+    The response contains one result per entry, in the same order::
+
+        {
+            'users': [
+                {'status': 200, 'user_id': INT, 'active': BOOL, 'block_quota': INT, 'monthly_traffic_quota': INT,
+                 'over_quota': BOOL},
+                {'status': 400|404, 'error': STR},
+                ...
+            ]
+        }
+
+    Successful results have the same layout as auth_resource responses, with an added *status*.
+    Like in auth_resource, passing *ticket* adds a ticket and its *valid_until* to every successful result.
+    Users are looked up with one query per kind of identification, and every distinct user
+    is processed only once, regardless of how often it occurs in the batch. Cached answers and
+    Entitlement rows are used like in auth_resource.
+    """
+    entries = request.data.get('users') if hasattr(request.data, 'get') else None
+    if not isinstance(entries, list):
+        return Response(status=400, data={'error': 'Expected a list of users'})
+    if len(entries) > AUTH_RESOURCE_BATCH_LIMIT:
+        return Response(status=400, data={'error': 'Too many users, at most %d allowed' % AUTH_RESOURCE_BATCH_LIMIT})
+
+    identifications = []
+    for entry in entries:
+        try:
+            if not isinstance(entry, dict):
+                raise AuthResourceError(400, 'No user identification supplied')
+            identifications.append(parse_user_identification(entry))
+        except AuthResourceError as error:
+            identifications.append(error)
+
+    cached, versions = entitlements.lookup([identification for identification in identifications
+                                            if not isinstance(identification, AuthResourceError)])
+
+    def values_of(wanted_kind):
+        return {identification[1] for identification in identifications
+                if not isinstance(identification, AuthResourceError) and identification[0] == wanted_kind
+                and identification not in cached}
+
+    users_by_token = resolve_entitlements('token', values_of('token'))
+    users_by_id = resolve_entitlements('user_id', values_of('user_id'))
+    for user in users_by_token.values():
+        # Use one instance per user, so that it is processed only once.
+        users_by_id.setdefault(user.id, user)
+    answers = entitlement_answers(users_by_id.values())
+
+    with_tickets = wants_ticket(request.data)
+
+    def batch_result(data, valid_until):
+        result = dict(data, status=200)
+        if with_tickets:
+            expires = tickets.expiry(valid_until)
+            result['ticket'] = tickets.issue(data, expires)
+            result['valid_until'] = int(expires.timestamp())
+        return result
+
+    results_by_user = {}
+    results = []
+    for identification in identifications:
+        if isinstance(identification, AuthResourceError):
+            results.append({'status': identification.status, 'error': identification.error})
+            continue
+        if identification in cached:
+            data, valid_until = cached[identification]
+            results.append(batch_result(data, valid_until))
+            continue
+        kind, value = identification
+        user = (users_by_token if kind == 'token' else users_by_id).get(value)
+        if user is None:
+            results.append({'status': 404, 'error': NOT_FOUND_ERRORS[kind]})
+            continue
+        if user.id not in results_by_user:
+            data, valid_until = answers[user.id]
+            entitlements.store(user.id, data, valid_until, versions, token=value if kind == 'token' else None)
+            results_by_user[user.id] = batch_result(data, valid_until)
+        results.append(results_by_user[user.id])
+
+    logger.debug('Auth resource batch called: %d entries, %d users', len(entries), len(results_by_user))
+    return Response({'users': results})
+
+
+# Interval (in seconds) of looking for new changes while long-polling entitlement_changes
+ENTITLEMENT_FEED_POLL_INTERVAL = 1
+
+
+@api_view(('GET',))
+@require_api_key
+def entitlement_changes(request, format=None):
+    """
+    Feed of entitlement changes, for block servers keeping local copies of auth_resource answers.
+
+    Query parameters:
+
+    - *after*: cursor returned by the previous call. Without it no changes are returned, only the current cursor.
+    - *limit*: maximum number of changes returned, at most (and by default) AUTH_RESOURCE_BATCH_LIMIT.
+    - *wait*: seconds to wait for changes if there are none yet (long-polling), at most ENTITLEMENT_FEED_MAX_WAIT.
+
+    Response layout::
+
+        {
+            'changes': [
+                {'cursor': INT, 'user_id': INT, 'plan_id': null, 'changed_at': STR},
+                {'cursor': INT, 'user_id': null, 'plan_id': STR, 'changed_at': STR},
+                ...
+            ],
+            'cursor': INT,
+        }
+
+    Each change with a *user_id* means that the answer of auth_resource for the user may have changed (including the
+    user being deleted), clients should fetch the answers of changed users again, e.g. with auth_resource_batch.
+    A change with a *plan_id* means that the plan changed, and with it the answers of all its users; clients should
+    fetch all answers again.
+    Pass the returned *cursor* as *after* to the next call.
+    """
+    try:
+        limit = min(int(request.query_params.get('limit', AUTH_RESOURCE_BATCH_LIMIT)), AUTH_RESOURCE_BATCH_LIMIT)
+        wait = min(float(request.query_params.get('wait', 0)), settings.ENTITLEMENT_FEED_MAX_WAIT)
+        after = request.query_params.get('after')
+        if after is not None:
+            after = int(after)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return Response(status=400, data={'error': 'Malformed parameters'})
+    if after is None:
+        return Response({'changes': [], 'cursor': entitlements.feed_cursor()})
+
+    deadline = time.monotonic() + wait
+    # One query per poll, see QUERY_BUDGETS
+    while not entitlements.pending_after(after) and time.monotonic() < deadline:
+        time.sleep(ENTITLEMENT_FEED_POLL_INTERVAL)
+    changes = entitlements.changes_after(after, limit)
     return Response({
-        'user_id': user.id,
-        'active': (not is_disabled),
-        'block_quota': profile.plan.block_quota,
-        'monthly_traffic_quota': profile.plan.monthly_traffic_quota,
+        'changes': [{'cursor': change.sequence, 'user_id': change.user_id, 'plan_id': change.plan_id,
+                     'changed_at': change.created_at}
+                    for change in changes],
+        'cursor': changes[-1].sequence if changes else after,
     })
 
 
-class PasswordSetForm(PasswordResetForm):
+@api_view(('POST',))
+@require_api_key
+def usage_report(request, format=None):
+    """
+    Usage deltas of users, reported by block servers.
+
+    Payload layout::
+
+        {
+            'users': [
+                {'user_id': INT, 'traffic': INT, 'stored': INT},
+                ...
+            ]
+        }
+
+    *traffic* is the number of bytes transferred and *stored* the change of the number of bytes stored by the user
+    since the previous report of the block server. Both default to zero, entries of the same user are added up.
+    A report with a malformed entry is rejected as a whole, so that it can be sent again after fixing it.
+
+    The deltas are added up in the cache and flushed into the usage rollups by the flush_usage command,
+    see qabel_provider.usage.
+    """
+    serializer = UsageReportSerializer(data=request.data)
+    serializer.is_valid(True)
+    usage.record(serializer.save())
+    return Response()
+
+
+class PasswordSetForm(QueuedPasswordResetForm):
     def send_mail(self, subject_template_name, email_template_name,
                   context, from_email, to_email, html_email_template_name=None):
         """
-        Sends a django.core.mail.EmailMultiAlternatives to `to_email`.
+        Queues a django.core.mail.EmailMultiAlternatives to `to_email`, with the `cc_emails` passed to save() in CC.
         """
         cc_emails = context.pop('cc_emails')
-        subject = loader.render_to_string(subject_template_name, context)
-        # Email subject *must not* contain newlines
-        subject = ''.join(subject.splitlines())
-        body = loader.render_to_string(email_template_name, context)
-
-        email_message = EmailMultiAlternatives(subject, body, from_email, [to_email], cc=cc_emails)
-        if html_email_template_name is not None:
-            html_email = loader.render_to_string(html_email_template_name, context)
-            email_message.attach_alternative(html_email, 'text/html')
-
-        email_message.send()
+        outbox.enqueue(self.render_mail(subject_template_name, email_template_name, context, from_email, to_email,
+                                        html_email_template_name, cc_emails))
 
     def save(self, cc_emails, **kwargs):
         # Judica me, Deus, et discerne causam meam de gente non sancta: ab homine iniquo et doloso erue me.
@@ -173,54 +478,66 @@ def register_on_behalf(request, format=None):
     serializer.is_valid(True)
     userdata = serializer.save()
 
-    try:
-        with transaction.atomic():
-            if User.objects.filter(email=userdata.email).count():
-                return Response({'status': 'Account exists'})
-
-            username = gen_username(userdata.email)
-
-            # We set a very long, random password because PasswordResetForm requires a usable password
-            # (to avoid having disabled-by-staff users re-enable their accounts via a passwort reset).
-            password = os.urandom(64).hex()
-            user = User.objects.create_user(username,
-                                            email=userdata.email,
-                                            password=password,
-                                            first_name=userdata.first_name,
-                                            last_name=userdata.last_name)
-            EmailAddress.objects.create(user=user, email=userdata.email,
-                                        primary=True, verified=True)
-            for email in userdata.secondary_emails:
-                EmailAddress.objects.create(user=user, email=email,
-                                            primary=False, verified=True)
-            user.profile.created_on_behalf = True
-            user.profile.save()
-
-            password_form = PasswordSetForm(data={'email': userdata.email})
-            if not password_form.is_valid():
-                # Should not be possible to hit, unless drf3 and django use different email validators w/ different accepting sets
-                logger.error('register_on_behalf failed, password reset form with validated email is invalid?! '
-                             'Errors are: %r', password_form.errors)
-                return Response({'status': 'Registration failed.'}, status=500)
-
-            password_form.save(
-                cc_emails=userdata.secondary_emails,
-                request=request,
-                use_https=request.is_secure(),
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                subject_template_name='registration/account_created_subject.txt',
-                email_template_name='registration/account_created_email.txt',
-                html_email_template_name='registration/account_created_email.html'
-            )
-    except SMTPException as smtp_exception:
-        # zodb has a much, much nicer design here. You can just call doom() inside a transaction, trying to commit it
-        # will fail (with an exception). Leaving the scope does not. Intuitive, correct, avoids huge exception handlers.
-        logger.exception('register_on_behalf failed while sending mail')
-        return Response({'status': 'Registration failed. SMTP error: %s' % smtp_exception}, status=400)
+    with transaction.atomic():
+        # Like the bulk variant, any address in use makes the account exist
+        if provisioning.taken_emails(provisioning.emails_of(userdata)):
+            return Response({'status': 'Account exists'})
+
+        # We set a very long, random password because PasswordResetForm requires a usable password
+        # (to avoid having disabled-by-staff users re-enable their accounts via a passwort reset).
+        password = os.urandom(64).hex()
+        user = create_user(userdata.email,
+                           password=password,
+                           first_name=userdata.first_name,
+                           last_name=userdata.last_name)
+        EmailAddress.objects.bulk_create(provisioning.email_addresses(user, userdata))
+        user.profile.created_on_behalf = True
+        user.profile.save()
+
+        password_form = PasswordSetForm(data={'email': userdata.email})
+        if not password_form.is_valid():
+            # Should not be possible to hit, unless drf3 and django use different email validators w/ different accepting sets
+            logger.error('register_on_behalf failed, password reset form with validated email is invalid?! '
+                         'Errors are: %r', password_form.errors)
+            return Response({'status': 'Registration failed.'}, status=500)
+
+        password_form.save(
+            cc_emails=userdata.secondary_emails,
+            request=request,
+            use_https=request.is_secure(),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            **provisioning.ACCOUNT_CREATED_MAIL
+        )
 
     return Response({'status': 'Account created'})
 
 
+@api_view(('POST',))
+@require_api_key
+def register_on_behalf_bulk(request, format=None):
+    """
+    Register many accounts on behalf of their users, like register_on_behalf.
+
+    The request body has one register_on_behalf payload per line (NDJSON), at most provisioning.LIMIT non-empty lines.
+    Records are registered in chunks of provisioning.BATCH_SIZE, one transaction each, before the response is sent. It
+    has one result per non-empty line, in order::
+
+        {"line": INT, "email": STR, "status": "Account created", "username": STR}
+        {"line": INT, "email": STR, "status": "Account exists"}
+        {"line": INT, "email": STR, "status": "Registration failed"}
+        {"line": INT, "status": "Invalid record", "errors": {...}}
+        {"line": INT, "status": "Malformed record", "error": STR}
+
+    Records failing to register can be sent again. API authentication required.
+    """
+    entries = list(provisioning.parse(request.stream or ()))
+    if len(entries) > provisioning.LIMIT:
+        return Response(status=400, data={'error': 'Too many records, at most %d allowed' % provisioning.LIMIT})
+    results = provisioning.register(entries, request)
+    return HttpResponse(''.join(json.dumps(result) + '\n' for result in results),
+                        content_type='application/x-ndjson')
+
+
 @api_view(('POST',))
 @require_api_key
 def plan_subscription(request, format=None):
@@ -283,6 +600,72 @@ def plan_add_interval(request, format=None):
     return Response()
 
 
+@api_view(('POST',))
+@require_api_key
+def plan_batch(request, format=None):
+    """
+    Batch variant of plan_subscription and plan_add_interval, for reconciling many subscriptions at once.
+
+    Payload layout::
+
+        {
+            'changes': [
+                {'action': 'set-plan', 'user_email': STR, 'plan': STR (id-of-plan)},
+                {'action': 'add-interval', 'user_email': STR, 'plan': STR (id-of-plan), 'duration': STR},
+                ...
+            ]
+        }
+
+    The response contains one result per change, in the same order::
+
+        {
+            'changes': [
+                {'status': 200},
+                {'status': 400, 'errors': {FIELD: [STR, ...], ...}},
+                ...
+            ]
+        }
+
+    Changes are applied in chunks of subscriptions.BATCH_SIZE, one transaction each (see qabel_provider.subscriptions).
+    Changes of the same user take effect in order. API authentication required.
+    """
+    changes = request.data.get('changes') if hasattr(request.data, 'get') else None
+    if not isinstance(changes, list):
+        return Response(status=400, data={'error': 'Expected a list of changes'})
+    if len(changes) > subscriptions.LIMIT:
+        return Response(status=400, data={'error': 'Too many changes, at most %d allowed' % subscriptions.LIMIT})
+    return Response({'changes': subscriptions.apply(changes, get_request_origin(request))})
+
+
+@api_view(('GET',))
+@require_api_key
+def audit_log_export(request, format=None):
+    """
+    Export the audit log (plan changes of all users) of a period, for finance reconciliation.
+
+    Query parameters:
+
+    - *since*: start of the period (inclusive), an ISO 8601 date and time. Times without time zone are UTC.
+    - *until*: end of the period (exclusive), likewise.
+    - *type*: "csv" (default) or "ndjson".
+
+    The response is streamed, one line per entry, oldest first, with the fields
+    id, timestamp, user_id, username, action, plan, interval (ID) and origin. CSV starts with a header line.
+
+    API authentication required.
+    """
+    try:
+        since, until = (parse_datetime(request.query_params.get(param, '')) for param in ('since', 'until'))
+        if not since or not until:
+            raise ValueError
+        content_type, generate = audit.FORMATS[request.query_params.get('type', 'csv')]
+    except (ValueError, KeyError):
+        return Response(status=400, data={'error': 'Malformed parameters'})
+    since, until = (moment if timezone.is_aware(moment) else timezone.make_aware(moment, timezone.utc)
+                    for moment in (since, until))
+    return StreamingHttpResponse(generate(audit.entries(since, until)), content_type=content_type)
+
+
 class ThrottledLoginView(LoginView):
 
     @staticmethod
@@ -326,35 +709,28 @@ class PasswordPolicyRegisterView(RegisterView):
     serializer_class = UserSerializer
 
 
-def get_used_quota_of_user(user):
-    cache_key = 'user-quota-%d' % user.id
-    quota_used = cache.get(cache_key)
-    if quota_used is not None:
-        return quota_used
-    try:
-        _, quota_used = get_block_quota_of_user(user)
-    except Exception:
-        logger.exception('Unable to retrieve block quota.')
-        return 0
-    else:
-        cache.set(cache_key, quota_used, 60)
-        return quota_used
-
-
 @login_required
 def user_profile(request):
     user = request.user
     profile = user.profile
+    # Outdated rows are rewritten by the next auth_resource call, not by page views
+    entitlement = entitlements.current(user) or entitlements.computed(user)
 
-    quota_used = get_used_quota_of_user(user)
+    quota_used, quota_updated_at = quota.get_used_quota(user)
     user_greeting = '{} {}'.format(user.first_name, user.last_name).strip() or user.username
 
     return render(request, 'accounts/profile.html', {
         'user_greeting': user_greeting,
         'profile': profile,
+        'plan': entitlement.plan,
         'block_used': quota_used,
-        'block_quota': profile.plan.block_quota,
-        'block_percentage': int((quota_used / profile.plan.block_quota) * 100),
+        'block_used_updated_at': quota_updated_at,
+        'block_used_stale': quota.is_stale(quota_updated_at),
+        'block_quota': entitlement.block_quota,
+        'block_percentage': int((quota_used / entitlement.block_quota) * 100),
+        'traffic_used': usage.month_traffic(profile),
+        'traffic_quota': entitlement.monthly_traffic_quota,
+        'over_quota': entitlements.over_quota_of(user),
     })
 
 
@@ -398,23 +774,108 @@ def change_user_profile(request):
 event_describers = {
     'start-interval': _('Started using prepaid plan {.plan}').format,
     'expired-interval': _('Prepaid plan {.plan} expired').format,
-    'add-interval': _('Prepaid plan {.plan} of duration {.interval.duration} added').format,
+    'add-interval': _('Prepaid plan {0.plan} of duration {0.interval.duration} added').format,
     'set-plan': _('Subscribed to {.plan}').format,
 }
 
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def history_cursor(event):
+    """Return the cursor pointing behind *event*: its timestamp (in microseconds) and ID."""
+    return '%d-%d' % ((event.timestamp - HISTORY_EPOCH) // datetime.timedelta(microseconds=1), event.id)
+
+
+def history_page(profile, before, limit):
+    """
+    Return the *limit* latest events of *profile* before the cursor *before* (if any), and the cursor of the next page.
+
+    The cursor is None on the last page. Pages are looked up by keyset on (timestamp, id), which is covered by an index,
+    so that every page costs the same regardless of its position. Raise ValueError for malformed cursors.
+    """
+    if before:
+        timestamp, event_id = before.split('-')
+        try:
+            timestamp = HISTORY_EPOCH + datetime.timedelta(microseconds=int(timestamp))
+        except OverflowError:
+            raise ValueError('Cursor out of range')
+        event_id = int(event_id)
+        if event_id >= 2 ** 63:
+            # Beyond the integer range of the database
+            raise ValueError('Cursor out of range')
+    events = []
+    # Entries of closed months may be archived (see qabel_provider.audit)
+    for model in (ProfilePlanLog, ArchivedProfilePlanLog):
+        page = model.objects.filter(profile=profile).select_related('plan', 'interval')
+        if before:
+            page = page.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=event_id))
+        events += page.order_by('-timestamp', '-id')[:limit + 1]
+    events.sort(key=lambda event: (event.timestamp, event.id), reverse=True)
+    events = events[:limit + 1]
+    cursor = history_cursor(events[limit - 1]) if len(events) > limit else None
+    return events[:limit], cursor
+
+
+def describe_event(event):
+    return {
+        'timestamp': event.timestamp,
+        'action': event.action,
+        'plan': event.plan_id,
+        'description': event_describers[event.action](event),
+    }
+
+
 @login_required
 def user_history(request):
     user = request.user
     profile = user.profile
-
-    events = []
-    for event in ProfilePlanLog.objects.filter(profile=profile):
-        events.append(event_describers[event.action](event))
+    try:
+        events, cursor = history_page(profile, request.GET.get('before'), HISTORY_PAGE_SIZE)
+    except ValueError:
+        events, cursor = history_page(profile, None, HISTORY_PAGE_SIZE)
 
     return render(request, 'accounts/history.html', {
         'profile': profile,
-        'events': events,
+        'events': [describe_event(event) for event in events],
+        'cursor': cursor,
+    })
+
+
+@api_view(('GET',))
+@permission_classes((IsAuthenticated,))
+def account_history(request, format=None):
+    """
+    History of the account (plan changes), latest first, in pages.
+
+    Query parameters:
+
+    - *before*: cursor returned by the previous call. Without it the latest events are returned.
+    - *limit*: maximum number of events returned, at most (and by default) HISTORY_PAGE_SIZE.
+
+    Response layout::
+
+        {
+            'events': [
+                {'timestamp': STR, 'action': STR, 'plan': STR (id-of-plan), 'description': STR},
+                ...
+            ],
+            'cursor': STR | null,
+        }
+
+    Pass the returned *cursor* as *before* to get the next page; it is null on the last page.
+    """
+    try:
+        limit = min(int(request.query_params.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError
+        events, cursor = history_page(request.user.profile, request.query_params.get('before'), limit)
+    except ValueError:
+        return Response(status=400, data={'error': 'Malformed parameters'})
+    return Response({
+        'events': [describe_event(event) for event in events],
+        'cursor': cursor,
     })
 
 
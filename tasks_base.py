@@ -135,9 +135,13 @@ class BaseUwsgiConfiguration:
             for description, configuration in self.sections:
                 print(file=file)
                 print('#', description, file=file)
-                for key, value in configuration.items():
-                    expanded_value = str(value).format_map(self.variables)
-                    print(key, '=', expanded_value, file=file)
+                for key, values in configuration.items():
+                    # Options given more than once (like env) are lists
+                    if not isinstance(values, list):
+                        values = [values]
+                    for value in values:
+                        expanded_value = str(value).format_map(self.variables)
+                        print(key, '=', expanded_value, file=file)
 
     def write_info(self, file):
         """Write commit information to *file*."""
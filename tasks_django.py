@@ -27,6 +27,9 @@ class UwsgiConfiguration(BaseUwsgiConfiguration):
 
         self.basename = self.path.with_suffix('').name
         self.settings_path = self.tmp_path / 'settings.py'
+        # Metrics of the uWSGI workers, aggregated by the metrics view (see qabel_provider.monitoring)
+        (self.tmp_path / 'prometheus').mkdir()
+        self.prometheus_path = (self.path.parent / 'prometheus').absolute()
 
         # By default automagic, but allow override
         if 'STATIC_ROOT' not in self.config:
@@ -48,6 +51,12 @@ class UwsgiConfiguration(BaseUwsgiConfiguration):
     def settings_pythonpath(self):
         return self.path.parent.absolute()
 
+    def manage_command_line(self, args):
+        """Return command line running the manage.py command *args* of the deployed tree, e.g. from uWSGI daemons."""
+        # DJANGO_SETTINGS_MODULE is inherited from the uWSGI master, see automagic
+        return 'env PYTHONPATH={pythonpath} {{virtualenv}}/bin/python -Wi {{tree}}/manage.py {args}'.format(
+            pythonpath=self.settings_pythonpath(), args=args)
+
     def automagic(self):
         """Return automatically inferred|inferrable configuration."""
         config = {
@@ -56,7 +65,24 @@ class UwsgiConfiguration(BaseUwsgiConfiguration):
 
             # Path to the settings module generated (e.g. deployed/current.py)
             'python-path': self.settings_pythonpath(),
-            'env': 'DJANGO_SETTINGS_MODULE=' + self.settings_module(),
+            'env': [
+                'DJANGO_SETTINGS_MODULE=' + self.settings_module(),
+                'prometheus_multiproc_dir=' + str(self.prometheus_path),
+            ],
+            # Files of workers of an earlier master would be aggregated with those of the current ones
+            'exec-asap': 'rm -f ' + str(self.prometheus_path / '*.db'),
+            # Mails are queued in the outbox by requests, see qabel_provider.outbox. uWSGI restarts the sender if it dies.
+            'attach-daemon': self.manage_command_line('send_queued_mail --loop'),
+            # Periodic jobs (minute hour day month weekday, -N is every N), skipped while the previous run is still busy
+            'unique-cron': [
+                # Usage not flushed within a day is lost, see qabel_provider.usage
+                '-5 -1 -1 -1 -1 ' + self.manage_command_line('flush_usage'),
+                # Snapshots older than MONITORING_STATS_MAX_AGE aren't exported, see qabel_provider.monitoring
+                '-2 -1 -1 -1 -1 ' + self.manage_command_line('snapshot_stats'),
+                # Expires intervals ahead of requests (see qabel_provider.intervals) and records changes of
+                # entitlements caused by time alone in the feed (see qabel_provider.entitlements)
+                '-1 -1 -1 -1 -1 ' + self.manage_command_line('sweep_intervals'),
+            ],
 
             # Where the app packages (e.g. qabel_provider, qabel_id) live
             'pythonpath': '{tree}',